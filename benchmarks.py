@@ -73,3 +73,66 @@ print()
 pycytime(['Bounded','Group','Literal'], '{2}("a"),{1}({2}("b")),{2}("c")', '"abc"')
 pycytime(['Sequence','Group','Literal'], '{2}("a"),{1}({2}("b")),{2}("c")', '"abc"')
 
+
+# terminals failing at the end of input or on a mismatch
+print()
+pycytime(['Literal'], '"abcdefg"', '""')
+pycytime(['Literal'], '"abcdefg"', '"abcdefX"')
+pycytime(['Spacing'], '', '""')
+pycytime(['Integer'], '', '""')
+pycytime(['Integer'], '', '"-"')
+pycytime(['Float'], '', '"123"')
+pycytime(['Float'], '', '"1.0e"')
+pycytime(['BoundedString'], '\'"\', \'"\'', '\'"abcdefghij\'')
+pycytime(['BoundedString'], '\'"\', \'"\'', '\'x"abcdefg"\'')
+pycytime(['Choice','Literal','Integer','Dot'], '{1}("abc"),{2}(),{3}()', '""')
+pycytime(['Choice','Literal'], '{1}("abcd"),{1}("abce"),{1}("abcf")', '"abcg"')
+
+# matching records one at a time vs. one repetition over all of them
+print()
+print('Repeat(CharacterClass("a-z"),min=1) over 100 lines\n'
+      '  (match with delimiter, iter_matches)')
+for prefix in ('py', 'cy'):
+    setup = (
+        'from textpy.scanners import {0}_Repeat, {0}_CharacterClass,'
+        ' {0}_Literal; d={0}_Literal("\\n");'
+        ' w={0}_Repeat({0}_CharacterClass("a-z"), min=1);'
+        ' f={0}_Repeat(w, delimiter=d).match; g=w.iter_matches;'
+        ' s="abc\\n" * 100'.format('c' if prefix == 'cy' else prefix)
+    )
+    print('  {}: {}\t{}'.format(
+        prefix,
+        timeit('f(s)', setup=setup, number=1000),
+        timeit('for m in g(s, delimiter=d): pass', setup=setup, number=1000)
+    ))
+
+# a memory-mapped input past 2 GiB, so positions exceed a C int
+print()
+print('Sequence(BoundedString(\'"\', \'"\'), Integer()) over a 2 GiB mmap\n'
+      '  (scan, match)')
+setup = (
+    'import mmap; from textpy.scanners import c_Sequence, c_BoundedString,'
+    ' c_Integer, c_Group; n=2**31+10; s=mmap.mmap(-1, n+3);'
+    ' s[0:1]=b\'"\'; s[n-1:]=b\'"123\'; s.find(b"x");'  # fault pages in
+    ' p=c_Sequence(c_BoundedString(b\'"\', b\'"\'), c_Group(c_Integer()))'
+)
+print('  cy: {}\t{}'.format(
+    timeit('p.scan(s)', setup=setup, number=5) / 5,
+    timeit('p.match(s)', setup=setup, number=5) / 5
+))
+
+# the recursive scanners vs. the same grammar compiled for the machine
+print()
+print('Grammar vs. Grammar.machine() on 2000 nested arrays\n'
+      '  (scan, match)')
+setup = (
+    'from textpy.grammars import Grammar;'
+    ' g=Grammar(\'Start = "[" (Start | Num){:","} "]"\\nNum = [0-9]+\');'
+    ' m=g.machine(); s="[" + ",".join(["[1,22,[333,4]]"] * 2000) + "]"'
+)
+for name, obj in (('tree', 'g'), ('vm', 'm')):
+    print('  {}: {}\t{}'.format(
+        name,
+        timeit('{}.scan(s)'.format(obj), setup=setup, number=100),
+        timeit('{}.match(s)'.format(obj), setup=setup, number=100)
+    ))
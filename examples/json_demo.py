@@ -31,22 +31,20 @@ like this:
     COLON       <- ':' Spacing
     Spacing     <- [ \t\n]*
 
-Note that string processing does not currently process escape
-sequences. Because JSON strings can contain both unicode AND escaped
-unicode, some custom processing is required. See this StackOverflow
-answer: http://stackoverflow.com/a/24519338/1441112
+Strings are scanned with `BoundedString(..., decode=True)`, which
+decodes JSON escape sequences (including `\\uXXXX` and surrogate pairs)
+as it makes the value.
 
 '''
 
 from textpy.scanners import *
-from textpy.actions import constant
+from textpy.actions import constant, identity
 from textpy.grammars import Grammar, PEG
 
 
 grm = {}
-Str = Group(BoundedString('"', '"'), action=lambda s: s[1:-1])
-Flt = Group(Float(), action=float)
-Int = Group(Integer(), action=int)
+Str = Group(BoundedString('"', '"', decode=True), action=identity)
+Num = Number()
 Tru = Group(Literal('true'), action=constant(True))
 Fls = Group(Literal('false'), action=constant(False))
 Nul = Group(Literal('null'), action=constant(None))
@@ -71,7 +69,7 @@ Array = Group(
     ),
     action=list
 )
-grm['Value'] = Choice(Object, Array, Str, Tru, Fls, Nul, Flt, Int)
+grm['Value'] = Choice(Object, Array, Str, Tru, Fls, Nul, Num)
 
 Json = Choice(Object, Array)
 
@@ -86,26 +84,22 @@ Json2 = Grammar(
                (Value){:Comma}
                Spacing "]"
     Value    = Object | Array | DQString
-             | TrueVal | FalseVal | NullVal | Float | Integer
+             | TrueVal | FalseVal | NullVal | Number
     TrueVal  = "true"
     FalseVal = "false"
     NullVal  = "null"
     Comma    = Spacing "," Spacing
     '''
 )
-Json2['Float'] = Float()
-Json2['Integer'] = Integer()
-Json2['DQString'] = BoundedString('"', '"')
+Json2['Number'] = Number()
+Json2['DQString'] = BoundedString('"', '"', decode=True)
 Json2['Spacing'] = Spacing()
 Json2.update_actions(
     Object=dict,
     Array=list,
-    DQString=lambda s: s[1:-1],
     TrueVal=constant(True),
     FalseVal=constant(False),
-    NullVal=constant(None),
-    Float=float,
-    Integer=int
+    NullVal=constant(None)
 )
 
 
@@ -1,8 +1,18 @@
 #!/usr/bin/env python3
 
+import re
 from distutils.core import setup
+
+import Cython
 from Cython.Build import cythonize
 
+# textpy/_scanners.pyx uses critical sections and declares itself
+# compatible with free-threaded builds, both new in Cython 3.1
+version = re.match(r'(\d+)\.(\d+)', Cython.__version__).groups()
+if tuple(map(int, version)) < (3, 1):
+    raise SystemExit('TextPy needs Cython 3.1 or later, found '
+                     + Cython.__version__)
+
 setup(
   name = 'textpy',
   ext_modules = cythonize("textpy/_scanners.pyx"),
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+import io
+import json
+
+from textpy import bench, scanners
+from textpy.bench import corpora
+from textpy.grammars import Grammar
+
+
+def test_corpora():
+    for name, (generate, make_parser, nested) in corpora.CORPORA.items():
+        p = make_parser()
+        for depth in ((1, 4) if nested else (1,)):
+            doc = generate(2000, depth, seed=1)
+            assert len(doc) >= 2000 and doc == generate(2000, depth, seed=1)
+            assert p.scan(doc) == len(doc), name
+    doc = corpora.json_document(3000, depth=5)
+    assert corpora.json_parser().match(doc).value == json.loads(doc)
+
+
+def test_family():
+    g = Grammar('''
+        Start = "[" (Start | Num){:","} "]"
+        Num   = [0-9]+
+    ''', actions={'Num': int})
+    s = '[1,[2,3],[]]'
+    for prefix in bench.families():
+        base = getattr(scanners, prefix + '_Scanner')
+        g2 = bench.family(g, prefix)
+        assert isinstance(g2['Start'], base)
+        assert g2.match(s).value == g.match(s).value
+        r = bench.family(corpora.grammar_parser(), prefix)
+        doc = corpora.grammar_document(500, 3)
+        assert isinstance(r, base)
+        assert r.match(doc).value == corpora.grammar_parser().match(doc).value
+
+
+def test_run():
+    rows = bench.run(corpora=['csv', 'json'], sizes=(200,), depths=(1, 3),
+                     repeat=3, warmup=0)
+    n = len(bench.families()) * len(bench.MODES)
+    assert len(rows) == 3 * n  # csv does not nest
+    for row in rows:
+        assert row['parity'] and row['repeat'] == 3
+        assert row['min'] <= row['p50'] <= row['p90'] <= row['p99']
+        assert row['mb_per_s'] > 0
+    assert bench.percentile([3, 1, 2, 4], 50) == 2
+    assert bench.percentile([3, 1, 2, 4], 99) == 4
+    f = io.StringIO()
+    bench.dump(rows, f, label='test')
+    f.seek(0)
+    old = bench.load(f)
+    assert old == rows
+    pairs = bench.compare(old, rows[:2])
+    assert [ratio for _, ratio in pairs] == [1.0, 1.0]
+    assert 'MB/s' in bench.header() and bench.line(rows[0])
+
+
+def test_memory():
+    m = bench.measure_memory(lambda n: [object() for _ in range(n)], 1000)
+    assert 1000 <= m['blocks'] < 1100
+    assert m['retained'] >= 1000 * 16 and m['peak'] >= m['retained']
+    assert m['rss'] is None or m['rss'] >= 0
+    rows = bench.run_memory(corpora=['log'], sizes=(2000,), depths=(1,))
+    assert len(rows) == len(bench.families()) * len(bench.MEMORY_MODES)
+    stats = dict(((row['family'], row['mode']), row) for row in rows)
+    for prefix in bench.families():
+        scan, match, trace = [stats[prefix, mode]
+                              for mode in bench.MEMORY_MODES]
+        assert scan['retained'] < match['retained'] < trace['retained']
+        assert match['blocks'] < trace['blocks']
+    f = io.StringIO()
+    bench.dump([], f, memory=rows)
+    f.seek(0)
+    old = bench.load(f, memory=True)
+    assert [ratio for _, ratio in bench.compare(old, rows, 'peak')] == \
+        [1.0] * len(rows)
+    assert 'peak kB' in bench.memory_header() and bench.memory_line(rows[0])
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from textpy.scanners import Literal, ParseError
+from textpy.grammars import Grammar
+
+def test_memoize():
+    g = Grammar('''
+        Start = A "x" | A "y" | A "z"
+        A     = "(" A ")" | "a"
+    ''')
+    s = '(((a)))z'
+    assert g.scan(s) == 8
+    m = g.memoize()
+    assert g.scan(s) == 8
+    assert m.misses == 4 and m.hits == 2
+    assert g.match(s).value == s
+    m = g.memoize(rules=['Start'])  # A is not memoized
+    assert g.scan(s) == 8
+    assert m.hits == m.misses == 0
+    m = g.memoize(rules=[])
+    assert g.scan(s) == 8
+
+def test_compile():
+    g = Grammar('''
+        Start = A B
+        A     = "a"
+    ''')
+    try:
+        g.compile()
+    except ValueError as ex:
+        assert 'B' in str(ex)
+    else:
+        assert False, 'undefined rule not detected'
+    try:
+        g.scan('ab')
+    except ValueError:
+        pass
+    else:
+        assert False, 'undefined rule not detected'
+    g['B'] = g.nonterminal('A')
+    assert g.compile() is g
+    assert g.scan('aa') == 2
+    g['A'] = Grammar('X = "b"')['X']  # redefining unlinks
+    assert g.scan('bb') == 2
+
+def test_optimize_dispatch():
+    g = Grammar('''
+        Start = Value
+        Value = Word | Num | "(" Value ")"
+        Word  = [a-z]+
+        Num   = [0-9]+
+    ''')
+    report = g.optimize(fuse=False, rewrite=False)
+    assert report['dispatched'] == [('Value', 'Word | Num | "(" Value ")"')]
+    assert g.scan('((ab))') == 6
+    assert g.scan('12') == 2
+    g['Num'] = Grammar('X = "x"')['X']  # tables are dropped
+    assert g.scan('x') == 1
+
+def test_bytes():
+    g = Grammar('''
+        Start = Value
+        Value = Word | Num | "(" Value ")"
+        Word  = [a-z]+
+        Num   = /[0-9]+/
+    ''')
+    assert g.scan(b'((ab))') == 6
+    assert g.match(bytearray(b'12')).value == b'12'
+    g.memoize()
+    g.optimize()
+    assert g.scan(b'((ab))') == 6
+    assert g.match(b'(12)').value == b'(12)'
+
+def test_incremental():
+    g = Grammar('''
+        Start = Item [ \\n]*
+        Item  = "[" Num{:","} "]"
+        Num   = [0-9]+
+    ''')
+    text = '[1,2,3]\n[45]\n\n[6,78]\n'
+    for size in (1, 2, 5, len(text)):
+        p = g.incremental()
+        found = []
+        for i in range(0, len(text), size):
+            found.extend((p.offset + m.pos, m.value)
+                         for m in p.feed(text[i:i+size]))
+        found.extend((p.offset + m.pos, m.value) for m in p.close())
+        assert found == [(0, '[1,2,3]\n'), (8, '[45]\n\n'), (14, '[6,78]\n')]
+        assert len(p._buffer) <= len(text) - 14
+    p = g.incremental()
+    assert [m.value for m in p.feed(b'[1][2')] == [b'[1]']
+    try:
+        p.close()
+    except ValueError as ex:
+        assert 'offset 3' in str(ex)
+    else:
+        assert False, 'incomplete input not detected'
+    # short records after a long one are not held back
+    p = Grammar('Start = Rec\nRec = [a-z]+ ";"').incremental()
+    assert p.feed('a' * 100) == []
+    assert [len(m.value) for m in p.feed('a' * 100 + ';')] == [201]
+    for rec in ('b;', 'c;', 'd;'):
+        assert [m.value for m in p.feed(rec)] == [rec]
+    assert p.close() == []
+    # complete records are not scanned before they are matched (probes
+    # count scans and matches, not the trees of partial matches)
+    g = Grammar('Start = Rec\nRec = [a-z]+ ";"')
+    p = g.incremental()
+    with g.profile(nodes=False) as prof:
+        assert [m.value for m in p.feed('ab;cd;e')] == ['ab;', 'cd;']
+    assert prof.rules['Rec'].calls == 1  # telling 'e' is cut off
+
+def test_iter_matches():
+    g = Grammar('''
+        Start = "{" Pair{:","} "}"
+        Pair  = [a-z]+ ":" [0-9]+
+    ''')
+    m = g.memoize()
+    it = g.iter_matches('{a:1}\n{b:2,c:3}\n{d}\n', delimiter=Literal('\n'))
+    assert [m.value for m in it] == ['{a:1}', '{b:2,c:3}']
+    assert it.pos == 16
+    assert len(m) < 10  # cleared for each record
+
+_records = Grammar('''
+    Start = "[" (Num){:","} "]"
+    Num   = [0-9]+
+''', actions={'Num': int})
+
+def test_match_many():
+    docs = ['[1,2]', '[3]', 'x', '[45,6]'] * 5
+    expected = [[1, 2], [3], None, [45, 6]] * 5
+    g = _records
+    assert list(g.match_many(docs, workers=2, chunksize=3)) == expected
+    found = sorted(g.match_many(docs, workers=2, ordered=False))
+    assert found == list(enumerate(expected))
+    ms = list(g.match_many(docs[:3], workers=2, values=False))
+    assert [m and m.span() for m in ms] == [(0, 5), (0, 3), None]
+    g = Grammar('Start = "a"', actions={'Start': lambda x: x})
+    try:
+        g.match_many(['a'])
+    except ValueError:
+        pass
+    else:
+        assert False, 'unpicklable action not detected'
+    found = g.match_many(['[1]'], workers=1, grammar=__name__ + ':_records')
+    assert list(found) == [[1]]
+
+def test_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    g = Grammar('''
+        Start = (Item){:","}
+        Item  = "[" (Start) "]" | (Num) "/" (Num) | (Num)
+        Num   = [0-9]+
+    ''', actions={'Num': int})
+    g.memoize()
+    docs = ['1/2,[3,4/5]', '[[6]],7', '8/', '[' * 30 + '9' + ']' * 30] * 50
+    expected = [g.match(doc).value for doc in docs]
+    with ThreadPoolExecutor(4) as pool:
+        found = list(pool.map(lambda doc: g.match(doc).value, docs))
+    assert found == expected
+    # the first matches compile the grammar once, under a lock
+    from textpy.scanners import Spacing
+    g = Grammar('Start = (Num){:","}\nNum = [0-9]+', skip=Spacing(),
+                tokens=['Num'], actions={'Num': int})
+    compile_, calls = g._compile, []
+    g._compile = lambda: calls.append(1) or compile_()
+    with ThreadPoolExecutor(4) as pool:
+        found = list(pool.map(lambda doc: g.match(doc).value, ['1, 2'] * 8))
+    assert found == [[1, 2]] * 8 and calls == [1]
+
+def test_pickle():
+    import pickle
+    g = Grammar('''
+        Start = "[" (Num){:","} "]"
+        Num   = [0-9]+
+    ''', actions={'Num': int})
+    g.memoize()
+    g.optimize()
+    g2 = pickle.loads(pickle.dumps(g))
+    assert g2.match('[1,23]').value == [1, 23]
+    assert g2._memo is not None and g2._memo is not g._memo
+    g2['Num'] = Literal('x')
+    assert g2.match('[x]').value == ['x']
+    assert g.match('[1]').value == [1]
+
+def test_cache(tmp_path):
+    from textpy.grammars import GrammarCache, PEG
+    definition = '''
+        Start = "(" Start ")" | [a-z]+
+    '''
+    saved = Grammar.cache
+    try:
+        Grammar.cache = GrammarCache(maxsize=1, directory=str(tmp_path))
+        g1 = Grammar(definition)
+        assert len(Grammar.cache) == 1 and len(list(tmp_path.iterdir())) == 1
+        g2 = Grammar(definition)  # a copy of the cached tree
+        assert g2['Start'] is not g1['Start']
+        assert [nt._grammar for _, nt in g2._nonterminals] == [g2._grm]
+        g2.update_actions(Start=str.upper)
+        assert g2.match('((ab))').value == '((AB))'
+        assert g1.match('((ab))').value == '((ab))'
+        Grammar.cache.clear()
+        assert Grammar(definition).match('(x)').value == '(x)'  # from disk
+        PEG('Start <- "a"')
+        assert len(Grammar.cache) == 1  # least recently used is dropped
+        assert len(list(tmp_path.iterdir())) == 2
+        Grammar.cache = None
+        assert Grammar(definition).match('(x)').value == '(x)'
+    finally:
+        Grammar.cache = saved
+
+def test_trace():
+    g = Grammar('''
+        Start = "(" Start ")" | [a-z]
+    ''')
+    g.memoize()
+    t = g.trace('((a))')
+    assert t.starts[0] == 0 and t.ends[0] == 5
+    rules = [(t.starts[i], t.rule(i)) for i in range(len(t)) if t.rule(i)]
+    assert rules == [(1, 'Start'), (2, 'Start')]
+    assert g.trace('((a)') is None
+
+def test_deferred():
+    calls = []
+    def num(x):
+        calls.append(x)
+        return int(x)
+    g = Grammar('''
+        Start = (Item){:","}
+        Item  = (Num) "/" (Num) ";" | (Num) "/" (Num) "!"
+        Num   = [0-9]+
+    ''', actions={'Num': num})
+    assert g.match('1/2!,3/4;').value == [[1, 2], [3, 4]]
+    assert len(calls) == 6
+    del calls[:]
+    assert g.match('1/2!,3/4;', deferred=True).value == [[1, 2], [3, 4]]
+    assert calls == ['1', '2', '3', '4']
+    assert g.match('1/2', deferred=True).value == []
+
+def test_strict():
+    g = Grammar('''
+        Start = Item /\\n/ Item
+        Item  = "(" Num ")" | "(" Num ";" Num ")"
+        Num   = [0-9]+
+    ''')
+    for memoized in (False, True):
+        if memoized:
+            g.memoize()
+        for deferred in (False, True):
+            with pytest.raises(ParseError) as exc:
+                g.match('(1)\n(2;3]', deferred=deferred, strict=True)
+            e = exc.value
+            assert (e.pos, e.lineno, e.colno) == (8, 2, 5)
+            assert e.expected == ('")"', '[0-9]')
+    assert g.match('(1)\n(2;3)', strict=True).end() == 9
+
+def test_skip():
+    import pickle
+    rules = '''
+        Start  = {0} (Value) {0}
+        Value  = Object | Array | (Number) | (Word)
+        Object = "{{"{0} ((Pair) ({0}","{0} (Pair))*)? {0}"}}"
+        Pair   = (Word) {0}":"{0} (Value)
+        Array  = "["{0} ((Value) ({0}","{0} (Value))*)? {0}"]"
+        Number = [0-9]+
+        Word   = [a-z] [a-z]* | "'a b'"
+        WS     = /(?:\\s|#[^\\n]*)*/
+    '''
+    actions = {'Number': int}
+    explicit = Grammar(rules.format(' WS '), actions=actions)
+    g = Grammar(rules.format(''), actions=actions, skip='WS',
+                tokens=['Number', 'Word'])
+    docs = ['{ab: [1, 2], c :{}}', '[ 12 , # note\n 3 ]', "['a b' ,x]"]
+    for doc in docs:
+        assert g.match(doc).value == explicit.match(doc).value
+    assert g.scan('[1 2]') == -1 and g.scan('[ 1 2 ]') == -1
+    assert g.scan('[a b]') == -1  # no skipping inside tokens
+    assert g.scan("['a  b']") == -1  # or literals
+    with pytest.raises(ParseError) as exc:
+        g.match('{ab # ,\n 1}', strict=True)
+    assert exc.value.pos == 9 and exc.value.expected == ('":"',)
+    g.memoize()
+    report = g.optimize()
+    assert [rule for rule, _, _ in report['fused']] == ['Word']
+    for g2 in (g, pickle.loads(pickle.dumps(g))):
+        for doc in docs:
+            assert g2.match(doc).value == explicit.match(doc).value
+
+def test_skip_shared():
+    import gc
+    from textpy.scanners import Group, Integer, Repeat, Spacing
+    shared, spacing = Group(Integer(), action=int), Spacing()
+    g1 = Grammar(skip=spacing)
+    g1['Start'] = Repeat(shared)
+    assert g1.match('1 2 3').value == [1, 2, 3]
+    for skip in (None, Spacing()):  # none, or another skip scanner
+        g2 = Grammar(skip=skip)
+        g2['Start'] = Repeat(shared)
+        with pytest.raises(ValueError):
+            g2.compile()
+    assert g1.match('1 2 3').value == [1, 2, 3]
+    g3 = Grammar(skip=spacing)  # the same skip scanner is fine
+    g3['Start'] = Repeat(shared)
+    assert g3.match('1 2 3').value == [1, 2, 3]
+    del g1, g3
+    gc.collect()
+    g4 = Grammar()
+    g4['Start'] = Repeat(shared)
+    assert g4.match('1 2 3').value == [1]
+
+def test_emit():
+    g = Grammar('''
+        Start = (Row)*
+        Row   = "[" (Item)* "]"
+        Item  = [0-9]
+    ''', actions={'Item': int})
+    s = '[12][3]'
+    out = []
+    g.emit(['Item'], out.append)
+    assert g.match(s).value == [[], []] and out == [1, 2, 3]
+    del out[:]
+    g.emit(['Item'])
+    g.emit(['Row'], out.append)
+    g.memoize()
+    g.optimize()
+    assert g.match(s, deferred=True).value == [] and out == [[1, 2], [3]]
+    g.emit(['Row'])
+    assert g.match(s).value == [[1, 2], [3]]
+
+def test_machine():
+    g = Grammar('''
+        Start = "[" (Start | Num){:","} "]"
+        Num   = [0-9]+
+    ''', actions={'Num': int})
+    m = g.machine()
+    for s in ('[1,[2,3],[]]', '[1,[2', '[]'):
+        assert m.scan(s) == g.scan(s)
+        m1, m2 = m.match(s), g.match(s, deferred=True)
+        assert (m1 and m1.value) == (m2 and m2.value)
+    # nesting is limited by memory, not by the C or Python stack
+    n = 100000
+    s = '[' * n + '1' + ']' * n
+    assert m.scan(s) == len(s)
+    val = m.match(s).value
+    for _ in range(n):
+        val, = val
+    assert val == 1
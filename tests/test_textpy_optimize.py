@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import pytest
+
+from textpy import scanners, optimize
+from textpy.grammars import Grammar
+
+NOMATCH = scanners.NOMATCH
+
+fusion = pytest.mark.skipif(not optimize.CAN_FUSE,
+                            reason='regex fusion requires Python 3.11')
+
+
+def test_children():
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        rep = getattr(scanners, prefix + '_Repeat')
+        lit = getattr(scanners, prefix + '_Literal')
+        a, b = lit('a'), lit('b')
+        p = seq(a, rep(b, delimiter=a))
+        assert optimize.kind(p) == 'Sequence'
+        assert optimize.children(p)[0] is a
+        assert optimize.children(optimize.children(p)[1]) == [b, a]
+        assert optimize.children(a) == []
+        assert optimize.size(p) == 5  # a is used twice
+        assert optimize.rebuild(p, optimize.children(p)) is p
+        q = optimize.rebuild(p, [b, a])
+        assert optimize.kind(q) == 'Sequence' and q.scan('ba') == 2
+
+
+@fusion
+def test_fuse():
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        ch = getattr(scanners, prefix + '_Choice')
+        rep = getattr(scanners, prefix + '_Repeat')
+        opt = getattr(scanners, prefix + '_Optional')
+        grp = getattr(scanners, prefix + '_Group')
+        lit = getattr(scanners, prefix + '_Literal')
+        cc = getattr(scanners, prefix + '_CharacterClass')
+        bs = getattr(scanners, prefix + '_BoundedString')
+        regex = getattr(scanners, prefix + '_Regex')
+        # ordered choice does not backtrack into other alternatives
+        p = seq(ch(lit('a'), lit('ab')), lit('c'))
+        f, fused = optimize.fuse(p)
+        assert len(fused) == 1 and fused[0][0] is p
+        assert isinstance(f, regex)
+        for s in ('ac', 'abc', 'a', ''):
+            assert f.scan(s) == p.scan(s)
+        # repetition is possessive
+        p = seq(rep(cc('a-z'), min=1), lit('z'))
+        f, _ = optimize.fuse(p)
+        assert f.scan('abz') == p.scan('abz') == NOMATCH
+        # delimited repetition leaves a trailing delimiter unconsumed
+        p = rep(cc('a-z'), min=1, max=3, delimiter=lit(','))
+        f, _ = optimize.fuse(p)
+        for s in ('a,b,', 'a,b,c,d', ',', 'a'):
+            assert f.scan(s) == p.scan(s)
+        p = seq(lit('x'), bs('"', '"'))
+        f, _ = optimize.fuse(p)
+        for s in ('x"a\\"b"', 'x"a\\"', 'x"\\"'):
+            assert f.scan(s) == p.scan(s)
+        # capturing and action-bearing subtrees are kept, but regular
+        # parts inside them are fused
+        p = grp(seq(lit('a'), opt(lit('b')), lit('c')))
+        f, fused = optimize.fuse(p)
+        assert len(fused) == 1 and isinstance(f, grp)
+        assert f.match('abc').value == p.match('abc').value == ['abc']
+        p = seq(lit('a'), lit('b'), lit('c'), action=len)
+        assert optimize.fuse(p) == (p, [])
+        # optional values with a custom default are not textual
+        p = opt(seq(lit('a'), lit('b')), default=None)
+        f, fused = optimize.fuse(p)
+        assert f.match('x').value is None
+        # neither are converted numbers
+        num = getattr(scanners, prefix + '_Number')
+        p = ch(lit('a'), num())
+        assert optimize.fuse(p) == (p, [])
+        p = seq(lit('['), num(convert=False), lit(']'))
+        f, fused = optimize.fuse(p)
+        assert len(fused) == 1
+        for s in ('[1]', '[-.5e3]', '[1.]', '[.]', '[1e]'):
+            assert f.scan(s) == p.scan(s)
+
+
+@fusion
+def test_Grammar_optimize():
+    g = Grammar('''
+        Start = (Key) ":" (Val)
+        Key   = [a-z] [a-z0-9]* "-"?
+        Val   = "(" [0-9]+ ")" | [0-9]+
+    ''')
+    s = 'ab1-:(12)'
+    before = g.match(s).value
+    report = g.optimize()
+    assert sorted(rule for rule, _, _ in report['fused']) == ['Key', 'Val']
+    assert g.match(s).value == before == ['ab1-', '(12)']
+
+
+def test_first():
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        ch = getattr(scanners, prefix + '_Choice')
+        opt = getattr(scanners, prefix + '_Optional')
+        lit = getattr(scanners, prefix + '_Literal')
+        cc = getattr(scanners, prefix + '_CharacterClass')
+        nt = getattr(scanners, prefix + '_Nonterminal')
+        dot = getattr(scanners, prefix + '_Dot')
+        assert optimize.first(lit('ab')) == ({'a'}, False)
+        assert optimize.first(lit('')) == (set(), True)
+        assert optimize.first(cc('abc')) == ({'a', 'b', 'c'}, False)
+        assert optimize.first(seq(opt(lit('-')), cc('0-1'))) == (
+            {'-', '0', '1'}, False
+        )
+        assert optimize.first(ch(lit('a'), opt(lit('b')))) == (
+            {'a', 'b'}, True
+        )
+        assert optimize.first(seq(dot(), lit('a'))) == (None, False)
+        grm = {}
+        grm['A'] = ch(seq(lit('('), nt(grm, 'A'), lit(')')), lit('a'))
+        assert optimize.first(nt(grm, 'A')) == ({'(', 'a'}, False)
+        grm['B'] = seq(nt(grm, 'B'), lit('b'))  # left-recursive
+        assert optimize.first(nt(grm, 'B')) == (None, False)
+
+
+def test_dispatch():
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        ch = getattr(scanners, prefix + '_Choice')
+        opt = getattr(scanners, prefix + '_Optional')
+        grp = getattr(scanners, prefix + '_Group')
+        lit = getattr(scanners, prefix + '_Literal')
+        regex = getattr(scanners, prefix + '_Regex')
+        integer = getattr(scanners, prefix + '_Integer')
+        a, ab, r = lit('a'), seq(lit('a'), lit('b')), regex('[ab]c')
+        num = grp(integer(), action=int)
+        p = ch(a, ab, r, num)
+        _, choices = optimize.dispatch(seq(p, lit('!')))
+        assert choices == [p]
+        assert p._dispatch['a'] == (a, ab, r)
+        assert p._dispatch['1'] == (r, num)
+        assert p._default == (r,)
+        assert p.scan('ab') == 1  # first alternative still wins
+        assert p.scan('bc') == 2
+        assert p.match('-1').value == -1
+        assert p.scan('') == NOMATCH
+        p.dispatch(None)
+        assert p._dispatch is None and p._default == p._scanners
+        # nullable alternatives are always tried
+        p = ch(lit('a'), opt(lit('b')), lit('c'))
+        optimize.dispatch(p)
+        assert p._dispatch['c'] == p._scanners[1:]
+        assert p._default == p._scanners[1:2]
+        assert p.scan('c') == 0
+        assert p.scan('') == 0
+
+
+def test_rewrite():
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        ch = getattr(scanners, prefix + '_Choice')
+        opt = getattr(scanners, prefix + '_Optional')
+        grp = getattr(scanners, prefix + '_Group')
+        la = getattr(scanners, prefix + '_Lookahead')
+        lit = getattr(scanners, prefix + '_Literal')
+        cc = getattr(scanners, prefix + '_CharacterClass')
+        nt = getattr(scanners, prefix + '_Nonterminal')
+        sp = getattr(scanners, prefix + '_Spacing')
+        # flatten and merge
+        p = seq(lit('a'), seq(lit('b'), grp(cc('cd'))), grp(lit('e')))
+        q, rewrites = optimize.rewrite(p)
+        assert rewrites == [('flatten', '"b" ([cd])'), ('merge', '"a" "b"')]
+        assert [optimize.kind(x) for x in q._scanners] == [
+            'Literal', 'Group', 'Group'
+        ]
+        assert q._scanners[0]._x == 'ab'
+        assert q.match('abce').value == p.match('abce').value == ['c', 'e']
+        assert optimize.rewrite(seq(lit('a')))[0]._x == 'a'
+        assert optimize.rewrite(grp(lit('a')))[1] == []  # value is used
+        # factor
+        p = ch(seq(lit('{'), sp(), grp(cc('a-z')), lit('}')),
+               seq(lit('{'), sp(), grp(cc('0-9')), lit('}')),
+               seq(lit('{'), lit('}')))
+        q, rewrites = optimize.rewrite(p)
+        assert [name for name, _ in rewrites] == ['merge', 'flatten', 'factor']
+        assert len(q._scanners) == 2 and q._scanners[1]._x == '{}'
+        factored = q._scanners[0]
+        assert [optimize.kind(x) for x in factored._scanners] == [
+            'Literal', 'Spacing', 'Choice'
+        ]
+        for s in ('{ a}', '{1}', '{}', '{ }', '{a', ''):
+            assert q.scan(s) == p.scan(s)
+            if p.scan(s) >= 0:
+                assert q.match(s).value == p.match(s).value
+        # prune and ungroup
+        p = ch(lit('a'), opt(lit('b')), seq(la(grp(lit('c'))), lit('c')))
+        q, rewrites = optimize.rewrite(p)
+        assert [name for name, _ in rewrites] == ['ungroup', 'prune']
+        assert len(q._scanners) == 2 and q.scan('c') == p.scan('c') == 0
+        # inline
+        grm = {}
+        grm['A'] = seq(lit('a'), cc('bc'))
+        grm['B'] = seq(lit('x'), nt(grm, 'A'), nt(grm, 'A', action=len))
+        q, rewrites = optimize.rewrite(grm['B'], {'A': grm['A']})
+        assert rewrites == [('inline', 'A')]
+        assert q._scanners[1] is grm['A']  # not flattened
+        assert q.match('xabac').value == grm['B'].match('xabac').value
+
+
+def test_Grammar_rewrite():
+    import pickle
+    definition = '''
+        Start = (Item){:Comma}
+        Item  = "{" Sp (Key) Sp "}" | "{" Sp (Num) Sp "}" | "[" Sp (Num) "]"
+        Key   = [a-z]+
+        Num   = [0-9]+
+        Comma = Sp "," Sp
+        Sp    = [ ]*
+    '''
+    g = Grammar(definition, actions={'Num': int})
+    plain = Grammar(definition, actions={'Num': int})
+    report = g.optimize()
+    assert sorted(report['nodes']) == sorted(g._grm)
+    assert report['nodes']['Item'][0] == 21
+    rewrites = set(name for rule, name, _ in report['rewritten']
+                   if rule == 'Item')
+    assert rewrites == {'inline', 'factor'}
+    assert g._inlined == {'Key', 'Comma', 'Sp'}
+    docs = ['{ab}, { 1 },[2]', '{a} ,[ 1]', '{1', '{}']
+    for g2 in (g, pickle.loads(pickle.dumps(g))):
+        for s in docs:
+            assert g2.scan(s) == plain.scan(s)
+            if plain.scan(s) >= 0:
+                assert g2.match(s).value == plain.match(s).value
+    assert list(g.match_many(docs[:2], workers=2)) == [
+        plain.match(s).value for s in docs[:2]
+    ]
+    with pytest.raises(ValueError):
+        g.emit(['Key'], print)
+    with pytest.raises(ValueError):
+        g['Sp'] = scanners.Literal(' ')
+    g['Num'] = scanners.Literal('x')  # not inlined
+    assert g.scan('{x}') == 3
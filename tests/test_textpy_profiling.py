@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import json
+
+from textpy import scanners, profiling
+from textpy.grammars import Grammar
+
+
+def test_Probe():
+    for prefix in ('c', 'py'):
+        probe = getattr(scanners, prefix + '_Probe')
+        seq = getattr(scanners, prefix + '_Sequence')
+        grp = getattr(scanners, prefix + '_Group')
+        lit = getattr(scanners, prefix + '_Literal')
+        a = probe(lit('a'), 'a')
+        p = probe(seq(a, grp(lit('b'))))
+        assert p.capturing
+        assert p.match('ab').value == ['b']
+        g = probe(grp(lit('bc'), action=str.upper))
+        assert g.action is not None  # so a Sequence appends its value
+        assert probe(seq(lit('a'), g)).match('abc').value == ['BC']
+        rep = getattr(scanners, prefix + '_Repeat')(g, min=1)
+        assert rep.match('bcbc').value == ['BC', 'BC']  # not spliced
+        assert rep.match('bcbc', deferred=True).value == ['BC', 'BC']
+        assert p.scan('ab') == 2 and p.scan('b') == scanners.NOMATCH
+        assert (a.calls, a.successes, a.failures) == (3, 2, 1)
+        assert a.consumed == 2
+        assert a.retries == 1  # 'ab' is the same string both times
+        p.scan('xab', 1)
+        assert a.retries == 1
+        assert 0 <= p.self_time <= p.time and a.time <= p.time
+        p.reset()
+        assert p.calls == 0 and p.time == 0.0
+
+
+def test_instrument():
+    for prefix in ('c', 'py'):
+        ch = getattr(scanners, prefix + '_Choice')
+        lit = getattr(scanners, prefix + '_Literal')
+        x, y = lit('x'), lit('y')
+        c = ch(x, y)
+        c.dispatch({'x': (x,), 'y': (y,)}, ())
+        p, probes = profiling.instrument(c, 'C')
+        assert [path for path, _ in probes] == ['C.0', 'C.1', 'C']
+        assert p.scan('y') == 1 and p.scan('z') == scanners.NOMATCH
+        calls = dict((path, probe.calls) for path, probe in probes)
+        assert calls == {'C.0': 0, 'C.1': 1, 'C': 2}  # dispatched
+
+
+def test_profile():
+    g = Grammar('''
+        Start = "[" (Item){:","} "]"
+        Item  = Num | Word
+        Num   = [0-9]+
+        Word  = [a-z]+
+    ''', actions={'Num': int})
+    s = '[1,ab,23]'
+    with g.profile() as prof:
+        assert g.match(s).value == [1, 'ab', 23]
+    assert g.match(s).value == [1, 'ab', 23]  # restored
+    assert type(g['Start']) is not type(prof.rules['Start'])
+    num, word = prof.rules['Num'], prof.rules['Word']
+    assert (num.calls, num.successes, num.failures) == (3, 2, 1)
+    assert (word.calls, word.consumed) == (1, 2)
+    paths = [path for _, path, _ in prof.nodes]
+    assert 'Start.1' in paths and 'Start' not in paths
+    d = json.loads(prof.to_json())
+    assert d['rules']['Item']['calls'] == 3
+    assert {'rule', 'path', 'scanner', 'time'} <= set(d['nodes'][0])
+    table = prof.table(nodes=True).splitlines()
+    assert table[0].split()[:3] == ['name', 'calls', 'successes']
+    assert len(table) == 1 + len(prof.rules) + len(prof.nodes)
+    with g.profile(nodes=False) as prof:
+        g.scan(s)
+    assert prof.nodes == [] and prof.rules['Item'].calls == 3
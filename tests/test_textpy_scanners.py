@@ -1,6 +1,9 @@
-
 #!/usr/bin/env python3
 
+import sys
+
+import pytest
+
 from textpy import scanners
 
 NOMATCH = scanners.NOMATCH
@@ -28,6 +31,31 @@ def test_CharacterClass():
         assert cc('a-z1-').scan('1') == 1
         assert cc('a-z1-').scan('2') == NOMATCH
         assert cc('a-z1-').scan('A') == NOMATCH
+        assert cc('a-c').scan('-') == NOMATCH
+        assert cc('a-c').scan('c') == 1
+        assert cc('^a-c').scan('d') == 1
+        assert cc('^a-c').scan('b') == NOMATCH
+        assert cc('^').scan('^') == 1
+        assert cc('a^').scan('^') == 1
+        assert cc('^^').scan('^') == NOMATCH
+        assert cc('\\]').scan(']') == 1
+        assert cc('a\\-c').scan('-') == 1
+        assert cc('a\\-c').scan('b') == NOMATCH
+        assert cc('\\n\\t').scan('\n') == 1
+        assert cc('\\n\\t').scan('\t') == 1
+        assert cc('\\n\\t').scan('n') == NOMATCH
+        assert cc('\\\\').scan('\\') == 1
+        assert cc('α-ω').scan('λ') == 1
+        assert cc('α-ω').scan('a') == NOMATCH
+        assert cc('a-zα-ω').scan('Ω') == NOMATCH
+        assert cc('^α-ω').scan('Ω') == 1
+        assert cc('^α-ω').scan('λ') == NOMATCH
+        assert cc('\x00-\U0010ffff').scan('\U0001f600') == 1
+        assert cc('a-c')._ranges == [('a', 'c')]
+        assert cc('c-ea-d')._ranges == [('a', 'e')]
+        assert cc('^a')._negated
+        with pytest.raises(ValueError):
+            cc('z-a')
 
 def test_Repeat():
     for prefix in ('c', 'py'):
@@ -57,9 +85,25 @@ def test_BoundedString():
         assert p.scan('"one" two') == 5
         assert p.scan('one "two"', pos=4) == 9
         assert p.scan('"one\\"two"') == 10
+        assert p.scan('"one') == NOMATCH
+        assert p.scan('"one\\') == NOMATCH
+        assert p.scan('"one\\"') == NOMATCH
         p = bs('"""', '"""')
         assert p.scan('"""one"""') == 9
         assert p.scan('"""a""b"c"""') == 12
+        assert bs('<', '\\>').scan('<a\\\\>\\>') == 7
+        long = '"' + 'a\\"' * 3000 + '"'  # past where the GIL is released
+        assert bs('"', '"').scan(long + '"') == len(long)
+        p = bs('"', '"', decode=True)
+        s = r'"a\"b\\\/\n\u00e9\ud83d\ude00\ud83d\q\u12"'
+        value = 'a"b\\/\n\u00e9\U0001f600\ud83d\\q\\u12'
+        assert p.match(s).value == value
+        assert p.match(s, deferred=True).value == value
+        assert p.match(s, trace=True).value == s
+        assert p.match('"x"').value == 'x'
+        assert p.match('"\u00e9\\t"'.encode('utf-8')).value == b'\xc3\xa9\t'
+        assert p.match(memoryview(b'"\\u00e9"')).value == b'\xc3\xa9'
+        assert bs("'", "'", action=len, decode=True).match("'\\n'").value == 1
 
 def test_Sequence():
     for prefix in ('c', 'py'):
@@ -96,6 +140,13 @@ def test_Choice():
         assert p.scan('abc') == 1
         assert p.scan('abc', pos=1) == 2
         assert p.scan('abc', pos=2) == NOMATCH
+        # failing at the end of input falls through to later alternatives
+        dot = getattr(scanners, prefix + '_Dot')
+        integer = getattr(scanners, prefix + '_Integer')
+        p = ch(dot(), integer(), lit(''))
+        assert p.scan('') == 0
+        assert p.match('').value == ''
+        assert p.match('a', pos=1).value == ''
 
 def test_Integer():
     for prefix in ('c', 'py'):
@@ -109,6 +160,14 @@ def test_Integer():
         assert integer.scan('+0') == 2
         assert integer.scan('-') == NOMATCH
         assert integer.scan('+') == NOMATCH
+        assert integer.match('012').value == '012'
+        integer = getattr(scanners, prefix + '_Integer')(convert=True)
+        assert integer.match('012').value == 12
+        assert integer.match(b'-3x').value == -3
+        big = '-' + '9' * 30
+        assert integer.match(memoryview(big.encode())).value == int(big)
+        assert integer.match('7', deferred=True).value == 7
+        assert integer.match('7', trace=True).value == '7'
 
 def test_Float():
     for prefix in ('c', 'py'):
@@ -139,6 +198,26 @@ def test_Float():
         assert float.scan('-.e1') == NOMATCH
         assert float.scan('1e') == NOMATCH
         assert float.scan('1e1') == 3
+        float = getattr(scanners, prefix + '_Float')(convert=True)
+        assert float.match('-1.5e2').value == -150.0
+        assert float.match(bytearray(b'.25')).value == 0.25
+        assert float.match('1e999').value == 1e999
+
+def test_Number():
+    for prefix in ('c', 'py'):
+        number = getattr(scanners, prefix + '_Number')()
+        assert number.scan('') == NOMATCH
+        assert number.scan('-') == NOMATCH
+        assert number.scan('1.e') == 2
+        assert number.scan('12x') == 2
+        values = [number.match(s).value for s in ('12', '-0', '1.', '2e3')]
+        assert values == [12, 0, 1.0, 2000.0]
+        assert [type(v) for v in values] == [int, int, float, float]
+        assert number.match(b'-4.5').value == -4.5
+        assert number.scan('12', partial=True) == scanners.EOS
+        number = getattr(scanners, prefix + '_Number')(action=str,
+                                                        convert=False)
+        assert number.match('01.50').value == '01.50'
 
 def test_Regex():
     for prefix in ('c', 'py'):
@@ -198,6 +277,80 @@ def test_Optional():
         assert opt(grp(a), default=None).match('b').value == None
 
 
+def test_Nonterminal():
+    for prefix in ('c', 'py'):
+        nt = getattr(scanners, prefix + '_Nonterminal')
+        lit = getattr(scanners, prefix + '_Literal')
+        grm = {}
+        a = nt(grm, 'A')
+        try:
+            a.link()
+        except ValueError:
+            pass
+        else:
+            assert False, 'undefined rule not detected'
+        grm['A'] = lit('a')
+        assert a.scan('a') == 1
+        a.link()
+        grm['A'] = lit('b')
+        assert a.scan('a') == 1  # still bound to the old rule
+        a.unlink()
+        assert a.scan('a') == NOMATCH
+        assert a.scan('b') == 1
+
+def test_Memo():
+    for prefix in ('c', 'py'):
+        memo = getattr(scanners, prefix + '_Memo')
+        nt = getattr(scanners, prefix + '_Nonterminal')
+        ch = getattr(scanners, prefix + '_Choice')
+        seq = getattr(scanners, prefix + '_Sequence')
+        lit = getattr(scanners, prefix + '_Literal')
+        rep = getattr(scanners, prefix + '_Repeat')
+        grm = {'A': rep(lit('a'), min=1)}
+        m = memo()
+        a = nt(grm, 'A', memo=m)
+        p = ch(seq(a, lit('x')), seq(a, lit('y')))
+        assert p.scan('aaay') == 4
+        assert (m.hits, m.misses) == (1, 1)
+        assert p.match('aaay').value == 'aaay'
+        assert p.match('aaay').value == 'aaay'
+        assert p.scan('aaaz') == NOMATCH
+        assert p.scan('aaaz', pos=1) == NOMATCH
+        assert len(m) == 2  # ('A', 0) and ('A', 1)
+        m.clear()
+        assert len(m) == 0
+        # bounded window
+        m = memo(window=2)
+        p = rep(seq(nt(grm, 'A', memo=m), lit(',')))
+        assert p.scan('a,' * 20) == 40
+        assert m.misses == 21
+        assert len(m) <= 4
+        # deferred matches copy the nodes of a memoized rule on a hit
+        grp = getattr(scanners, prefix + '_Group')
+
+        def parser(m):
+            grm = {}
+            b = nt(grm, 'B', memo=m)
+            grm['A'] = ch(seq(b, lit('x')), seq(grp(b), lit('y')))
+            grm['B'] = ch(seq(lit('('), grp(nt(grm, 'A', memo=m)),
+                              lit(')')),
+                          grp(lit('z'), action=len))
+            return nt(grm, 'A', memo=m)
+
+        s = '((zy)y)y'
+        expected = parser(None).trace(s)
+        t = parser(memo()).trace(s)
+        for a in ('starts', 'ends', 'parents', 'nexts'):
+            assert list(getattr(t, a)) == list(getattr(expected, a))
+        assert [str(t.scanner(i)) for i in range(len(t))] == [
+            str(expected.scanner(i)) for i in range(len(expected))
+        ]
+        m = memo()
+        s = '(' * 50 + 'z' + 'y)' * 50 + 'y'  # 2**50 steps unmemoized
+        assert parser(m).match(s, deferred=True).value == \
+            parser(memo()).match(s).value
+        assert m.misses == 102 and m.hits == 51
+
 
 # def test_sequence():
 #     assert s.sequence(s.Integer)('a') is None
@@ -248,3 +401,396 @@ def test_Optional():
 #     assert zom(s.literal('a'))('b').span() == (0, 0)
 #     assert zom(s.literal('a'))('a').span() == (0, 1)
 #     assert zom(s.literal('a'))('aaa').span() == (0, 3)
+
+def test_bytes():
+    import mmap
+    import tempfile
+    for prefix in ('c', 'py'):
+        seq = getattr(scanners, prefix + '_Sequence')
+        grp = getattr(scanners, prefix + '_Group')
+        lit = getattr(scanners, prefix + '_Literal')
+        cc = getattr(scanners, prefix + '_CharacterClass')
+        regex = getattr(scanners, prefix + '_Regex')
+        spacing = getattr(scanners, prefix + '_Spacing')
+        integer = getattr(scanners, prefix + '_Integer')
+        bs = getattr(scanners, prefix + '_BoundedString')
+        p = seq(
+            grp(regex(rb'[a-z]+')), spacing(),
+            grp(integer()), spacing(b' '),
+            grp(bs(b'"', '"')), lit(b'!'), grp(cc('^a-z')),
+            grp(regex(r'.'))
+        )
+        s = b'abc 12 "x\\"y"!\xe9\xe9'
+        m = p.match(s)
+        assert m.string is s
+        assert m.value == [b'abc', b'12', b'"x\\"y"', b'\xe9', b'\xe9']
+        assert m.group() == s
+        assert lit('\xe9').scan(b'\xe9') == 1
+        assert lit(b'ab').scan('ab') == 2
+        assert regex(rb'a+').scan('aab') == 2
+        # bytes are matched with ASCII semantics
+        assert regex(r'\w').scan('\xe9') == 1
+        assert regex(r'\w').scan(b'\xe9') == NOMATCH
+        assert regex(rb'\w').scan('\xe9') == NOMATCH
+        for buf in (bytearray(s), memoryview(s)):
+            m = p.match(buf)
+            assert m.string is buf
+            assert isinstance(m.value[0], memoryview)  # zero-copy
+            assert [bytes(v) for v in m.value] == [
+                b'abc', b'12', b'"x\\"y"', b'\xe9', b'\xe9'
+            ]
+        with tempfile.TemporaryFile() as f:
+            f.write(s)
+            f.flush()
+            mm = mmap.mmap(f.fileno(), 0)
+            assert p.scan(mm) == len(s)
+            mm.close()
+    # the py_ scanners decode buffers to Latin-1, one character a byte
+    utf8 = '\xe9'.encode('utf-8')
+    assert scanners._input(bytearray(utf8)) == '\xc3\xa9'
+    assert scanners.py_Dot().scan(utf8) == 1
+    assert scanners.py_Literal('\xe9').scan(utf8) == NOMATCH
+    assert scanners.py_Literal('\xc3\xa9').scan(utf8) == 2
+    m = scanners.py_Group(scanners.py_CharacterClass('\xc3')).match(utf8)
+    assert m.value == [b'\xc3']
+
+@pytest.mark.skipif(sys.maxsize < 2**32, reason='needs 64-bit positions')
+def test_large_input():
+    import mmap
+    # an anonymous map reads as zeros without committing memory; only
+    # the C scanners read large buffers without copying them
+    get = lambda name: getattr(scanners, 'c_' + name)
+    size = 2**31 + 10
+    mm = mmap.mmap(-1, size + 6)
+    mm[0:1] = b'"'
+    mm[size - 1:] = b'"1234,x'
+    num = get('Group')(get('Integer')(convert=True))
+    p = get('Sequence')(get('BoundedString')(b'"', b'"'), num)
+    m = p.match(mm)
+    assert m.span() == (0, size + 4) and m.value == [1234]
+    assert p.scan(mm, partial=True) == size + 4
+    m = get('Repeat')(num, delimiter=get('Literal')(b',')).match(mm, size)
+    assert m.span() == (size, size + 4) and m.start() > 2**31
+    with pytest.raises(scanners.ParseError) as exc:
+        get('Sequence')(p, get('Literal')(b';')).match(mm, strict=True)
+    assert exc.value.pos == size + 4 and exc.value.colno == size + 5
+    mm.close()
+
+def test_partial():
+    EOS = scanners.EOS
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, integer, flt = get('Literal'), get('Integer'), get('Float')
+        bs, seq, ch, rep = (
+            get('BoundedString'), get('Sequence'), get('Choice'), get('Repeat')
+        )
+        assert get('Dot')().scan('', partial=True) == EOS
+        assert get('CharacterClass')('a').scan('', partial=True) == EOS
+        assert lit('abc').scan('ab', partial=True) == EOS
+        assert lit('abc').scan('ax', partial=True) == NOMATCH
+        assert lit('abc').scan('abcd', partial=True) == 3
+        assert integer().scan('12', partial=True) == EOS
+        assert integer().scan('12', partial=False) == 2
+        assert integer().scan('12,', partial=True) == 2
+        assert flt().scan('1', partial=True) == EOS
+        assert flt().scan('1.5e', partial=True) == EOS
+        assert flt().scan('1.5e,', partial=True) == 3
+        assert bs('"', '"').scan('"a\\', partial=True) == EOS
+        assert bs('"', '"').scan('"a"', partial=True) == 3
+        assert get('Spacing')().scan('  ', partial=True) == EOS
+        assert get('Regex')('[a-z]+').scan('ab', partial=True) == EOS
+        assert seq(lit('a'), lit('b')).scan('a', partial=True) == EOS
+        assert seq(lit('a'), lit('b')).scan('b', partial=True) == NOMATCH
+        assert ch(lit('ab'), lit('a')).scan('a', partial=True) == EOS
+        assert ch(lit('b'), lit('a')).scan('a', partial=True) == 1
+        assert rep(lit('ab')).scan('aba', partial=True) == EOS
+        assert rep(lit('ab'), max=1).scan('aba', partial=True) == 2
+        assert get('Optional')(lit('ab')).scan('a', partial=True) == EOS
+        assert get('NegativeLookahead')(lit('x')).scan('', partial=True) == EOS
+        assert get('Lookahead')(lit('x')).scan('y', partial=True) == NOMATCH
+        # a partial match fails wherever a partial scan returns EOS
+        grp = get('Group')
+        for p, s in ((ch(grp(lit('ab')), grp(lit('a'))), 'a'),
+                     (rep(grp(lit('ab'))), 'aba'),
+                     (get('Optional')(grp(lit('ab'))), 'a'),
+                     (seq(grp(integer()), lit(';')), '12')):
+            assert p.match(s, partial=True) is None
+            m = p.match(s + ';', partial=True)
+            assert (m.span(), m.value) == (
+                (0, p.scan(s + ';')), p.match(s + ';').value)
+
+def test_iter_matches():
+    for prefix in ('c', 'py'):
+        rep = getattr(scanners, prefix + '_Repeat')
+        cc = getattr(scanners, prefix + '_CharacterClass')
+        lit = getattr(scanners, prefix + '_Literal')
+        word = rep(cc('a-z'), min=1)
+        it = word.iter_matches('ab\ncd\nx1\ny', delimiter=lit('\n'))
+        assert [m.value for m in it] == ['ab', 'cd', 'x']
+        assert it.pos == 7
+        it = word.iter_matches('ab\ncd\n', delimiter=lit('\n'))
+        assert [m.span() for m in it] == [(0, 2), (3, 5)]
+        assert it.pos == 6
+        it = word.iter_matches('abc', pos=1)
+        assert [m.value for m in it] == ['bc'] and it.pos == 3
+        it = word.iter_matches('')
+        assert list(it) == [] and it.pos == 0
+        it = rep(cc('a-z')).iter_matches('ab1')  # stops at empty matches
+        assert [m.value for m in it] == ['ab'] and it.pos == 2
+
+def test_pickle():
+    import pickle
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, cc = get('Literal'), get('CharacterClass')
+        grm = {}
+        a = get('Nonterminal')(grm, 'A', memo=get('Memo')())
+        grm['A'] = get('Choice')(
+            get('Sequence')(lit('('), a, lit(')')),
+            get('Group')(get('Repeat')(cc('a-zé'), min=1, delimiter=lit(','))),
+            get('Optional')(get('Regex')('[0-9]+'), action=int),
+            action=str
+        )
+        a.link()
+        grm['A'].dispatch({'(': grm['A']._scanners[:1]}, grm['A']._scanners[1:])
+        a2 = pickle.loads(pickle.dumps(a))
+        grm2 = a2._grammar
+        assert grm2 is not grm and grm2['A'] is a2._scanner
+        assert grm2['A']._dispatch['('] == grm2['A']._scanners[:1]
+        assert a2.memo is not None
+        for s in ('((a,é))', '12', ''):
+            assert a2.scan(s) == a.scan(s)
+            assert a2.match(s).value == a.match(s).value
+        m = pickle.loads(pickle.dumps(a.match('(b)')))
+        assert m.string == '(b)' and m.span() == (0, 3) and m.value == '(b)'
+        for x in (get('Dot')(), get('Spacing')(' '), get('Integer')(),
+                  get('Float')(convert=True), get('Number')(convert=False),
+                  get('BoundedString')('"', '"', decode=True),
+                  get('Lookahead')(lit('"')),
+                  get('NegativeLookahead')(lit('"'))):
+            y = pickle.loads(pickle.dumps(x))
+            assert type(y) is type(x) and repr(y) == repr(x)
+            assert y.scan(' "1.5" ') == x.scan(' "1.5" ')
+
+def test_trace():
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, cc = get('Literal'), get('CharacterClass')
+        num = get('Group')(get('Repeat')(cc('0-9'), min=1))
+        p = get('Sequence')(
+            lit('['),
+            get('Repeat')(num, max=2, delimiter=lit(',')),
+            get('Optional')(lit(',')),
+            lit(']')
+        )
+        assert p.trace('[1,22,3]') is None
+        t = p.trace('[1,22,]')
+        assert len(t) == len(t.starts) == len(t.ids) == 14
+        assert t.children(0) == [1, 2, 11, 13]
+        assert [t.scanner(i) for i in t.children(0)] == list(p._scanners)
+        assert [t.ends[i] for i in t.children(2)] == [2, 3, 5]  # 1 , 22
+        assert t.parent(2) == 0 and t.first_child(1) == -1
+        assert t.next_sibling(13) == -1
+        assert t.match(11).span() == (5, 6) and t.match(11).value == ','
+        assert t.rule(0) is None
+        events = list(t.walk())
+        assert events[:3] == [(0, True), (1, True), (1, False)]
+        assert events[-1] == (0, False) and len(events) == 28
+        cur = scanners.TreeCursor(t)
+        assert cur.goto_first_child() and cur.goto_next_sibling()
+        assert cur.text == '1,22' and cur.goto_first_child()
+        assert cur.text == '1' and cur.rule is None
+        while cur.goto_parent():
+            pass
+        assert cur.node == 0 and not cur.goto_next_sibling()
+        t = p.trace(b'[5]')
+        assert t.match().value == b'[5]'
+
+def test_deferred():
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, cc, grp = get('Literal'), get('CharacterClass'), get('Group')
+        calls = []
+        def num(x):
+            calls.append(x)
+            return int(x)
+        n = grp(get('Repeat')(cc('0-9'), min=1), action=num)
+        item = get('Choice')(
+            get('Sequence')(n, lit('/'), n, lit(';')),
+            get('Sequence')(n, lit('/'), n, action=tuple),
+            get('Bounded')(lit('<'), grp(n), lit('>')),
+            action=list
+        )
+        p = get('Repeat')(item, delimiter=grp(lit(',')))
+        s = '1/2,3/4;,<5>,x'
+        expected = p.match(s)
+        assert len(calls) == 7  # 1 and 2 were converted twice
+        del calls[:]
+        m = p.match(s, deferred=True)
+        assert m.span() == expected.span() == (0, 12)
+        assert m.value == expected.value == [[1, 2], ',', [3, 4], ',', [5]]
+        assert calls == ['1', '2', '3', '4', '5']
+        assert p.match('x', deferred=True).value == []
+        assert get('Optional')(n).match('x', deferred=True).value == []
+        # a delimiter is only kept when an item follows it
+        r = get('Repeat')(grp(cc('a')), max=2, delimiter=grp(lit(',')))
+        for deferred in (False, True):
+            assert r.match('a,a,a', deferred=deferred).value == ['a', ',', 'a']
+            assert r.match('a,b', deferred=deferred).value == ['a']
+
+def test_strict():
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, integer = get('Literal'), get('Integer')
+        p = get('Sequence')(
+            lit('('),
+            get('Repeat')(integer(), delimiter=lit(',')),
+            get('Choice')(lit(')'), lit(']'))
+        )
+        assert p.match('(1,2)', strict=True).end() == 5
+        assert p.match('(1,2', strict=False) is None
+        with pytest.raises(scanners.ParseError) as exc:
+            p.match('(1,2;', strict=True)
+        e = exc.value
+        assert (e.pos, e.lineno, e.colno) == (4, 1, 5)
+        assert e.expected == ('")"', '","', '"]"')
+        assert str(e) == ('No match at line 1, column 5 (offset 4); '
+                          'expected ")", ",", "]"')
+        with pytest.raises(scanners.ParseError) as exc:
+            get('Sequence')(lit('a\n'), lit('b')).match('a\nc', strict=True)
+        assert (exc.value.lineno, exc.value.colno) == (2, 1)
+        # the farthest failure wins even if a shorter alternative fails
+        with pytest.raises(scanners.ParseError) as exc:
+            p.match(b'(1,x)', strict=True)
+        assert exc.value.pos == 3 and exc.value.expected == ('Integer',)
+        # failures under a negative lookahead are not expected terminals
+        q = get('Sequence')(get('NegativeLookahead')(lit('a')), get('Dot')())
+        with pytest.raises(scanners.ParseError) as exc:
+            q.match('ab', strict=True)
+        assert exc.value.pos == 0 and exc.value.expected == ('!"a"',)
+        with pytest.raises(ValueError):
+            q.match('', pos=0, deferred=True, strict=True)
+
+def test_skip():
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, bs = get('Literal'), get('BoundedString')
+        ws = get('Regex')(r'(?:\s|#[^\n]*)*')
+        p = get('Sequence')(lit('a b'), get('Group')(bs('"', '"')),
+                            get('Repeat')(get('Integer')(), min=1,
+                                          delimiter=lit(',')))
+        assert p.scan(' a b" x "1,2') == NOMATCH
+        for sub in (p._scanners[0], p._scanners[1]._scanner,
+                    p._scanners[2]._scanner, p._scanners[2]._delimiter):
+            sub.skip = ws
+        m = p.match(' a b # c\n " x " 1 ,2  ')
+        assert m.end() == 20  # trailing trivia is left alone
+        assert m.value == ['" x "']
+        tree = p.trace(' a b # c\n " x " 1 ,2  ')
+        group = tree.children(0)[1]
+        assert tree.starts[tree.first_child(group)] == 10  # after trivia
+        assert p.scan(' a  b " x " 1') == NOMATCH  # literals are not split
+        assert p.scan(' a b', partial=True) == scanners.EOS
+        with pytest.raises(scanners.ParseError) as exc:
+            p.match('a b "x" # ,\n ;', strict=True)
+        assert exc.value.pos == 13 and exc.value.expected == ('Integer',)
+
+def test_sink():
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, grp = get('Literal'), get('Group')
+        num = grp(get('Integer')(), action=int)
+        out = []
+        p = get('Repeat')(num, delimiter=grp(lit(',')), sink=out.append)
+        for deferred in (False, True):
+            m = p.match('1,2,3;', deferred=deferred)
+            assert m.span() == (0, 5) and m.value == ()
+            assert out == [1, ',', 2, ',', 3]
+            del out[:]
+        assert len(p.trace('1,2').children(0)) == 3 and out == []
+        # a sink inside a sequence adds nothing to the sequence's value
+        seq = get('Sequence')(lit('('), p, grp(lit(')')))
+        assert seq.match('(4,5)').value == [')'] and out == [4, ',', 5]
+        # generator consumers receive values through send()
+        def total(sums):
+            n = 0
+            while True:
+                n += yield
+                sums.append(n)
+        sums = []
+        gen = total(sums)
+        next(gen)
+        q = get('Repeat')(get('Sequence')(num, lit(';')), sink=gen.send)
+        assert q.match('1;2;3;').value == () and sums == [1, 3, 6]
+        # groups emit what they would add to their parent's values
+        del out[:]
+        g = get('Sequence')(grp(lit('a'), sink=out.append),
+                            grp(lit('b'), action=str.upper, sink=out.append),
+                            grp(lit('c')))
+        for deferred in (False, True):
+            assert g.match('abc', deferred=deferred).value == ['c']
+            assert out == ['a', 'B']
+            del out[:]
+        # emitted values are not emitted again by outer sinks
+        r = get('Repeat')(grp(num, sink=out.append), sink=sums.append)
+        del sums[:]
+        assert r.match('12').value == () and out == [12] and sums == []
+
+def test_Machine():
+    from textpy import vm
+    def traced(m):
+        # the spans and values of a match(trace=True) result
+        if m is None or not isinstance(m.value, list):
+            return m and (m.span(), m.value)
+        return (m.span(), [traced(x) for x in m.value])
+    for prefix in ('c', 'py'):
+        get = lambda name: getattr(scanners, prefix + '_' + name)
+        lit, cc, grp = get('Literal'), get('CharacterClass'), get('Group')
+        num = grp(get('Repeat')(cc('0-9'), min=1), action=int)
+        item = get('Choice')(grp(num), grp(lit('x')), get('Sequence')(
+            lit('('), get('NegativeLookahead')(lit(')')), cc('a-z'),
+            get('Optional')(lit('!')), lit(')')))
+        p = get('Repeat')(item, delimiter=lit(','), min=1, max=3)
+        m = vm.compile(p)
+        assert isinstance(m, get('Machine'))
+        assert 'SPAN' in vm.disassemble(m)
+        for s in ('12,x,(a!)', '1,(b),x,2', '(a', '()', '7,', ''):
+            assert m.scan(s) == p.scan(s)
+            assert m.scan(s, partial=True) == p.scan(s, partial=True)
+            m1, m2 = m.match(s), p.match(s, deferred=True)
+            assert (m1 and (m1.span(), m1.value)) == \
+                (m2 and (m2.span(), m2.value))
+            assert traced(m.match(s, trace=True)) == \
+                traced(p.match(s, trace=True))
+            t1, t2 = m.trace(s), p.trace(s)
+            assert (t1 is None) == (t2 is None)
+            if t1 is not None:
+                assert list(t1.starts) == list(t2.starts)
+                assert list(t1.ends) == list(t2.ends)
+                assert [t1.scanner(i) for i in range(len(t1))] == \
+                    [t2.scanner(i) for i in range(len(t2))]
+            errors = []
+            for q in (m, p):
+                try:
+                    errors.append(q.match(s, strict=True).span())
+                except scanners.ParseError as exc:
+                    errors.append((exc.pos, exc.expected))
+            assert errors[0] == errors[1]
+        # traced matches are built without nested calls too
+        rules = {}
+        value = get('Nonterminal')(rules, 'Value')
+        array = get('Nonterminal')(rules, 'Array')
+        rules['Value'] = get('Choice')(array, lit('1'))
+        rules['Array'] = get('Sequence')(
+            lit('['), get('Repeat')(grp(value), delimiter=lit(',')),
+            lit(']'))
+        value.link()
+        array.link()
+        n = 20000
+        m = vm.compile(value).match('[' * n + '1' + ']' * n, trace=True)
+        for _ in range(n):
+            # Value > Choice > Array > Sequence > Repeat > Group > Value
+            m = m.value[0].value[0].value[0]
+            assert m.value[0].span() == (m.pos, m.pos + 1)
+            m = m.value[1].value[0].value[0]
+        assert m.span() == (n, n + 1) and m.value[0].value[0].value == '1'
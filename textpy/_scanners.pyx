@@ -1,36 +1,86 @@
 
+# cython: freethreading_compatible=True
+
+cimport cython
+
 import re
+import threading
+from array import array as _array
 from functools import partial
+from time import perf_counter
+
+from textpy.exceptions import _parse_error
+
+from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
+from cpython.unicode cimport PyUnicode_READ, PyUnicode_KIND, PyUnicode_DATA
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE
+from cpython cimport array
+from cpython.ref cimport PyObject
+from libc.string cimport memchr, memcmp
+
+cdef extern from "Python.h":
+    # the same as PyUnicode_READ, declared so the kernels can use it
+    # without the GIL
+    Py_UCS4 _read "PyUnicode_READ" (int kind, void *data,
+                                    Py_ssize_t index) nogil
+    double PyOS_string_to_double(const char *s, char **endptr,
+                                 PyObject *overflow_exception) except? -1.0
+    object PyLong_FromString(const char *s, char **pend, int base)
+    object PyUnicode_FromKindAndData(int kind, const void *buffer,
+                                     Py_ssize_t size)
+    object PyBytes_FromStringAndSize(const char *v, Py_ssize_t size)
 
 cpdef enum:
     NOMATCH = -1
     EOS = -2
 
+cdef enum:
+    ERROR = -3  # signals that an exception was raised while scanning
+    MAX_EXPECTED = 32  # terminals recorded at the farthest failure
+    # characters a kernel reads before releasing the GIL, as releasing
+    # it costs more than most scans
+    NOGIL_SCAN = 4096
+    NUMBER_BUFFER = 64  # numbers longer than this are copied to the heap
+
 cpdef enum:
     NORMAL = 0
     CAPTURE = 1
     TRACE = 2
 
 
+cdef struct Text:
+    # The characters of an input (or of a pattern) as read by the
+    # scanning kernels, which run without the GIL. *reached_end* is set
+    # when a kernel needed to look past the end.
+    int kind
+    void *data
+    Py_ssize_t length
+    bint reached_end
+
+
 cdef class Match(object):
-    cdef readonly unicode string
-    cdef readonly int pos, endpos
+    cdef readonly object string
+    cdef readonly Py_ssize_t pos, endpos
     cdef readonly object value
 
-    def __init__(self, unicode s, int pos, int endpos, object value=None):
+    def __init__(self, object s, Py_ssize_t pos, Py_ssize_t endpos,
+                 object value=None):
         self.string = s
         self.pos = pos
         self.endpos = endpos
         self.value = value
         # self.lastindex = sum(n.lastindex for n in ast)
 
-    cpdef int start(self, group=0):
+    def __reduce__(self):
+        return (type(self), (self.string, self.pos, self.endpos, self.value))
+
+    cpdef Py_ssize_t start(self, group=0):
         if group == 0:
             return self.pos
         else:
             return self._groups[group].start()
 
-    cpdef int end(self, group=0):
+    cpdef Py_ssize_t end(self, group=0):
         if group == 0:
             return self.endpos
         else:
@@ -42,7 +92,7 @@ cdef class Match(object):
         else:
             return self._groups[group].span()
 
-    cpdef unicode group(self, group=0):
+    cpdef object group(self, group=0):
         if group == 0:
             start, end = self.pos, self.endpos
         else:
@@ -50,197 +100,809 @@ cdef class Match(object):
         return self.string[start:end]
 
 
+@cython.freelist(8)
+cdef class Input(object):
+    # The string or byte buffer being scanned. Characters are read
+    # directly from *data* with PyUnicode_READ; byte buffers use kind 1
+    # so each byte is read as the code point of the same value.
+    cdef readonly object source
+    cdef object text  # str, bytes, or a memoryview of bytes
+    cdef bint is_text
+    cdef int kind
+    cdef void *data
+    cdef Py_ssize_t length
+    # if *partial*, more input may follow and terminals that reach the
+    # end return EOS
+    cdef bint partial
+    # the farthest offset where a terminal failed and (up to
+    # MAX_EXPECTED of) the terminals that failed there, for error
+    # messages; the scanners are borrowed references, valid while the
+    # scan runs, and failures are not recorded while *quiet* is nonzero
+    # (e.g., under a negative lookahead)
+    cdef Py_ssize_t farthest
+    cdef PyObject *expected[MAX_EXPECTED]
+    cdef int nexpected
+    cdef int quiet
+    # the last Memo used on this input and its table for this thread
+    cdef object memo
+    cdef object memo_table
+    cdef Py_buffer _view
+    cdef bint _has_view
+
+    def __cinit__(self, object source, bint partial=False):
+        self.source = source
+        self.partial = partial
+        self.farthest = -1
+        if isinstance(source, unicode):
+            self.text = source
+            self.is_text = True
+            self.kind = PyUnicode_KIND(source)
+            self.data = PyUnicode_DATA(source)
+            self.length = len(<unicode>source)
+        else:
+            text = source
+            if not isinstance(source, bytes):
+                text = memoryview(source)
+                if text.ndim != 1 or text.format != 'B':
+                    text = text.cast('B')
+            PyObject_GetBuffer(text, &self._view, PyBUF_SIMPLE)
+            self._has_view = True
+            self.text = text
+            self.is_text = False
+            self.kind = 1
+            self.data = self._view.buf
+            self.length = self._view.len
+
+    def __dealloc__(self):
+        if self._has_view:
+            PyBuffer_Release(&self._view)
+
+    cdef inline object slice(self, Py_ssize_t start, Py_ssize_t end):
+        if self.is_text:
+            return (<unicode>self.text)[start:end]
+        return self.text[start:end]
+
+    cdef inline Text view(self) noexcept:
+        cdef Text t
+        t.kind = self.kind
+        t.data = self.data
+        t.length = self.length
+        t.reached_end = False
+        return t
+
+
+cdef class _TreeEntry(object):
+    # a memoized rule in a Tree: where it ends and the *count* nodes of
+    # its body, at index *base* of the tree or, once dropped from it,
+    # at index *offset* of the *saved* arrays
+    cdef Py_ssize_t end, base, count, offset
+    cdef tuple saved
+
+
+cdef class Tree(object):
+    """
+    Compact parse tree built by Scanner.trace().
+
+    Nodes are numbered in pre-order (the root is node 0) and stored in
+    parallel arrays of 64-bit integers: *starts* and *ends* are the
+    span of each node, *parents* and *nexts* are the indices of the
+    parent and next sibling (or -1), and *ids* index *scanners*, the
+    list of the scanners that made the nodes. The first child of node
+    i, if any, is node i + 1. Match objects are only made on request.
+    """
+    cdef readonly object string
+    cdef readonly array.array starts, ends, parents, nexts, ids
+    cdef readonly list scanners
+    cdef dict _ids
+    cdef Py_ssize_t _n, _cap, _parent  # the arrays have _cap items
+    cdef list _memos  # memo entries whose nodes are in the tree
+
+    def __init__(self, object string):
+        self.string = string
+        self.starts = _array('q')
+        self.ends = _array('q')
+        self.parents = _array('q')
+        self.nexts = _array('q')
+        self.ids = _array('q')
+        self.scanners = []
+        self._ids = {}
+        self._n = self._cap = 0
+        self._parent = -1
+        self._memos = []
+
+    def __len__(self):
+        return self._n
+
+    def parent(self, Py_ssize_t i):
+        """Return the index of the parent of node *i*, or -1."""
+        return self.parents[i]
+
+    def first_child(self, Py_ssize_t i):
+        """Return the index of the first child of node *i*, or -1."""
+        if i + 1 < self._n and self.parents[i + 1] == i:
+            return i + 1
+        return -1
+
+    def next_sibling(self, Py_ssize_t i):
+        """Return the index of the next sibling of node *i*, or -1."""
+        return self.nexts[i]
+
+    def children(self, Py_ssize_t i):
+        """Return the list of the indices of the children of node *i*."""
+        cdef list kids = []
+        cdef Py_ssize_t j = self.first_child(i)
+        while j != -1:
+            kids.append(j)
+            j = self.nexts.data.as_longlongs[j]
+        return kids
+
+    def scanner(self, Py_ssize_t i):
+        """Return the scanner that made node *i*."""
+        return self.scanners[self.ids[i]]
+
+    def rule(self, Py_ssize_t i):
+        """Return the rule name if node *i* is a nonterminal, or None."""
+        return getattr(self.scanner(i), '_name', None)
+
+    def match(self, Py_ssize_t i=0):
+        """Return a Match for node *i* with its text as the value."""
+        start, end = self.starts[i], self.ends[i]
+        return Match(self.string, start, end, self.string[start:end])
+
+    def evaluate(self, Py_ssize_t i=0):
+        """
+        Return the value that match() gives node *i*, running the
+        actions of the nodes whose values are used exactly once.
+        """
+        return _evaluate(self, i)
+
+    def walk(self):
+        """
+        Iterate over `(i, entering)` pairs, depth-first: each node is
+        yielded with `True` before its children and with `False` after.
+        """
+        cdef list stack = []
+        cdef Py_ssize_t i
+        for i in range(self._n):
+            while stack and stack[-1] != self.parents[i]:
+                yield stack.pop(), False
+            yield i, True
+            stack.append(i)
+        while stack:
+            yield stack.pop(), False
+
+    cdef inline Py_ssize_t _first(self, Py_ssize_t i):
+        if i + 1 < self._n and self.parents.data.as_longlongs[i + 1] == i:
+            return i + 1
+        return -1
+
+    cdef inline Py_ssize_t _next(self, Py_ssize_t i):
+        return self.nexts.data.as_longlongs[i]
+
+    cdef inline object _scanner(self, Py_ssize_t i):
+        return self.scanners[self.ids.data.as_longlongs[i]]
+
+    cdef Py_ssize_t _open(self, Scanner scanner, Py_ssize_t pos) except -1:
+        cdef Py_ssize_t i = self._n
+        sid = self._ids.get(scanner)  # scanners hash by identity
+        if sid is None:
+            sid = self._ids[scanner] = len(self.scanners)
+            self.scanners.append(scanner)
+        if i == self._cap:
+            self._resize(2 * i + 16)
+        self.starts.data.as_longlongs[i] = pos
+        self.ends.data.as_longlongs[i] = -1
+        self.parents.data.as_longlongs[i] = self._parent
+        self.nexts.data.as_longlongs[i] = -1
+        self.ids.data.as_longlongs[i] = sid
+        self._n = i + 1
+        self._parent = i
+        return i
+
+    cdef inline void _close(self, Py_ssize_t i, Py_ssize_t end):
+        self.ends.data.as_longlongs[i] = end
+        self._parent = self.parents.data.as_longlongs[i]
+
+    cdef int _leaf(self, Scanner scanner, Py_ssize_t pos,
+                   Py_ssize_t end) except -1:
+        self._close(self._open(scanner, pos), end)
+        return 0
+
+    cdef int _truncate(self, Py_ssize_t n) except -1:
+        # drop the nodes from index n on (made by a failed attempt)
+        if self._memos:
+            self._save(n)
+        if n < self._n:
+            self._n = n
+        return 0
+
+    cdef int _save(self, Py_ssize_t n) except -1:
+        # copy out the nodes of memo entries from index n on; the
+        # entries are in the order they were made, so an entry's inner
+        # entries come after it when popped and share its copy
+        cdef list memos = self._memos
+        cdef _TreeEntry e, outer = None
+        cdef Py_ssize_t j
+        while memos and (<_TreeEntry>memos[-1]).base >= n:
+            e = memos.pop()
+            if outer is not None and e.base >= outer.base:
+                e.saved = outer.saved
+                e.offset = outer.offset + e.base - outer.base
+            else:
+                j = e.base + e.count
+                e.saved = (self.starts[e.base:j], self.ends[e.base:j],
+                           self.parents[e.base:j], self.ids[e.base:j])
+                e.offset = 0
+                outer = e
+        return 0
+
+    cdef int _copy(self, _TreeEntry e) except -1:
+        # add the nodes of memo entry e under the open node
+        cdef array.array starts, ends, parents, ids
+        cdef Py_ssize_t a, k, i = self._n, shift = self._n - e.base
+        if e.saved is None:
+            a = e.base
+        else:
+            a = e.offset
+        while self._n + e.count > self._cap:
+            self._resize(2 * self._cap + 16)
+        if e.saved is None:
+            starts, ends, parents, ids = (self.starts, self.ends,
+                                          self.parents, self.ids)
+        else:
+            starts, ends, parents, ids = e.saved
+        for k in range(e.count):
+            self.starts.data.as_longlongs[i + k] = \
+                starts.data.as_longlongs[a + k]
+            self.ends.data.as_longlongs[i + k] = ends.data.as_longlongs[a + k]
+            self.parents.data.as_longlongs[i + k] = \
+                parents.data.as_longlongs[a + k] + shift
+            self.nexts.data.as_longlongs[i + k] = -1
+            self.ids.data.as_longlongs[i + k] = ids.data.as_longlongs[a + k]
+        self._n = i + e.count
+        return 0
+
+    cdef int _resize(self, Py_ssize_t n) except -1:
+        for a in (self.starts, self.ends, self.parents, self.nexts, self.ids):
+            array.resize(a, n)
+        self._cap = n
+        return 0
+
+    cdef int _discard(self, Py_ssize_t i) except -1:
+        self._parent = self.parents.data.as_longlongs[i]
+        return self._truncate(i)
+
+    cdef int _finish(self) except -1:
+        # link siblings; the last child seen of each node is kept in
+        # *last* (indexed by parent, or n for the roots)
+        cdef Py_ssize_t i, p, n = self._n
+        cdef array.array last = array.clone(self.starts, n + 1, False)
+        self._resize(n)
+        for i in range(n + 1):
+            last.data.as_longlongs[i] = -1
+        for i in range(n):
+            p = self.parents.data.as_longlongs[i]
+            if p < 0:
+                p = n
+            if last.data.as_longlongs[p] >= 0:
+                self.nexts.data.as_longlongs[last.data.as_longlongs[p]] = i
+            last.data.as_longlongs[p] = i
+        return 0
+
+
 cdef class Scanner(object):
     cdef public bint capturing
     cdef public object action
+    cdef public Scanner skip  # trivia skipped first (see Grammar)
 
     def __init__(self, object action=None):
         self.action = action
 
-    cpdef int scan(self, unicode s, int pos=0) except EOS:
+    # Scanners are pickled as their constructor arguments (derived
+    # tables are rebuilt) with the action as the state.
+    def __reduce__(self):
+        return (type(self), (), self.action)
+
+    def __setstate__(self, state):
+        self.action = state
+
+    cpdef Py_ssize_t scan(self, object s, Py_ssize_t pos=0,
+                          bint partial=False) except ERROR:
         try:
-            return self._scan(s, pos)
+            return self._scan(Input(s, partial), pos)
         except IndexError:
             return NOMATCH
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         return NOMATCH
 
-    cdef Match _match(self, unicode s, int pos, int mode):
-        cdef int end
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
+        cdef Py_ssize_t end
         cdef object action = self.action
         try:
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
             end = self._scan(s, pos)
             if end == NOMATCH:
                 return None
             else:
                 if mode == TRACE or action is None:
-                    return Match(s, pos, end, s[pos:end])
+                    return Match(s.source, pos, end, s.slice(pos, end))
                 else:
-                    return Match(s, pos, end, action(s[pos:end]))
+                    return Match(s.source, pos, end, action(s.slice(pos, end)))
+        except IndexError:
+            return None
+
+    cpdef match(self, object s, Py_ssize_t pos=0, bint trace=False,
+                bint deferred=False, bint strict=False, bint partial=False):
+        cdef Input inp = Input(s, partial)
+        cdef Match m
+        cdef Tree t
+        if deferred or partial:
+            # recognize first, then run actions on the kept nodes only
+            t = self._trace(inp, pos)
+            m = None
+            if t is not None:
+                m = Match(s, pos, t.ends[0], _evaluate(t, 0))
+        else:
+            m = self._match(inp, pos, TRACE if trace else NORMAL)
+        if m is None and strict:
+            raise _failure(inp, pos)
+        return m
+
+    def trace(self, object s, Py_ssize_t pos=0):
+        """
+        Return a Tree of the nodes matched in *s* at *pos*, or `None`
+        if there is no match. Unlike `match(s, trace=True)`, no Match
+        objects are made for the nodes.
+        """
+        return self._trace(Input(s), pos)
+
+    cdef Tree _trace(self, Input s, Py_ssize_t pos):
+        cdef Tree t = Tree(s.source)
+        cdef Py_ssize_t end
+        try:
+            end = self._tree(s, pos, t)
         except IndexError:
+            end = NOMATCH
+        if end < 0:
             return None
+        t._finish()
+        return t
+
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        # add the node(s) matched at pos to t; composite scanners open a
+        # node, add their children, and close or discard it
+        cdef Py_ssize_t end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = self._scan(s, pos)
+        if end >= 0:
+            t._leaf(self, pos, end)
+        return end
 
-    cpdef match(self, unicode s, int pos=0, bint trace=False):
-        return self._match(s, pos, TRACE if trace else NORMAL)
+    cdef bint _uses(self, Tree t, Py_ssize_t i, Py_ssize_t j):
+        # whether the value of node i needs that of its child node j
+        return True
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        # the value of node i from the values of its children, as in
+        # _match() with the NORMAL mode
+        cdef object val = s.slice(t.starts.data.as_longlongs[i],
+                                  t.ends.data.as_longlongs[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    def iter_matches(self, object s, Py_ssize_t pos=0, Scanner delimiter=None):
+        """
+        Return an iterator yielding successive matches of the scanner
+        in *s*, separated by *delimiter* if given, starting at *pos*.
+        """
+        return MatchIterator(self, Input(s), pos, delimiter)
+
+
+
+cdef class MatchIterator(object):
+    """
+    Iterator over successive matches of a scanner (see
+    Scanner.iter_matches()). Iteration stops at the end of the input or
+    where the scanner or delimiter fails; *pos* is then the offset
+    where it stopped. If *memo* is set, it is cleared before each match.
+    """
+    cdef Scanner _scanner, _delimiter
+    cdef Input _input
+    cdef readonly Py_ssize_t pos
+    cdef public Memo memo
+    cdef bint _started, _done
+
+    def __cinit__(self, Scanner scanner, Input s, Py_ssize_t pos,
+                  Scanner delimiter=None):
+        self._scanner = scanner
+        self._delimiter = delimiter
+        self._input = s
+        self.pos = pos
+
+    def __iter__(self):
+        return self
 
+    def __next__(self):
+        cdef Py_ssize_t start = self.pos, pos = self.pos
+        cdef Match m
+        if self._done:
+            raise StopIteration
+        if self._started and self._delimiter is not None:
+            pos = self._delimiter._scan(self._input, pos)
+        if pos >= 0 and pos < self._input.length:
+            if self.memo is not None:
+                self.memo.clear()
+            m = self._scanner._match(self._input, pos, NORMAL)
+            if m is not None and m.endpos > start:
+                self._started = True
+                self.pos = m.endpos
+                return m
+            self.pos = pos
+        elif pos >= 0:
+            self.pos = pos
+        self._done = True
+        raise StopIteration
 
 
 cdef class Dot(Scanner):
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        s[pos]  # check for IndexError
+    def __repr__(self): return 'Dot()'
+    def __str__(self): return '.'
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if pos >= s.length:
+            return _at_end(s, self, pos)
         return pos + 1
 
 
 cdef class CharacterClass(Scanner):
-    cdef list _ranges
-    cdef unicode _chars
-    def __init__(self, unicode clsstr, object action=None):
+    cdef readonly unicode _clsstr
+    cdef readonly bint _negated
+    cdef readonly list _ranges
+    # membership of Latin-1 characters (already negated if needed)
+    cdef unsigned char _latin1[256]
+    # sorted, disjoint ranges of characters beyond Latin-1
+    cdef Py_UCS4 *_starts
+    cdef Py_UCS4 *_ends
+    cdef Py_ssize_t _nranges
+
+    def __init__(self, object clsstr, object action=None):
+        cdef Py_ssize_t i, n = 0
+        cdef Py_UCS4 c
         self.action = action
-        cdef list ranges = [], chars = []
-        cdef int i = 0, n = len(clsstr)
-        while i < n-2:
-            if clsstr[i+1] == u'-':
-                ranges.append((clsstr[i], clsstr[i+2]))
-            else:
-                chars.append(clsstr[i])
-            i += 1
-        # remaining character(s) cannot be ranges
-        while i < n:
-            chars.append(clsstr[i])
-            i += 1
-        self._chars = ''.join(chars)
-        self._ranges = ranges
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef Py_UCS4 a, b, c
-        c = s[pos]
-        if c in self._chars:
+        self._clsstr = clsstr = _as_text(clsstr)
+        self._negated, ranges = _parse_class(clsstr)
+        self._ranges = [(chr(a), chr(b)) for a, b in ranges]
+        for c in range(256):
+            self._latin1[c] = self._negated
+        for a, b in ranges:
+            for c in range(a, min(b, 255) + 1):
+                self._latin1[c] = not self._negated
+            if b > 255:
+                n += 1
+        PyMem_Free(self._starts)
+        PyMem_Free(self._ends)
+        self._starts = <Py_UCS4 *>PyMem_Malloc(n * sizeof(Py_UCS4) + 1)
+        self._ends = <Py_UCS4 *>PyMem_Malloc(n * sizeof(Py_UCS4) + 1)
+        if self._starts is NULL or self._ends is NULL:
+            raise MemoryError()
+        self._nranges = n
+        i = 0
+        for a, b in ranges:
+            if b > 255:
+                self._starts[i] = max(a, 256)
+                self._ends[i] = b
+                i += 1
+
+    def __dealloc__(self):
+        PyMem_Free(self._starts)
+        PyMem_Free(self._ends)
+
+    def __repr__(self): return 'CharacterClass({})'.format(repr(self._clsstr))
+    def __str__(self): return '[{}]'.format(self._clsstr)
+    def __reduce__(self): return (type(self), (self._clsstr,), self.action)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if pos >= s.length:
+            return _at_end(s, self, pos)
+        if self._contains(PyUnicode_READ(s.kind, s.data, pos)):
             return pos + 1
-        for a, b in self._ranges:
-            if a <= c <= b:
-                return pos + 1
-        return NOMATCH
+        return _fail(s, self, pos)
+
+    cdef bint _contains(self, Py_UCS4 c) noexcept nogil:
+        cdef Py_ssize_t lo = 0, hi = self._nranges, mid
+        if c < 256:
+            return self._latin1[c]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if c < self._starts[mid]:
+                hi = mid
+            elif c > self._ends[mid]:
+                lo = mid + 1
+            else:
+                return not self._negated
+        return self._negated
 
 
 cdef class Literal(Scanner):
-    cdef unicode _x
-    cdef int _xlen
-    def __init__(self, unicode x, object action=None):
+    cdef readonly unicode _x
+    cdef Py_ssize_t _xlen
+    cdef Text _text
+    def __init__(self, object x, object action=None):
         self.action = action
-        self._x = x
-        self._xlen = len(x)
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef int end = pos + self._xlen
-        if s[pos:end] != self._x:
-            return NOMATCH
+        self._x = _as_text(x)
+        self._xlen = len(self._x)
+        self._text = _text(self._x)
+    def __repr__(self): return 'Literal({})'.format(repr(self._x))
+    def __str__(self): return '"{}"'.format(self._x)
+    def __reduce__(self): return (type(self), (self._x,), self.action)
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Py_ssize_t end
+        cdef Text t = s.view()
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = pos + self._xlen
+        if end > s.length:
+            if s.partial and _startswith(&t, &self._text, pos, s.length):
+                return EOS
+            return _fail(s, self, pos)
+        if not _startswith(&t, &self._text, pos, end):
+            return _fail(s, self, pos)
         return end
 
 
 cdef class Regex(Scanner):
-    cdef object _regex
+    cdef readonly object regex
+    cdef bint _text
+    cdef object _retyped  # regex for input of the other type
     def __init__(self, object pattern, object action=None):
         self.action = action
         if hasattr(pattern, 'match'):
-            self._regex = pattern
+            self.regex = pattern
         else:
-            self._regex = re.compile(pattern)
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        m = self._regex.match(s, pos=pos)
+            self.regex = re.compile(pattern)
+        self._text = isinstance(self.regex.pattern, unicode)
+        self._retyped = None
+    def __repr__(self): return 'Regex({})'.format(repr(self.regex.pattern))
+    def __str__(self): return '/{}/'.format(self.regex.pattern)
+    def __reduce__(self): return (type(self), (self.regex,), self.action)
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef object regex = self.regex
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if s.is_text != self._text:
+            with cython.critical_section(self):  # threads may share it
+                if self._retyped is None:
+                    self._retyped = _retype_regex(regex, s.is_text)
+                regex = self._retyped
+        m = regex.match(s.text, pos)
+        if s.partial and (m.end() if m is not None else pos) >= s.length:
+            return EOS
         if m is None:
-            return NOMATCH
+            return _fail(s, self, pos)
         else:
             return m.end()
 
 
 cdef class Spacing(Scanner):
-    cdef unicode _ws
-    def __init__(self, unicode ws=u' \n\t\r\f\v', object action=None):
+    cdef readonly unicode _ws
+    cdef Text _text
+    def __init__(self, object ws=u' \t\n\r\f\v', object action=None):
         self.action = action
-        self._ws = ws
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef unicode ws = self._ws
-        try:
-            while s[pos] in ws:
-                pos += 1
-        except IndexError:
-            pass
+        self._ws = _as_text(ws)
+        self._text = _text(self._ws)
+    def __repr__(self):
+        return 'Spacing({})'.format(
+            repr(self._ws) if self._ws != u' \t\n\r\f\v' else ''
+        )
+    def __str__(self): return '[{}]*'.format(repr(self._ws)[1:-1])
+    def __reduce__(self): return (type(self), (self._ws,), self.action)
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Text t = s.view()
+        cdef Py_ssize_t end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = _scan_spacing(&t, pos, &self._text, pos + NOGIL_SCAN)
+        if end == pos + NOGIL_SCAN:
+            with nogil:
+                end = _scan_spacing(&t, end, &self._text, t.length)
+        pos = end
+        if pos == s.length and s.partial:
+            return EOS
         return pos
 
 
-cdef class Integer(Scanner):
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        # [-+]? \d+
-        cdef int numdigits
-        if s[pos] in u'-+':
-            pos += 1
-        numdigits = _scan_digits(s, pos)
-        if numdigits == 0:
-            return NOMATCH
-        return pos + numdigits
+cdef class _Numeric(Scanner):
+    # With *convert*, the value of a match is the number itself, read
+    # from the input without making a substring first.
+    cdef readonly bint convert
+    cdef int _real  # 1 for float values, 0 for int, -1 for either
 
+    def __init__(self, object action=None, bint convert=False):
+        self.action = action
+        self.convert = convert
+    def __repr__(self):
+        if self.convert:
+            return '{}(convert=True)'.format(self)
+        return '{}()'.format(self)
+    def __reduce__(self):
+        return (type(self), (None, self.convert), self.action)
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
+        cdef Py_ssize_t end
+        cdef object val
+        if not self.convert or mode == TRACE:
+            return Scanner._match(self, s, pos, mode)
+        try:
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
+            end = self._scan(s, pos)
+        except IndexError:
+            return None
+        if end == NOMATCH:
+            return None
+        val = _number_value(s, pos, end, self._real)
+        if self.action is not None:
+            val = self.action(val)
+        return Match(s.source, pos, end, val)
 
-cdef class Float(Scanner):
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        # one of:
-        #   [-+]? \d+\.\d* ([eE][-+]?\d+)?
-        #   [-+]? \.\d+ ([eE][-+]?\d+)?
-        #   [-+]? \d+ [eE][-+]?\d+
-        # note that bare integers (e.g. 1, -1, etc.) are not accepted
-        cdef Py_UCS4 c
-        cdef int dpos
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val
+        if not self.convert:
+            return Scanner._value(self, s, t, i, values)
+        val = _number_value(s, t.starts.data.as_longlongs[i],
+                            t.ends.data.as_longlongs[i], self._real)
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+
+cdef class Integer(_Numeric):
+    def __str__(self): return 'Integer'
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Text t = s.view()
+        cdef Py_ssize_t end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = _scan_integer(&t, pos)
+        return _number_end(s, self, pos, end, t.reached_end)
 
-        if s[pos] in u'-+':  # [-+]?
-            pos += 1
 
-        if s[pos] == u'.':  # \.\d+ ([eE][-+]?\d+)?
-            dpos = _scan_digits(s, pos+1)
-            if dpos == 0:
-                return NOMATCH
-            pos += dpos + 1
-            pos += _scan_exponent(s, pos)
+cdef class Float(_Numeric):
+    def __cinit__(self):
+        self._real = 1
+    def __str__(self): return 'Float'
 
-        else:  # other two patterns begin with \d+
-            dpos = _scan_digits(s, pos)
-            if dpos == 0:
-                return NOMATCH
-            pos += dpos
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Text t = s.view()
+        cdef Py_ssize_t end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = _scan_float(&t, pos)
+        return _number_end(s, self, pos, end, t.reached_end)
 
-            if s[pos] == u'.':  # \d+\.\d* ([eE][-+]?\d+)?
-                pos += 1
-                pos += _scan_digits(s, pos)
-                pos += _scan_exponent(s, pos)
 
-            else:  # \d+ [eE][-+]?\d+
-                dpos = _scan_exponent(s, pos)
-                if dpos == 0:
-                    return NOMATCH
-                pos += dpos
-        return pos
+cdef class Number(_Numeric):
+    # a Float or else an Integer, converted to a float or an int
+    def __cinit__(self):
+        self._real = -1
+    def __init__(self, object action=None, bint convert=True):
+        self.action = action
+        self.convert = convert
+    def __repr__(self):
+        if not self.convert:
+            return 'Number(convert=False)'
+        return 'Number()'
+    def __str__(self): return 'Number'
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Text t = s.view()
+        cdef Py_ssize_t end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = _scan_float(&t, pos)
+        if end == NOMATCH:
+            end = _scan_integer(&t, pos)
+        return _number_end(s, self, pos, end, t.reached_end)
 
 
 cdef class BoundedString(Scanner):
-    cdef unicode first, last
-    def __init__(self, unicode first, unicode last, object action=None):
+    # With *decode*, the value of a match is the string between the
+    # delimiters with JSON-style escapes decoded.
+    cdef readonly unicode first, last
+    cdef readonly bint decode
+    cdef Text _first, _last
+    def __init__(self, object first, object last, object action=None,
+                 bint decode=False):
         self.action = action
-        self.first = first
-        self.last = last
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef unicode c, a = self.first, b = self.last
-        cdef int alen = len(a), blen = len(b)
-        if s[pos:pos+alen] != a:
-            return NOMATCH
-        pos += alen
-        while s[pos:pos+blen] != b:
-            if s[pos] == u'\\':
-                s[pos+1]  # check for IndexError
-                pos += 2
-            else:
-                pos += 1
-        return pos + blen
+        self.first = _as_text(first)
+        self.last = _as_text(last)
+        self.decode = decode
+        self._first = _text(self.first)
+        self._last = _text(self.last)
+    def __repr__(self):
+        if self.decode:
+            return 'BoundedString("{}", "{}", decode=True)'.format(
+                self.first, self.last
+            )
+        return 'BoundedString("{}", "{}")'.format(self.first, self.last)
+    def __str__(self): return 'BoundedString'
+    def __reduce__(self):
+        return (type(self), (self.first, self.last, None, self.decode),
+                self.action)
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
+        cdef Py_ssize_t end
+        cdef object val
+        if not self.decode or mode == TRACE:
+            return Scanner._match(self, s, pos, mode)
+        try:
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
+            end = self._scan(s, pos)
+        except IndexError:
+            return None
+        if end == NOMATCH:
+            return None
+        val = _unescape(s, pos + self._first.length, end - self._last.length)
+        if self.action is not None:
+            val = self.action(val)
+        return Match(s.source, pos, end, val)
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val
+        if not self.decode:
+            return Scanner._value(self, s, t, i, values)
+        val = _unescape(s, t.starts.data.as_longlongs[i] + self._first.length,
+                        t.ends.data.as_longlongs[i] - self._last.length)
+        if self.action is not None:
+            val = self.action(val)
+        return val
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Text t = s.view()
+        cdef Py_ssize_t n = s.length, alen = self._first.length
+        cdef Py_ssize_t end, i
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        i = pos + alen
+        if pos + alen > n:
+            if s.partial and _startswith(&t, &self._first, pos, n):
+                return EOS
+            return _fail(s, self, pos)
+        if not _startswith(&t, &self._first, pos, pos + alen):
+            return _fail(s, self, pos)
+        end = _scan_bounded(&t, &i, &self._last, i + NOGIL_SCAN)
+        if end == NOMATCH and i <= n - self._last.length:
+            with nogil:
+                end = _scan_bounded(&t, &i, &self._last, n)
+        if end == NOMATCH:
+            return _at_end(s, self, pos)
+        return end
 
 
 cdef class Bounded(Scanner):
-    cdef Scanner _lhs, _body, _rhs
+    cdef readonly Scanner _lhs, _body, _rhs
 
     def __init__(self, Scanner lhs, Scanner body, Scanner rhs,
                  object action=None):
@@ -249,8 +911,16 @@ cdef class Bounded(Scanner):
         self._body = body
         self._rhs = rhs
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef int end
+    def __repr__(self):
+        return 'Bounded({}, {}, {})'.format(
+            repr(self._lhs), repr(self._body), repr(self._rhs)
+        )
+    def __str__(self): return 'Bounded'
+    def __reduce__(self):
+        return (type(self), (self._lhs, self._body, self._rhs), self.action)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Py_ssize_t end
         end = self._lhs._scan(s, pos)
         if end >= 0:
             end = self._body._scan(s, end)
@@ -258,10 +928,32 @@ cdef class Bounded(Scanner):
                 end = self._rhs._scan(s, end)
         return end
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Py_ssize_t i = t._open(self, pos)
+        cdef Py_ssize_t end = self._lhs._tree(s, pos, t)
+        if end >= 0:
+            end = self._body._tree(s, end, t)
+            if end >= 0:
+                end = self._rhs._tree(s, end, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    cdef bint _uses(self, Tree t, Py_ssize_t i, Py_ssize_t j):
+        return j != i + 1 and t._next(j) != -1  # only the body
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = values[t._next(i + 1)]
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef object action = self.action
         cdef Match m
-        cdef int end = self._lhs._scan(s, pos)
+        cdef Py_ssize_t end = self._lhs._scan(s, pos)
         if end == NOMATCH:
             return None
         m = self._body._match(s, end, mode)
@@ -271,7 +963,7 @@ cdef class Bounded(Scanner):
         if end == NOMATCH:
             return None
         if mode == TRACE:
-            m = Match(s, pos, end, [m])
+            m = Match(s.source, pos, end, [m])
         else:
             if action is not None:
                 m.value = action(m.value)
@@ -281,26 +973,56 @@ cdef class Bounded(Scanner):
 
 
 cdef class Sequence(Scanner):
-    cdef tuple _scanners
+    cdef readonly tuple _scanners
 
     def __init__(self, *scanners, object action=None):
         self.action = action
         self._scanners = scanners
         self.capturing = any(s.capturing for s in scanners)
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    def __repr__(self):
+        return 'Sequence({})'.format(', '.join(map(repr, self._scanners)))
+    def __str__(self):
+        return ' '.join(map(str, self._scanners))
+    def __reduce__(self):
+        return (type(self), self._scanners, self.action)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner
         for scanner in self._scanners:
             pos = scanner._scan(s, pos)
-            if pos == NOMATCH:
+            if pos < 0:
                 break
         return pos
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Py_ssize_t i = t._open(self, pos)
+        cdef Scanner scanner
+        for scanner in self._scanners:
+            pos = scanner._tree(s, pos, t)
+            if pos < 0:
+                t._discard(i)
+                return pos
+        t._close(i, pos)
+        return pos
+
+    cdef bint _uses(self, Tree t, Py_ssize_t i, Py_ssize_t j):
+        return (<Scanner>t._scanner(j)).capturing
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = _collect(t, i, values)
+        if not self.capturing:
+            val = s.slice(t.starts.data.as_longlongs[i],
+                          t.ends.data.as_longlongs[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef object action = self.action
         cdef list vals = []
         cdef object val
-        cdef int end = pos
+        cdef Py_ssize_t end = pos
         cdef Scanner scanner
         cdef Match m
         for scanner in self._scanners:
@@ -311,10 +1033,8 @@ cdef class Sequence(Scanner):
                 end = m.endpos
                 if mode == TRACE:
                     vals.append(m)
-                elif scanner.action is None:
-                    vals.extend(m.value)
                 else:
-                    vals.append(m.value)
+                    _add(vals, scanner, m.value, None)
             else:
                 end = scanner._scan(s, end)
                 if end == NOMATCH:
@@ -323,41 +1043,96 @@ cdef class Sequence(Scanner):
             val = vals
         else:
             if not self.capturing:
-                val = s[pos:end]
+                val = s.slice(pos, end)
             else:
                 val = vals
             if action is not None:
                 val = action(val)
-        return Match(s, pos, end, val)
+        return Match(s.source, pos, end, val)
 
 
 cdef class Choice(Scanner):
-    cdef tuple _scanners
+    cdef readonly tuple _scanners
+    cdef readonly dict _dispatch
+    cdef readonly tuple _default
 
     def __init__(self, *scanners, object action=None):
         self.action = action
         self._scanners = scanners
         self.capturing = any(s.capturing for s in scanners)
-
-    cdef int _scan(self, unicode s, int pos) except EOS:
+        self._dispatch = None
+        self._default = scanners
+
+    def __repr__(self):
+        return 'Choice({})'.format(', '.join(map(repr, self._scanners)))
+    def __str__(self):
+        return ' | '.join(map(str, self._scanners))
+    def __reduce__(self):
+        return (type(self), self._scanners,
+                (self.action, self._dispatch, self._default))
+    def __setstate__(self, state):
+        self.action, self._dispatch, self._default = state
+
+    def dispatch(self, dict table=None, tuple default=()):
+        """
+        Only try the alternatives in *table*[c] when the next
+        character is c, or those in *default* when c is not in
+        *table*. Each entry must keep the alternatives in their
+        original order. At the end of the input, and when *table* is
+        `None` (which disables dispatching), all alternatives are tried.
+        """
+        self._dispatch = table
+        self._default = self._scanners if table is None else default
+
+    cdef inline tuple _candidates(self, Input s, Py_ssize_t pos):
+        if self._dispatch is None:
+            return self._scanners
+        pos = _skip(self, s, pos)  # dispatch on the next token
+        if pos < 0 or pos >= s.length:
+            return self._scanners
+        return self._dispatch.get(PyUnicode_READ(s.kind, s.data, pos),
+                                  self._default)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner
-        cdef int end
-        for scanner in self._scanners:
+        cdef Py_ssize_t end
+        for scanner in self._candidates(s, pos):
             end = scanner._scan(s, pos)
+            if end != NOMATCH:
+                return end  # a match, or EOS if undecided
+        return NOMATCH
+
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Py_ssize_t i = t._open(self, pos)
+        cdef Scanner scanner
+        cdef Py_ssize_t end
+        for scanner in self._candidates(s, pos):
+            end = scanner._tree(s, pos, t)
             if end >= 0:
+                t._close(i, end)
                 return end
+            elif end == EOS:
+                t._discard(i)
+                return EOS  # undecided
+        t._discard(i)
         return NOMATCH
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = values[i + 1]
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef object action = self.action
         cdef object val = None
         cdef Scanner scanner
         cdef Match m
-        for scanner in self._scanners:
+        for scanner in self._candidates(s, pos):
             m = scanner._match(s, pos, mode)
             if m is not None:
                 if mode == TRACE:
-                    m = Match(s, pos, m.endpos, [m])
+                    m = Match(s.source, pos, m.endpos, [m])
                 elif action is not None:
                     m.value = action(m.value)
                 return m
@@ -365,30 +1140,52 @@ cdef class Choice(Scanner):
 
 
 cdef class Repeat(Scanner):
-    cdef Scanner _scanner
-    cdef Scanner _delimiter
-    cdef int _min, _max
-
-    def __init__(self, Scanner scanner, int min=0, int max=-1,
-                 Scanner delimiter=None, object action=None):
+    # With a *sink*, the values the repetition would collect are passed
+    # to the sink as each item matches, and it has no value itself.
+    cdef readonly Scanner _scanner
+    cdef readonly Scanner _delimiter
+    cdef readonly Py_ssize_t _min, _max
+    cdef public object sink
+
+    def __init__(self, Scanner scanner, Py_ssize_t min=0, Py_ssize_t max=-1,
+                 Scanner delimiter=None, object action=None,
+                 object sink=None):
         self.action = action
         self._scanner = scanner
         self._min = min
         self._max = max
         self._delimiter = delimiter
+        self.sink = sink
         self.capturing = (scanner.capturing or
                           (delimiter is not None and delimiter.capturing))
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    def __repr__(self):
+        return 'Repeat({}, min={}, max={}, delimiter={})'.format(
+            repr(self._scanner), self._min, self._max, repr(self._delimiter)
+        )
+    def __str__(self): return '{}{{{},{}{}}}'.format(
+        str(self._scanner),
+        self._min,
+        self._max,
+        ':' + str(self._delimiter) if self._delimiter is not None else ''
+    )
+    def __reduce__(self):
+        return (type(self),
+                (self._scanner, self._min, self._max, self._delimiter),
+                self.action)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner = self._scanner
         cdef Scanner delim = self._delimiter
-        cdef int a = self._min, b = self._max, count = 0
-        cdef int newpos
+        cdef Py_ssize_t a = self._min, b = self._max, count = 0
+        cdef Py_ssize_t newpos
         try:
-            newpos = scanner._scan(s, pos)
-            while newpos >= 0 and count != b:
+            newpos = scanner._scan(s, pos) if b != 0 else NOMATCH
+            while newpos >= 0:
                 pos = newpos
                 count += 1
+                if count == b:
+                    break  # without trying another item
                 if delim is not None:
                     newpos = delim._scan(s, pos)
                     if newpos < 0:
@@ -398,20 +1195,71 @@ cdef class Repeat(Scanner):
                     newpos = scanner._scan(s, pos)
         except IndexError:
             pass
+        if newpos == EOS and count != b:
+            return EOS
         if count >= a:
             return pos
         return NOMATCH
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Scanner scanner = self._scanner
+        cdef Scanner delim = self._delimiter
+        cdef Py_ssize_t a = self._min, b = self._max, count = 0
+        cdef Py_ssize_t end = pos, newpos
+        cdef Py_ssize_t i = t._open(self, pos), mark = t._n
+        try:
+            while count != b:
+                mark = t._n
+                newpos = end
+                if delim is not None and count > 0:
+                    newpos = delim._tree(s, newpos, t)
+                if newpos >= 0:
+                    newpos = scanner._tree(s, newpos, t)
+                if newpos < 0:
+                    t._truncate(mark)  # e.g., a trailing delimiter
+                    if newpos == EOS:
+                        t._discard(i)
+                        return EOS
+                    break
+                end = newpos
+                count += 1
+        except IndexError:
+            t._truncate(mark)
+            t._parent = i
+        if count >= a:
+            t._close(i, end)
+            return end
+        t._discard(i)
+        return NOMATCH
+
+    cdef bint _uses(self, Tree t, Py_ssize_t i, Py_ssize_t j):
+        return (<Scanner>t._scanner(j)).capturing
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = _collect(t, i, values)
+        if self.sink is not None:
+            for val in <list>val:
+                self.sink(val)
+            return _EMITTED
+        if not self.capturing:
+            val = s.slice(t.starts.data.as_longlongs[i],
+                          t.ends.data.as_longlongs[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef object action = self.action
+        cdef object sink = self.sink if mode != TRACE else None
         cdef Scanner scanner = self._scanner
         cdef Scanner delimiter = self._delimiter
         cdef bint s_is_grp = scanner.capturing
-        cdef bint d_is_grp = delimiter.capturing
-        cdef int a = self._min, b = self._max, count = 0, end = pos
+        cdef bint d_is_grp = delimiter is not None and delimiter.capturing
+        cdef Py_ssize_t a = self._min, b = self._max, count = 0
+        cdef Py_ssize_t end = pos, d_end
         cdef list vals = []
         cdef object val
-        cdef Match m
+        cdef Match m, d
         try:
             m = scanner._match(s, end, mode)
             while m is not None and count != b:
@@ -420,27 +1268,27 @@ cdef class Repeat(Scanner):
                 if mode == TRACE:
                     vals.append(m)
                 elif s_is_grp:
-                    if scanner.action is None:
-                        vals.extend(m.value)
-                    else:
-                        vals.append(m.value)
+                    _add(vals, scanner, m.value, sink)
+                if count == b:
+                    break
                 if delimiter is not None:
+                    d = None
                     if mode == TRACE or d_is_grp:
-                        m = delimiter._match(s, end, mode)
-                        if m is None:
+                        d = delimiter._match(s, end, mode)
+                        if d is None:
                             break
-                        d_end = m.endpos
-                        if mode == TRACE:
-                            vals.append(m)
-                        elif delimiter.action is None:
-                            vals.extend(m.value)
-                        else:
-                            vals.append(m.value)
+                        d_end = d.endpos
                     else:
                         d_end = delimiter._scan(s, end)
                         if d_end == NOMATCH:
                             break
                     m = scanner._match(s, d_end, mode)
+                    # keep the delimiter only if an item follows it
+                    if m is not None and d is not None:
+                        if mode == TRACE:
+                            vals.append(d)
+                        else:
+                            _add(vals, delimiter, d.value, sink)
                 else:
                     m = scanner._match(s, end, mode)
         except IndexError:
@@ -448,20 +1296,22 @@ cdef class Repeat(Scanner):
         if count >= a:
             if mode == TRACE:
                 val = vals
+            elif sink is not None:
+                val = _EMITTED
             else:
                 if not (s_is_grp or d_is_grp):
-                    val = s[pos:end]
+                    val = s.slice(pos, end)
                 else:
                     val = vals
                 if action is not None:
                     val = action(val)
-            return Match(s, pos, end, val)
+            return Match(s.source, pos, end, val)
         return None
 
 
 cdef class Optional(Scanner):
-    cdef Scanner _scanner
-    cdef object _default
+    cdef readonly Scanner _scanner
+    cdef readonly object _default
 
     def __init__(self, Scanner scanner, object default=...,
                  object action=None):
@@ -473,107 +1323,458 @@ cdef class Optional(Scanner):
             self._default = default
         self.capturing = scanner.capturing
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    def __repr__(self): return 'Optional({})'.format(repr(self._scanner))
+    def __str__(self): return str(self._scanner) + '?'
+    def __reduce__(self):
+        return (type(self), (self._scanner, self._default), self.action)
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner = self._scanner
-        cdef int end
+        cdef Py_ssize_t end
         try:
             end = scanner._scan(s, pos)
             if end == NOMATCH:
                 end = pos
         except IndexError:
             end = pos
+        return end  # EOS is passed on
+
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Py_ssize_t i = t._open(self, pos)
+        cdef Py_ssize_t end
+        try:
+            end = self._scanner._tree(s, pos, t)
+        except IndexError:
+            t._truncate(i + 1)
+            t._parent = i
+            end = NOMATCH
+        if end == EOS:
+            t._discard(i)
+            return EOS
+        elif end < 0:
+            end = pos
+        t._close(i, end)
         return end
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        if t._first(i) == -1:
+            return self._default
+        return values[i + 1]
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef Scanner scanner = self._scanner
         cdef object default = self._default
         cdef Match m
+        cdef Py_ssize_t end
         m = scanner._match(s, pos, mode)
         if mode == TRACE:
-            return Match(s, pos, pos, [m])  # m could be None
+            end = pos if m is None else m.endpos
+            return Match(s.source, pos, end, [m])  # m could be None
         elif m is None:
-            return Match(s, pos, pos, default)
+            return Match(s.source, pos, pos, default)
         else:
             return m
 
 
 cdef class Lookahead(Scanner):
-    cdef Scanner _scanner
+    cdef readonly Scanner _scanner
     def __init__(self, Scanner scanner):
         self._scanner = scanner
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    def __repr__(self): return 'Lookahead({})'.format(repr(self._scanner))
+    def __str__(self): return '&' + str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner,))
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner = self._scanner
-        if scanner._scan(s, pos) == NOMATCH:
-            return NOMATCH
+        cdef Py_ssize_t end = scanner._scan(s, pos)
+        if end < 0:
+            return end
         else:
             return pos
 
 
 cdef class NegativeLookahead(Scanner):
-    cdef Scanner _scanner
+    cdef readonly Scanner _scanner
     def __init__(self, Scanner scanner):
         self._scanner = scanner
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    def __repr__(self):
+        return 'NegativeLookahead({})'.format(repr(self._scanner))
+    def __str__(self): return '!' + str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner,))
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner = self._scanner
-        if scanner._scan(s, pos) == NOMATCH:
+        cdef Py_ssize_t end
+        s.quiet += 1  # failing here is not an error
+        try:
+            end = scanner._scan(s, pos)
+        finally:
+            s.quiet -= 1
+        if end == NOMATCH:
             return pos
+        elif end == EOS:
+            return EOS
         else:
-            return NOMATCH
+            return _fail(s, self, pos)
+
+
+cdef class _MemoTable(object):
+    # the entries of a Memo for one thread
+    cdef object string
+    cdef dict scans, matches, traces
+    cdef dict trees  # for the Tree in *tree*
+    cdef object tree
+    cdef Py_ssize_t horizon
+
+    def __len__(self):
+        cdef dict table
+        cdef Py_ssize_t n = 0
+        for table in (self.scans, self.matches, self.traces, self.trees):
+            for entries in table.values():
+                n += len(entries)
+        return n
+
+    cdef void evict(self, Py_ssize_t pos, Py_ssize_t window):
+        cdef Py_ssize_t horizon
+        cdef dict table
+        if window < 0:
+            return
+        horizon = pos - window
+        # sweep only after the horizon moved a full window so the cost
+        # is amortized over the stored entries
+        if horizon - self.horizon > window:
+            for table in (self.scans, self.matches, self.traces,
+                          self.trees):
+                for key in [key for key in table if key < horizon]:
+                    del table[key]
+            self.horizon = horizon
+
+
+cdef _MemoTable _new_table(object string):
+    cdef _MemoTable table = _MemoTable()
+    table.string = string
+    table.scans = {}
+    table.matches = {}
+    table.traces = {}
+    table.trees = {}
+    table.tree = None
+    table.horizon = 0
+    return table
+
+
+cdef class Memo(object):
+    """
+    Packrat memoization table shared by one or more Nonterminals.
+
+    Results are stored per rule name and position for the string
+    currently being parsed; the table is emptied when a different
+    string is seen or when clear() is called. If *window* is
+    non-negative, entries more than *window* characters behind the
+    most recently stored position are evicted so memory stays bounded
+    on long inputs. The *hits* and *misses* attributes count lookups.
+
+    Each thread has its own table, so a Memo (and the grammar using
+    it) may be shared by threads parsing different strings; len() and
+    clear() apply to the calling thread's table. The counts are not
+    synchronized and are approximate when threads parse concurrently.
+    """
+    cdef readonly Py_ssize_t window
+    cdef public Py_ssize_t hits, misses
+    cdef object _local
+
+    def __init__(self, Py_ssize_t window=-1):
+        self.window = window
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def __reduce__(self):
+        return (type(self), (self.window,))  # entries are not kept
+
+    def __len__(self):
+        return len(self._table(None))
+
+    def clear(self):
+        # empty the table in place, as inputs may have cached it
+        cdef _MemoTable table = self._table(None)
+        table.string = None
+        table.scans, table.matches, table.traces = {}, {}, {}
+        table.trees, table.tree = {}, None
+        table.horizon = 0
+
+    cdef _MemoTable _table(self, object string):
+        # the calling thread's table, emptied if *string* is new
+        cdef _MemoTable table = getattr(self._local, 'table', None)
+        if table is None or (string is not None
+                             and string is not table.string):
+            table = _new_table(string)
+            self._local.table = table
+        return table
+
+    cdef inline _MemoTable _input_table(self, Input s):
+        # as _table(), but cached on *s*, which only one thread uses
+        cdef _MemoTable table
+        if s.memo is self:
+            table = <_MemoTable>s.memo_table
+            if table.string is s.source:  # else cleared meanwhile
+                return table
+        table = self._table(s.source)
+        s.memo = self
+        s.memo_table = table
+        return table
+
+    cdef Py_ssize_t _scan(self, Scanner scanner, unicode name,
+                   Input s, Py_ssize_t pos) except ERROR:
+        cdef _MemoTable table = self._input_table(s)
+        cdef dict entries
+        cdef Py_ssize_t end
+        entries = table.scans.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            return entries[name]
+        self.misses += 1
+        end = scanner._scan(s, pos)
+        if entries is None:
+            entries = {}
+            table.scans[pos] = entries
+            table.evict(pos, self.window)
+        entries[name] = end
+        return end
 
+    cdef Match _match(self, Scanner scanner, unicode name,
+                      Input s, Py_ssize_t pos, int mode):
+        cdef _MemoTable memo = self._input_table(s)
+        cdef dict table, entries
+        cdef tuple entry
+        cdef Match m
+        table = memo.traces if mode == TRACE else memo.matches
+        entries = table.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            entry = entries[name]
+            if entry[0] == NOMATCH:
+                return None
+            return Match(s.source, pos, entry[0], entry[1])
+        self.misses += 1
+        m = scanner._match(s, pos, mode)
+        if entries is None:
+            entries = {}
+            table[pos] = entries
+            memo.evict(pos, self.window)
+        if m is None:
+            entries[name] = (NOMATCH, None)
+        else:
+            entries[name] = (m.endpos, m.value)
+        return m
 
-cdef class Nonterminal(Scanner):
-    cdef object _grammar
-    cdef unicode _name
+    cdef Py_ssize_t _tree(self, Scanner scanner, unicode name, Input s,
+                          Py_ssize_t pos, Tree t) except ERROR:
+        # a hit copies the nodes of the rule's body into t
+        cdef _MemoTable memo = self._input_table(s)
+        cdef dict entries
+        cdef _TreeEntry e
+        cdef Py_ssize_t base, end
+        if memo.tree is not t:
+            memo.tree = t
+            memo.trees = {}
+        entries = memo.trees.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            e = entries[name]
+            if e.end >= 0:
+                t._copy(e)
+            return e.end
+        self.misses += 1
+        base = t._n
+        end = scanner._tree(s, pos, t)
+        if entries is None:
+            entries = {}
+            memo.trees[pos] = entries
+            memo.evict(pos, self.window)
+        e = _TreeEntry()
+        e.end, e.base, e.count = end, base, t._n - base
+        entries[name] = e
+        if end >= 0:
+            t._memos.append(e)
+        return end
 
-    def __init__(self, object grammar, unicode name, object action=None):
+
+cdef class Nonterminal(Scanner):
+    # With a *sink*, the value of each match is passed to the sink
+    # instead (see Repeat).
+    cdef readonly object _grammar
+    cdef readonly unicode _name
+    cdef readonly Scanner _scanner
+    cdef public Memo memo
+    cdef public object sink
+
+    def __init__(self, object grammar, unicode name, object action=None,
+                 Memo memo=None, object sink=None):
         self.action = action
         self._grammar = grammar
         self._name = name
+        self._scanner = None
+        self.memo = memo
+        self.sink = sink
+
+    def __repr__(self): return 'Nonterminal(<dict>, "{}")'.format(self._name)
+    def __str__(self): return self._name
+    def __reduce__(self):
+        return (type(self), (self._grammar, self._name, None, self.memo),
+                (self.action, self._scanner))
+    def __setstate__(self, state):
+        self.action, self._scanner = state
+
+    def link(self):
+        """
+        Bind the nonterminal directly to its rule's scanner so scanning
+        no longer looks the rule up in the grammar. Raise a ValueError
+        if the rule is not defined.
+        """
+        try:
+            scanner = self._grammar[self._name]
+        except KeyError:
+            scanner = None
+        if scanner is None:
+            raise ValueError('Undefined rule: {}'.format(self._name))
+        self._scanner = scanner
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
-        cdef Scanner scanner
-        scanner = self._grammar[self._name]
+    def unlink(self):
+        """Revert to looking up the rule at scan time."""
+        self._scanner = None
+
+    cdef Scanner _resolve(self):
+        cdef Scanner scanner = self._grammar[self._name]
         if scanner is None:
             raise Exception(
                 'Nonterminal {} is not associated with a grammar'
                 .format(self._name)
             )
+        return scanner
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef Scanner scanner = self._scanner
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)  # before a token rule
+        if pos < 0:
+            return pos
+        if self.memo is not None:
+            return self.memo._scan(scanner, self._name, s, pos)
         return scanner._scan(s, pos)
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Scanner scanner = self._scanner
+        cdef Py_ssize_t i
+        cdef Py_ssize_t end
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        i = t._open(self, pos)
+        if self.memo is not None:
+            end = self.memo._tree(scanner, self._name, s, pos, t)
+        else:
+            end = scanner._tree(s, pos, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = values[i + 1]
+        if val is _EMITTED:
+            return val
+        if self.action is not None:
+            val = self.action(val)
+        if self.sink is not None:
+            self.sink(val)
+            val = _EMITTED
+        return val
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef object action = self.action
-        cdef Scanner scanner = self._grammar[self._name]
-        cdef Match m = scanner._match(s, pos, mode)
+        cdef Scanner scanner = self._scanner
+        cdef Match m
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return None
+        if self.memo is not None:
+            m = self.memo._match(scanner, self._name, s, pos, mode)
+        else:
+            m = scanner._match(s, pos, mode)
         if m is not None:
             if mode == TRACE:
-                m = Match(s, pos, m.endpos, [m])
-            elif action is not None:
-                m.value = action(m.value)
+                m = Match(s.source, pos, m.endpos, [m])
+            elif m.value is not _EMITTED:
+                if action is not None:
+                    m.value = action(m.value)
+                if self.sink is not None:
+                    self.sink(m.value)
+                    m.value = _EMITTED
         return m
 
 
 cdef class Group(Scanner):
-    cdef Scanner _scanner
+    # With a *sink*, the value the group would add to its parent's
+    # values is passed to the sink instead (see Repeat).
+    cdef readonly Scanner _scanner
+    cdef public object sink
 
-    def __init__(self, Scanner scanner, object action=None):
+    def __init__(self, Scanner scanner, object action=None,
+                 object sink=None):
         self.action = action
         self._scanner = scanner
         self.capturing = True
+        self.sink = sink
+
+    def __repr__(self): return 'Group({})'.format(repr(self._scanner))
+    def __str__(self): return '({})'.format(str(self._scanner))
+    def __reduce__(self): return (type(self), (self._scanner,), self.action)
 
-    cdef int _scan(self, unicode s, int pos) except EOS:
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
         cdef Scanner scanner = self._scanner
         return scanner._scan(s, pos)
 
-    cdef Match _match(self, unicode s, int pos, int mode):
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        cdef Py_ssize_t i = t._open(self, pos)
+        cdef Py_ssize_t end = self._scanner._tree(s, pos, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    cdef object _value(self, Input s, Tree t, Py_ssize_t i, list values):
+        cdef object val = values[i + 1]
+        if val is _EMITTED:
+            return val
+        if self.sink is not None:
+            self.sink(val if self.action is None else self.action(val))
+            return _EMITTED
+        if self.action is None:
+            return [val]
+        return self.action(val)
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
         cdef Scanner scanner = self._scanner
         cdef object action = self.action
         cdef Match m
         m = scanner._match(s, pos, mode)
         if m is not None:
             if mode == TRACE:
-                m = Match(s, pos, m.endpos, [m])
+                m = Match(s.source, pos, m.endpos, [m])
+            elif m.value is _EMITTED:
+                pass
+            elif self.sink is not None:
+                self.sink(m.value if action is None else action(m.value))
+                m.value = _EMITTED
             elif action is None:
                 m.value = [m.value]
             else:
@@ -581,18 +1782,364 @@ cdef class Group(Scanner):
         return m
 
 
+
+# time spent in nested probes, used to compute self time
+cdef double _probe_child_time = 0.0
+
+
+cdef class Probe(Scanner):
+    """
+    Wrapper recording statistics about the scans and matches of
+    *scanner* (see textpy.profiling); results are not changed.
+
+    *calls* counts invocations, of which *successes* matched and
+    *failures* did not (EOS counts as a failure), *consumed* is the
+    number of characters matched, *time* and *self_time* are the
+    seconds spent with and without nested probes, and *retries* counts
+    invocations at a position already tried on the same input.
+    """
+    cdef readonly Scanner _scanner
+    cdef readonly object name
+    cdef public Py_ssize_t calls, successes, failures, consumed, retries
+    cdef public double time, self_time
+    cdef object _string
+    cdef set _positions
+
+    def __init__(self, Scanner scanner, object name=None):
+        self._scanner = scanner
+        self.name = name
+        self.capturing = scanner.capturing
+        # parents check the action to decide how to use values, but
+        # only the wrapped scanner applies it
+        self.action = scanner.action
+        self.reset()
+
+    def __repr__(self): return 'Probe({})'.format(repr(self._scanner))
+    def __str__(self): return str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner, self.name))
+
+    def reset(self):
+        """Set all statistics to zero."""
+        self.calls = self.successes = self.failures = 0
+        self.consumed = self.retries = 0
+        self.time = self.self_time = 0.0
+        self._string = None
+        self._positions = set()
+
+    cdef inline double _enter(self, Input s, Py_ssize_t pos):
+        global _probe_child_time
+        if s.source is not self._string:
+            self._string = s.source
+            self._positions = set()
+        if pos in self._positions:
+            self.retries += 1
+        else:
+            self._positions.add(pos)
+        self.calls += 1
+        _probe_child_time = 0.0
+        return perf_counter()
+
+    cdef inline void _exit(self, double start, double outer, Py_ssize_t pos,
+                           Py_ssize_t end):
+        global _probe_child_time
+        cdef double elapsed = perf_counter() - start
+        self.time += elapsed
+        self.self_time += elapsed - _probe_child_time
+        _probe_child_time = outer + elapsed
+        if end >= 0:
+            self.successes += 1
+            self.consumed += end - pos
+        else:
+            self.failures += 1
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        cdef double outer = _probe_child_time
+        cdef double start = self._enter(s, pos)
+        cdef Py_ssize_t end = NOMATCH
+        try:
+            end = self._scanner._scan(s, pos)
+        finally:
+            self._exit(start, outer, pos, end)
+        return end
+
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        return self._scanner._tree(s, pos, t)  # not a node
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
+        cdef double outer = _probe_child_time
+        cdef double start = self._enter(s, pos)
+        cdef Match m = None
+        try:
+            m = self._scanner._match(s, pos, mode)
+        finally:
+            self._exit(start, outer, pos, NOMATCH if m is None else m.endpos)
+        return m
+
+cdef enum:
+    # the opcodes of textpy.vm, in the same order
+    OP_SCAN, OP_CHAR, OP_SET, OP_SPAN, OP_CHOICE, OP_COMMIT, OP_PCOMMIT,
+    OP_BCOMMIT, OP_FAILNOT, OP_FAIL, OP_CALL, OP_RET, OP_OPEN, OP_CLOSE,
+    OP_LEAF, OP_SKIP, OP_QUIET, OP_END
+
+
+cdef struct Instruction:
+    int op
+    Py_ssize_t arg
+
+
+cdef struct Entry:
+    # a backtrack entry, or a return address if *mark* is -1; *mark*
+    # and *parent* restore the tree when tracing
+    Py_ssize_t pc, pos, mark, parent
+    int quiet
+
+
+cdef class Machine(Scanner):
+    """
+    Scanner running a program made by `textpy.vm.compile()` from
+    *scanner*, with an explicit backtracking stack instead of nested
+    calls (see textpy.vm).
+    """
+    cdef readonly Scanner _scanner
+    cdef readonly tuple _code
+    cdef readonly list _nodes
+    cdef Instruction *_program
+
+    def __init__(self, Scanner scanner, object code, object nodes):
+        cdef Py_ssize_t i
+        self._scanner = scanner
+        self._code = tuple(code)
+        self._nodes = list(nodes)
+        # parents check the action to decide how to use values, but
+        # only the compiled scanner applies it
+        self.action = scanner.action
+        self.capturing = scanner.capturing
+        PyMem_Free(self._program)
+        self._program = <Instruction *>PyMem_Malloc(
+            len(self._code) * sizeof(Instruction) + 1)
+        if self._program is NULL:
+            raise MemoryError()
+        for i, (op, arg) in enumerate(self._code):
+            self._program[i].op = op
+            self._program[i].arg = arg
+
+    def __dealloc__(self):
+        PyMem_Free(self._program)
+
+    def __repr__(self): return 'Machine({})'.format(repr(self._scanner))
+    def __str__(self): return str(self._scanner)
+    def __reduce__(self):
+        return (type(self), (self._scanner, self._code, self._nodes))
+
+    cdef Py_ssize_t _scan(self, Input s, Py_ssize_t pos) except ERROR:
+        return self._run(s, pos, None)
+
+    cdef Py_ssize_t _tree(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        return self._run(s, pos, t)
+
+    cdef Match _match(self, Input s, Py_ssize_t pos, int mode):
+        cdef Tree t
+        cdef Py_ssize_t end
+        t = Tree(s.source)
+        end = self._run(s, pos, t)
+        if end < 0:
+            return None
+        t._finish()
+        if mode == TRACE:
+            return _traced(s, t, 0)
+        return Match(s.source, pos, end, _evaluate(t, 0))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef Py_ssize_t _run(self, Input s, Py_ssize_t pos, Tree t) except ERROR:
+        # scan from *pos*, adding nodes to *t* unless it is None
+        cdef Instruction *code = self._program
+        cdef list nodes = self._nodes
+        cdef Py_ssize_t pc = 0, n = 0, cap = 64, start, end, i = 0
+        cdef Entry *stack = <Entry *>PyMem_Malloc(cap * sizeof(Entry))
+        cdef Entry *e
+        cdef int op, quiet = s.quiet
+        cdef bint ok
+        cdef Scanner node
+        cdef Literal lit
+        cdef CharacterClass cc
+        if stack is NULL:
+            raise MemoryError()
+        try:
+            while True:
+                op = code[pc].op
+                ok = True
+                if op == OP_SCAN:
+                    node = <Scanner>nodes[code[pc].arg]
+                    if t is None:
+                        end = node._scan(s, pos)
+                    else:
+                        end = node._tree(s, pos, t)
+                    if end == EOS:
+                        return EOS
+                    ok = end >= 0
+                    pos = end
+                    pc += 1
+                elif op == OP_CHAR:
+                    lit = <Literal>nodes[code[pc].arg]
+                    if pos >= s.length:
+                        if _at_end(s, lit, pos) == EOS:
+                            return EOS
+                        ok = False
+                    elif (_read(s.kind, s.data, pos)
+                          == _read(lit._text.kind, lit._text.data, 0)):
+                        if t is not None:
+                            t._leaf(lit, pos, pos + 1)
+                        pos += 1
+                        pc += 1
+                    else:
+                        _fail(s, lit, pos)
+                        ok = False
+                elif op == OP_SET:
+                    cc = <CharacterClass>nodes[code[pc].arg]
+                    if pos >= s.length:
+                        if _at_end(s, cc, pos) == EOS:
+                            return EOS
+                        ok = False
+                    elif cc._contains(_read(s.kind, s.data, pos)):
+                        if t is not None:
+                            t._leaf(cc, pos, pos + 1)
+                        pos += 1
+                        pc += 1
+                    else:
+                        _fail(s, cc, pos)
+                        ok = False
+                elif op == OP_SPAN:
+                    node = <Scanner>nodes[code[pc].arg]
+                    cc = <CharacterClass>(<Repeat>node)._scanner
+                    start = pos
+                    if t is not None:
+                        i = t._open(node, pos)
+                    while pos < s.length and cc._contains(
+                            _read(s.kind, s.data, pos)):
+                        if t is not None:
+                            t._leaf(cc, pos, pos + 1)
+                        pos += 1
+                    if pos >= s.length:
+                        if _at_end(s, cc, pos) == EOS:
+                            return EOS
+                    else:
+                        _fail(s, cc, pos)
+                    ok = pos - start >= (<Repeat>node)._min
+                    if ok and t is not None:
+                        t._close(i, pos)
+                    pc += 1
+                elif op == OP_CHOICE:
+                    e = _push(&stack, &cap, n)
+                    n += 1
+                    e.pc = code[pc].arg
+                    e.pos = pos
+                    e.quiet = s.quiet
+                    e.mark = e.parent = 0
+                    if t is not None:
+                        e.mark = t._n
+                        e.parent = t._parent
+                    pc += 1
+                elif op == OP_COMMIT:
+                    n -= 1
+                    pc = code[pc].arg
+                elif op == OP_PCOMMIT:
+                    e = &stack[n - 1]
+                    e.pos = pos
+                    if t is not None:
+                        e.mark = t._n
+                        e.parent = t._parent
+                    pc = code[pc].arg
+                elif op == OP_BCOMMIT or op == OP_FAILNOT:
+                    n -= 1
+                    e = &stack[n]
+                    pos = e.pos
+                    s.quiet = e.quiet
+                    if t is not None:
+                        t._truncate(e.mark)
+                        t._parent = e.parent
+                    if op == OP_BCOMMIT:
+                        pc = code[pc].arg
+                    else:
+                        _fail(s, <Scanner>nodes[code[pc].arg], pos)
+                        ok = False
+                elif op == OP_FAIL:
+                    ok = False
+                elif op == OP_CALL:
+                    e = _push(&stack, &cap, n)
+                    n += 1
+                    e.pc = pc + 1
+                    e.mark = -1
+                    pc = code[pc].arg
+                elif op == OP_RET:
+                    n -= 1
+                    pc = stack[n].pc
+                elif op == OP_OPEN:
+                    if t is not None:
+                        t._open(<Scanner>nodes[code[pc].arg], pos)
+                    pc += 1
+                elif op == OP_CLOSE:
+                    if t is not None:
+                        t._close(t._parent, pos)
+                    pc += 1
+                elif op == OP_LEAF:
+                    if t is not None:
+                        t._leaf(<Scanner>nodes[code[pc].arg], pos, pos)
+                    pc += 1
+                elif op == OP_SKIP:
+                    pos = _skip(<Scanner>nodes[code[pc].arg], s, pos)
+                    if pos < 0:
+                        return pos
+                    pc += 1
+                elif op == OP_QUIET:
+                    s.quiet += <int>code[pc].arg
+                    pc += 1
+                else:  # OP_END
+                    return pos
+                if not ok:
+                    # unwind to the last backtrack entry
+                    while n > 0 and stack[n - 1].mark == -1:
+                        n -= 1
+                    if n == 0:
+                        return NOMATCH
+                    n -= 1
+                    e = &stack[n]
+                    pc = e.pc
+                    pos = e.pos
+                    s.quiet = e.quiet
+                    if t is not None:
+                        t._truncate(e.mark)
+                        t._parent = e.parent
+        finally:
+            s.quiet = quiet
+            PyMem_Free(stack)
+
+
+cdef inline Entry *_push(Entry **stack, Py_ssize_t *cap,
+                         Py_ssize_t n) except NULL:
+    # the entry at index n of the stack, growing it if needed
+    cdef Entry *grown
+    if n == cap[0]:
+        grown = <Entry *>PyMem_Realloc(stack[0], 2 * n * sizeof(Entry))
+        if grown is NULL:
+            raise MemoryError()
+        stack[0] = grown
+        cap[0] = 2 * n
+    return &stack[0][n]
+
+
 # utility functions
 
 def split(
         unicode s not None,
         unicode sep=u' \t\v\n\f\r',
-        int maxsplit=-1,
+        Py_ssize_t maxsplit=-1,
         unicode esc=u'\\',
         unicode quotes=u'"\''):
-    cdef int start = 0
-    cdef int pos = 0
-    cdef int end = len(s)
-    cdef int numsplit = 0
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t pos = 0
+    cdef Py_ssize_t end = len(s)
+    cdef Py_ssize_t numsplit = 0
     cdef list tokens = []
     cdef bint in_quotes = False
     cdef unicode q = u''
@@ -628,28 +2175,576 @@ def split(
 
 # helper functions
 
-cdef inline int _scan_digits(unicode s, int pos):
-    cdef int i = 0
+cdef object _evaluate(Tree t, Py_ssize_t i):
+    # compute the values of the nodes under node i that are used, in
+    # post-order so actions run in the order of the input
+    cdef Input s = Input(t.string)
+    cdef Py_ssize_t j, p, end = i
+    cdef list values = [None] * t._n
+    cdef bytearray used = bytearray(t._n)
+    cdef list stack = []
+    while end != -1 and t._next(end) == -1:
+        end = t.parents.data.as_longlongs[end]
+    end = t._n if end == -1 else t._next(end)
+    used[i] = 1
+    for j in range(i, end):
+        p = t.parents.data.as_longlongs[j]
+        if j > i and used[p] and (<Scanner>t._scanner(p))._uses(t, p, j):
+            used[j] = 1
+        while stack and stack[-1] != p:
+            _evaluate_node(s, t, stack.pop(), values, used)
+        stack.append(j)
+    while stack:
+        _evaluate_node(s, t, stack.pop(), values, used)
+    return values[i]
+
+
+cdef int _evaluate_node(Input s, Tree t, Py_ssize_t j, list values,
+                        bytearray used) except -1:
+    if used[j]:
+        values[j] = (<Scanner>t._scanner(j))._value(s, t, j, values)
+    return 0
+
+
+cdef Match _traced(Input s, Tree t, Py_ssize_t i):
+    # the Match that match(trace=True) gives for node i, built from the
+    # nodes under it in post-order rather than by nested calls
+    cdef Py_ssize_t j, k, p, end = i
+    cdef list stack = []  # (node, Match objects of its children)
+    cdef list val
+    cdef Match m = None
+    while end != -1 and t._next(end) == -1:
+        end = t.parents.data.as_longlongs[end]
+    end = t._n if end == -1 else t._next(end)
+    for j in range(i, end + 1):
+        p = t.parents.data.as_longlongs[j] if j < end else -2
+        while stack and stack[-1][0] != p:
+            k, val = stack.pop()
+            m = _traced_node(s, t, k, val)
+            if stack:
+                (<list>stack[-1][1]).append(m)
+        stack.append((j, []))
+    return m
+
+
+cdef Match _traced_node(Input s, Tree t, Py_ssize_t i, list val):
+    # the Match of node i, given those of its children
+    cdef Scanner scanner = t._scanner(i)
+    cdef Py_ssize_t start = t.starts.data.as_longlongs[i]
+    cdef Py_ssize_t end = t.ends.data.as_longlongs[i]
+    if isinstance(scanner, (Sequence, Choice, Repeat, Group, Nonterminal)):
+        return Match(s.source, start, end, val)
+    elif isinstance(scanner, Optional):
+        return Match(s.source, start, end, val or [None])
+    elif isinstance(scanner, Bounded):
+        return Match(s.source, start, end, val[1:2])  # only the body
+    return scanner._match(s, start, TRACE)  # terminals have no children
+
+
+cdef list _collect(Tree t, Py_ssize_t i, list values):
+    # the values of the capturing children of node i, as a list
+    cdef list val = []
+    cdef Scanner scanner
+    cdef Py_ssize_t j = t._first(i)
+    while j != -1:
+        scanner = t._scanner(j)
+        if scanner.capturing:
+            _add(val, scanner, values[j], None)
+        j = t._next(j)
+    return val
+
+
+class _Emitted(tuple):
+    # the value of a match whose value went to a sink; it adds nothing
+    # to the values of its parent
+    __slots__ = ()
+
+
+cdef object _EMITTED = _Emitted()
+
+
+cdef inline int _add(list vals, Scanner scanner, object value,
+                     object sink) except -1:
+    # add the value of a match of a capturing *scanner* to *vals*, or
+    # pass what would be added to *sink*
+    if value is _EMITTED:
+        return 0
+    if scanner.action is None:
+        if sink is None:
+            vals.extend(value)
+        else:
+            for value in value:
+                sink(value)
+    elif sink is None:
+        vals.append(value)
+    else:
+        sink(value)
+    return 0
+
+
+cdef unicode _as_text(object x):
+    # patterns may be given as bytes, which are read as Latin-1
+    if isinstance(x, unicode):
+        return x
+    return unicode(x, 'latin-1')
+
+
+cdef object _retype_regex(object regex, bint text):
+    # recompile *regex* for str (if *text*) or bytes-like input
+    pattern = regex.pattern
+    if text:
+        return re.compile(pattern.decode('latin-1'), regex.flags | re.ASCII)
     try:
-        while u'0' <= s[pos+i] <= u'9':
+        pattern = pattern.encode('latin-1')
+    except UnicodeEncodeError:
+        raise TypeError(
+            'cannot use a non-Latin-1 pattern on bytes: {!r}'.format(pattern)
+        )
+    return re.compile(pattern, regex.flags & ~re.UNICODE)
+
+
+_CLASS_ESCAPES = {
+    u'n': u'\n', u't': u'\t', u'r': u'\r', u'f': u'\f', u'v': u'\v'
+}
+
+cdef tuple _parse_class(unicode clsstr):
+    # Return (negated, ranges) for the class string, where ranges is a
+    # sorted list of disjoint (first, last) code point pairs.
+    cdef bint negated = False
+    cdef list items = [], ranges = []
+    cdef Py_ssize_t i = 0, n = len(clsstr)
+    cdef Py_UCS4 c, d
+    if n > 1 and clsstr[0] == u'^':
+        negated = True
+        i = 1
+    while i < n:
+        c = clsstr[i]
+        i += 1
+        if c == u'\\' and i < n:
+            c = _CLASS_ESCAPES.get(clsstr[i], clsstr[i])
             i += 1
-    except IndexError:
-        pass
-    return i
+        if i < n and clsstr[i] == u'-' and i + 1 < n:
+            d = clsstr[i+1]
+            i += 2
+            if d == u'\\' and i < n:
+                d = _CLASS_ESCAPES.get(clsstr[i], clsstr[i])
+                i += 1
+            if d < c:
+                raise ValueError(
+                    'Invalid range in character class: ' + clsstr
+                )
+            items.append((<long>c, <long>d))
+        else:
+            items.append((<long>c, <long>c))
+    for a, b in sorted(items):
+        if ranges and a <= ranges[-1][1] + 1:
+            if b > ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], b)
+        else:
+            ranges.append((a, b))
+    return negated, ranges
 
 
-cdef inline bint _scan_exponent(unicode s, int pos):
-    cdef int numdigits = 0
+cdef inline Py_ssize_t _skip(Scanner scanner, Input s,
+                             Py_ssize_t pos) except ERROR:
+    # the position after the trivia skipped before *scanner* at pos
+    cdef Py_ssize_t end
+    if scanner.skip is None:
+        return pos
+    s.quiet += 1  # missing trivia is not an error
     try:
-        if s[pos] in u'eE':
-            if s[pos+1] in '-+':
-                numdigits = _scan_digits(s, pos+2)
-                if numdigits > 0:
-                    return numdigits + 2
+        end = scanner.skip._scan(s, pos)
+    finally:
+        s.quiet -= 1
+    return pos if end == NOMATCH else end
+
+
+cdef inline Py_ssize_t _at_end(Input s, Scanner scanner, Py_ssize_t pos):
+    # the result of a terminal that needs to read past the end of *s*
+    return EOS if s.partial else _fail(s, scanner, pos)
+
+
+cdef inline Py_ssize_t _fail(Input s, Scanner scanner, Py_ssize_t pos):
+    # record that *scanner* failed at *pos* and return NOMATCH
+    cdef int i
+    cdef PyObject *x = <PyObject *>scanner
+    if pos < s.farthest or s.quiet:
+        return NOMATCH
+    if pos > s.farthest:
+        s.farthest = pos
+        s.nexpected = 0
+    for i in range(s.nexpected):
+        if s.expected[i] == x:
+            return NOMATCH
+    if s.nexpected < MAX_EXPECTED:
+        s.expected[s.nexpected] = x
+        s.nexpected += 1
+    return NOMATCH
+
+
+cdef object _failure(Input s, Py_ssize_t pos):
+    # the ParseError for a failed match of *s* from *pos*
+    cdef int i
+    if s.farthest > pos:
+        pos = s.farthest
+    expected = [<object>s.expected[i] for i in range(s.nexpected)]
+    return _parse_error(s.source, pos, expected)
+
+
+cdef inline Py_ssize_t _number_end(Input s, Scanner scanner, Py_ssize_t pos,
+                                   Py_ssize_t end, bint reached_end):
+    # a number cut off at the end of *s* may continue in more input
+    if reached_end and s.partial:
+        return EOS
+    if end == NOMATCH:
+        return _fail(s, scanner, pos)
+    return end
+
+
+cdef object _number_value(Input s, Py_ssize_t pos, Py_ssize_t end, int real):
+    # the number spelled by s[pos:end] as a float if *real* is 1, an
+    # int if it is 0, or as spelled if it is -1
+    cdef Text t = s.view()
+    cdef char small[NUMBER_BUFFER]
+    cdef char *buf = small
+    cdef Py_ssize_t i, n = end - pos
+    cdef unsigned long long value = 0  # wraps harmlessly for floats
+    cdef Py_UCS4 c
+    if n >= NUMBER_BUFFER:
+        buf = <char *>PyMem_Malloc(n + 1)
+        if buf == NULL:
+            raise MemoryError()
+    try:
+        for i in range(n):
+            c = _read(t.kind, t.data, pos + i)
+            buf[i] = <char>c
+            if u'0' <= c <= u'9':
+                value = value * 10 + (<int>c - 48)
+            elif c != u'-' and c != u'+' and real < 0:
+                real = 1  # a decimal point or exponent
+        buf[n] = 0
+        if real > 0:
+            return PyOS_string_to_double(buf, NULL, NULL)
+        elif n > 18:  # may not fit in a long long
+            return PyLong_FromString(buf, NULL, 10)
+        elif buf[0] == b'-':
+            return -<long long>value
+        return <long long>value
+    finally:
+        if buf != small:
+            PyMem_Free(buf)
+
+
+cdef object _unescape(Input s, Py_ssize_t pos, Py_ssize_t end):
+    # s[pos:end] with JSON-style escapes decoded; invalid escapes are
+    # kept as they are. The result is a str, or bytes for byte input
+    # (with the decoded characters encoded as UTF-8).
+    cdef Text t = s.view()
+    cdef Py_ssize_t i, n = 0, size
+    cdef Py_UCS4 c, d
+    cdef Py_UCS4 *chars = NULL
+    cdef unsigned char *octets = NULL
+    if _find(&t, u'\\', pos, end) < 0:
+        if s.is_text:
+            return s.slice(pos, end)
+        return bytes(s.slice(pos, end))
+    size = end - pos + 1
+    if s.is_text:
+        chars = <Py_UCS4 *>PyMem_Malloc(size * sizeof(Py_UCS4))
+    else:
+        octets = <unsigned char *>PyMem_Malloc(size)
+    if chars == NULL and octets == NULL:
+        raise MemoryError()
+    try:
+        while pos < end:
+            c = _read(t.kind, t.data, pos)
+            i = 0
+            if c == u'\\':
+                i = _escape(&t, pos, end, &d)
+            if i == 0:
+                i = 1
+                if chars != NULL:
+                    chars[n] = c
+                else:
+                    octets[n] = <unsigned char>c
+                n += 1
+            elif chars != NULL:
+                chars[n] = d
+                n += 1
             else:
-                numdigits = _scan_digits(s, pos+1)
-                if numdigits > 0:
-                    return numdigits + 1
-    except IndexError:
+                n += _utf8(d, octets + n)
+            pos += i
+        if chars != NULL:
+            return PyUnicode_FromKindAndData(4, chars, n)
+        return PyBytes_FromStringAndSize(<char *>octets, n)
+    finally:
+        PyMem_Free(chars)
+        PyMem_Free(octets)
+
+
+cdef inline int _utf8(unsigned int c, unsigned char *out) noexcept nogil:
+    # write *c* to *out* as UTF-8 (lone surrogates included) and return
+    # the number of bytes written; an escape is never shorter
+    if c < 0x80:
+        out[0] = <unsigned char>c
+        return 1
+    elif c < 0x800:
+        out[0] = <unsigned char>(0xC0 | (c >> 6))
+        out[1] = <unsigned char>(0x80 | (c & 0x3F))
+        return 2
+    elif c < 0x10000:
+        out[0] = <unsigned char>(0xE0 | (c >> 12))
+        out[1] = <unsigned char>(0x80 | ((c >> 6) & 0x3F))
+        out[2] = <unsigned char>(0x80 | (c & 0x3F))
+        return 3
+    out[0] = <unsigned char>(0xF0 | (c >> 18))
+    out[1] = <unsigned char>(0x80 | ((c >> 12) & 0x3F))
+    out[2] = <unsigned char>(0x80 | ((c >> 6) & 0x3F))
+    out[3] = <unsigned char>(0x80 | (c & 0x3F))
+    return 4
+
+
+cdef inline Text _text(unicode x) noexcept:
+    # a view of *x*, which must outlive it
+    cdef Text t
+    t.kind = PyUnicode_KIND(x)
+    t.data = PyUnicode_DATA(x)
+    t.length = len(x)
+    t.reached_end = False
+    return t
+
+
+# scanning kernels; these only read the characters of a Text
+
+cdef inline Py_UCS4 _char(Text *t, Py_ssize_t pos) noexcept nogil:
+    # the character at *pos*, or 0 at (or past) the end of *t*
+    if pos >= t.length:
+        t.reached_end = True
+        return 0
+    return _read(t.kind, t.data, pos)
+
+
+cdef inline bint _startswith(Text *t, Text *x, Py_ssize_t pos,
+                             Py_ssize_t end) noexcept nogil:
+    # True if t[pos:end] == x[:end-pos]; *end* must not exceed the
+    # length of t
+    cdef Py_ssize_t i, n = end - pos
+    if n < 0:
+        return False
+    if t.kind == x.kind:
+        return memcmp(<char *>t.data + pos * t.kind, x.data, n * t.kind) == 0
+    for i in range(n):
+        if (_read(t.kind, t.data, pos + i)
+                != _read(x.kind, x.data, i)):
+            return False
+    return True
+
+
+cdef inline bint _contains(Text *x, Py_UCS4 c) noexcept nogil:
+    cdef Py_ssize_t i
+    for i in range(x.length):
+        if _read(x.kind, x.data, i) == c:
+            return True
+    return False
+
+
+cdef Py_ssize_t _scan_spacing(Text *t, Py_ssize_t pos, Text *ws,
+                              Py_ssize_t stop) noexcept nogil:
+    # the end of the characters in *ws* from pos, or *stop* if reached
+    if stop > t.length:
+        stop = t.length
+    while pos < stop and _contains(ws, _read(t.kind, t.data, pos)):
+        pos += 1
+    return pos
+
+
+cdef Py_ssize_t _scan_integer(Text *t, Py_ssize_t pos) noexcept nogil:
+    # [-+]? \d+
+    cdef Py_ssize_t numdigits
+    if _char(t, pos) in u'-+':
+        pos += 1
+    numdigits = _scan_digits(t, pos)
+    if numdigits == 0:
+        return NOMATCH
+    return pos + numdigits
+
+
+cdef Py_ssize_t _scan_float(Text *t, Py_ssize_t pos) noexcept nogil:
+    # one of:
+    #   [-+]? \d+\.\d* ([eE][-+]?\d+)?
+    #   [-+]? \.\d+ ([eE][-+]?\d+)?
+    #   [-+]? \d+ [eE][-+]?\d+
+    # note that bare integers (e.g. 1, -1, etc.) are not accepted
+    cdef Py_ssize_t dpos
+
+    if _char(t, pos) in u'-+':  # [-+]?
+        pos += 1
+
+    if _char(t, pos) == u'.':  # \.\d+ ([eE][-+]?\d+)?
+        dpos = _scan_digits(t, pos+1)
+        if dpos == 0:
+            return NOMATCH
+        pos += dpos + 1
+        pos += _scan_exponent(t, pos)
+
+    else:  # other two patterns begin with \d+
+        dpos = _scan_digits(t, pos)
+        if dpos == 0:
+            return NOMATCH
+        pos += dpos
+
+        if _char(t, pos) == u'.':  # \d+\.\d* ([eE][-+]?\d+)?
+            pos += 1
+            pos += _scan_digits(t, pos)
+            pos += _scan_exponent(t, pos)
+
+        else:  # \d+ [eE][-+]?\d+
+            dpos = _scan_exponent(t, pos)
+            if dpos == 0:
+                return NOMATCH
+            pos += dpos
+    return pos
+
+
+cdef Py_ssize_t _scan_bounded(Text *t, Py_ssize_t *pos, Text *last,
+                              Py_ssize_t stop) noexcept nogil:
+    # the end of *last* after *pos, skipping backslash escapes, or
+    # NOMATCH if it does not start at or before *stop* (*pos is then
+    # where to resume); jumps between the next candidate for *last*
+    # and the next backslash
+    cdef Py_ssize_t i = pos[0], blen = last.length, end, esc
+    cdef Py_UCS4 c0
+    if stop > t.length - blen:
+        stop = t.length - blen
+    if blen == 0:
+        if i <= stop:
+            return i
+        return NOMATCH
+    c0 = _read(last.kind, last.data, 0)
+    end = _find(t, c0, i, stop + 1)
+    esc = _find(t, u'\\', i, stop + 1)
+    while end >= 0:
+        if esc < 0 or end <= esc:
+            if _startswith(t, last, end, end + blen):
+                return end + blen
+            if end != esc:
+                end = _find(t, c0, end + 1, stop + 1)
+                continue
+        # an escape before the next candidate (or *last* starts with a
+        # backslash and does not match there)
+        i = esc + 2
+        esc = _find(t, u'\\', i, stop + 1)
+        if end < i:
+            end = _find(t, c0, i, stop + 1)
+    while esc >= 0:
+        i = esc + 2
+        esc = _find(t, u'\\', i, stop + 1)
+    pos[0] = i if i > stop else stop + 1
+    return NOMATCH
+
+
+cdef inline Py_ssize_t _find(Text *t, Py_UCS4 c, Py_ssize_t pos,
+                             Py_ssize_t end) noexcept nogil:
+    # the index of the first *c* in t[pos:end], or -1
+    cdef const char *p
+    if pos >= end:
+        return -1
+    if t.kind == 1:
+        if c > 255:
+            return -1
+        p = <const char *>memchr(<char *>t.data + pos, <int>c, end - pos)
+        if p == NULL:
+            return -1
+        return p - <char *>t.data
+    while pos < end:
+        if _read(t.kind, t.data, pos) == c:
+            return pos
+        pos += 1
+    return -1
+
+
+cdef inline Py_ssize_t _escape(Text *t, Py_ssize_t pos, Py_ssize_t end,
+                               Py_UCS4 *c) noexcept nogil:
+    # decode the JSON-style escape at t[pos] (a backslash) into *c and
+    # return its length, or 0 if it is not a valid escape
+    cdef Py_UCS4 lo
+    if pos + 1 >= end:
+        return 0
+    c[0] = _read(t.kind, t.data, pos + 1)
+    if c[0] == u'"' or c[0] == u'\\' or c[0] == u'/':
         pass
+    elif c[0] == u'b':
+        c[0] = u'\b'
+    elif c[0] == u'f':
+        c[0] = u'\f'
+    elif c[0] == u'n':
+        c[0] = u'\n'
+    elif c[0] == u'r':
+        c[0] = u'\r'
+    elif c[0] == u't':
+        c[0] = u'\t'
+    elif c[0] == u'u' and _hex4(t, pos + 2, end, c):
+        if (0xD800 <= c[0] < 0xDC00 and pos + 12 <= end
+                and _read(t.kind, t.data, pos + 6) == u'\\'
+                and _read(t.kind, t.data, pos + 7) == u'u'
+                and _hex4(t, pos + 8, end, &lo)
+                and 0xDC00 <= lo < 0xE000):
+            c[0] = <Py_UCS4>(0x10000 + ((<int>c[0] - 0xD800) << 10)
+                             + (<int>lo - 0xDC00))
+            return 12
+        return 6
+    else:
+        return 0
+    return 2
+
+
+cdef inline bint _hex4(Text *t, Py_ssize_t pos, Py_ssize_t end,
+                       Py_UCS4 *c) noexcept nogil:
+    # read four hex digits at t[pos] into *c
+    cdef Py_UCS4 d
+    cdef int digit, value = 0
+    cdef Py_ssize_t i
+    if pos + 4 > end:
+        return False
+    for i in range(pos, pos + 4):
+        d = _read(t.kind, t.data, i)
+        if u'0' <= d <= u'9':
+            digit = <int>d - 48
+        elif u'a' <= d <= u'f':
+            digit = <int>d - 87
+        elif u'A' <= d <= u'F':
+            digit = <int>d - 55
+        else:
+            return False
+        value = value * 16 + digit
+    c[0] = <Py_UCS4>value
+    return True
+
+
+cdef inline Py_ssize_t _scan_digits(Text *t, Py_ssize_t pos) noexcept nogil:
+    cdef int kind = t.kind
+    cdef void *data = t.data
+    cdef Py_ssize_t n = t.length
+    cdef Py_UCS4 c
+    cdef Py_ssize_t i = 0
+    while pos + i < n:
+        c = _read(kind, data, pos + i)
+        if not u'0' <= c <= u'9':
+            return i
+        i += 1
+    t.reached_end = True
+    return i
+
+
+cdef inline Py_ssize_t _scan_exponent(Text *t, Py_ssize_t pos) noexcept nogil:
+    cdef Py_ssize_t numdigits = 0
+    if _char(t, pos) in u'eE':
+        if _char(t, pos+1) in u'-+':
+            numdigits = _scan_digits(t, pos+2)
+            if numdigits > 0:
+                return numdigits + 2
+        else:
+            numdigits = _scan_digits(t, pos+1)
+            if numdigits > 0:
+                return numdigits + 1
     return 0
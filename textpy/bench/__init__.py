@@ -0,0 +1,412 @@
+'''
+Benchmarks over generated corpora.
+
+Run `python -m textpy.bench` to time scanning and matching of the
+corpora in `textpy.bench.corpora` at several sizes and nesting depths
+with both the `c_` and `py_` scanner families. Each measurement is
+preceded by warm-up calls and reports the throughput (in MB/s of UTF-8
+input at the median time) and per-call latency percentiles. With
+`--memory`, it instead reports the memory blocks and bytes kept by a
+call's result, the peak traced by `tracemalloc`, and the growth of the
+peak resident set size, for `scan`, `match`, and `match(trace=True)`.
+Results can be written as JSON and compared with those of an earlier
+run, and each timing row records whether both families produced the
+same value.
+'''
+
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None  # e.g., on Windows
+
+from textpy import scanners
+from textpy.grammars import Grammar
+from textpy.bench.corpora import CORPORA
+
+
+SIZES = (1 << 10, 1 << 16, 1 << 20)
+DEPTHS = (1, 16)
+MODES = ('scan', 'match')
+MEMORY_MODES = ('scan', 'match', 'trace')
+PERCENTILES = (50, 90, 99)
+
+
+def families():
+    '''
+    Return the prefixes of the scanner families that are available.
+    '''
+    if scanners.c_Scanner is None:
+        return ('py',)
+    return ('c', 'py')
+
+
+def family(obj, prefix):
+    '''
+    Return a copy of the scanner (or Grammar) *obj* built from the
+    scanner family named by *prefix* (`'c'` or `'py'`).
+
+    Scanners are rebuilt from the same arguments they are pickled
+    with, so nodes shared in *obj*, including nonterminals and the
+    rules they refer to, are shared in the copy. Sinks and trivia
+    links are not copied.
+    '''
+    return _family(obj, prefix, {})
+
+
+def _family(obj, prefix, memo):
+    key = id(obj)
+    if key in memo:
+        return memo[key]
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_family(x, prefix, memo) for x in obj)
+    if isinstance(obj, dict):
+        new = memo[key] = type(obj)()
+        for k, v in obj.items():
+            new[k] = _family(v, prefix, memo)
+        return new
+    if isinstance(obj, Grammar):
+        cls = type(obj)
+    else:
+        cls = _counterpart(type(obj), prefix)
+        if cls is None:
+            return obj  # strings, actions, and so on
+    rv = obj.__reduce__()
+    args = _family(rv[1], prefix, memo)
+    new = memo[key] = cls(*args)
+    if len(rv) > 2 and rv[2] is not None:
+        new.__setstate__(_family(rv[2], prefix, memo))
+    return new
+
+
+def _counterpart(cls, prefix):
+    # the class of the given family that corresponds to a scanner class
+    if cls.__module__ == 'textpy._scanners':
+        name = cls.__name__
+    elif cls.__module__ == 'textpy.scanners' and \
+            cls.__name__.startswith('py_'):
+        name = cls.__name__[3:]
+    else:
+        return None
+    return getattr(scanners, prefix + '_' + name, None)
+
+
+def measure(func, arg, repeat=7, warmup=2):
+    '''
+    Return a list of the times in seconds of *repeat* calls of
+    `func(arg)` made after *warmup* untimed calls. The garbage
+    collector is disabled while timing.
+    '''
+    for _ in range(warmup):
+        func(arg)
+    times = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(arg)
+            times.append(time.perf_counter() - start)
+    finally:
+        if enabled:
+            gc.enable()
+    return times
+
+
+def percentile(times, p):
+    '''
+    Return the *p*-th percentile of *times* by the nearest rank.
+    '''
+    times = sorted(times)
+    rank = max(1, -(-len(times) * p // 100))  # ceiling
+    return times[min(rank, len(times)) - 1]
+
+
+def call(parser, mode):
+    '''
+    Return the function making a call of *mode* (`'scan'`, `'match'`,
+    or `'trace'` for `match(..., trace=True)`) with *parser*.
+    '''
+    if mode == 'trace':
+        return lambda s: parser.match(s, trace=True)
+    return getattr(parser, mode)
+
+
+def measure_memory(func, arg):
+    '''
+    Return a dictionary of the memory used by a call of `func(arg)`,
+    made after one untimed call with the garbage collector disabled:
+
+    - `blocks`: memory blocks allocated by the call and still held
+      while its result is alive
+    - `retained`: the bytes in those blocks
+    - `peak`: the peak traced memory during the call, in bytes above
+      the memory traced before it
+    - `rss`: the growth of the peak resident set size, in bytes, of a
+      child process making the same call, or `None` if processes
+      cannot be forked
+
+    Only memory allocated by Python's allocators is traced, which
+    includes that of the compiled scanners.
+    '''
+    func(arg)
+    gc.collect()
+    enabled = gc.isenabled()
+    gc.disable()
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        result = func(arg)
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+        if enabled:
+            gc.enable()
+    # the snapshots are traced too; leave them out
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    diff = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), 'filename')
+    del result
+    return {
+        'blocks': sum(stat.count_diff for stat in diff),
+        'retained': current - base,
+        'peak': peak - base,
+        'rss': _rss_growth(func, arg),
+    }
+
+
+def _maxrss():
+    # the peak resident set size of this process in bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _rss_growth(func, arg):
+    # measured in a fork, whose peak starts at this process's size, so
+    # earlier (larger) calls do not hide the peak of this one
+    if resource is None or not hasattr(os, 'fork'):
+        return None
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            start = _maxrss()
+            func(arg)
+            os.write(w, str(_maxrss() - start).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return int(data) if data else None
+
+
+def run(corpora=None, sizes=SIZES, depths=DEPTHS, prefixes=None,
+        modes=MODES, repeat=7, warmup=2, seed=0, report=None):
+    '''
+    Run the benchmarks and return a list of result rows (dictionaries).
+
+    *corpora* are names from `textpy.bench.corpora.CORPORA` (default:
+    all) and *prefixes* are scanner families (default: all that are
+    available). Corpora that do not nest are only run at the first of
+    *depths*. If *report* is given, it is called with each row as soon
+    as it is measured.
+    '''
+    if corpora is None:
+        corpora = list(CORPORA)
+    if prefixes is None:
+        prefixes = families()
+    rows = []
+    for name in corpora:
+        generate, make_parser, nested = CORPORA[name]
+        parser = make_parser()
+        parsers = dict((prefix, family(parser, prefix))
+                       for prefix in prefixes)
+        for depth in (depths if nested else depths[:1]):
+            for size in sizes:
+                doc = generate(size, depth, seed)
+                nbytes = len(doc.encode('utf-8'))
+                values = []
+                for prefix in prefixes:
+                    m = parsers[prefix].match(doc)
+                    values.append(None if m is None else (m.span(), m.value))
+                parity = all(v == values[0] for v in values)
+                for prefix in prefixes:
+                    p = parsers[prefix]
+                    for mode in modes:
+                        times = measure(call(p, mode), doc,
+                                        repeat=repeat, warmup=warmup)
+                        row = _row(name, size, depth, nbytes, prefix, mode,
+                                   times, parity)
+                        rows.append(row)
+                        if report is not None:
+                            report(row)
+    return rows
+
+
+def _row(name, size, depth, nbytes, prefix, mode, times, parity):
+    row = {
+        'corpus': name,
+        'size': size,
+        'depth': depth,
+        'bytes': nbytes,
+        'family': prefix,
+        'mode': mode,
+        'repeat': len(times),
+        'min': min(times),
+        'mean': sum(times) / len(times),
+    }
+    for p in PERCENTILES:
+        row['p{}'.format(p)] = percentile(times, p)
+    row['mb_per_s'] = nbytes / row['p50'] / 1e6
+    row['parity'] = parity
+    return row
+
+
+def run_memory(corpora=None, sizes=SIZES, depths=DEPTHS, prefixes=None,
+               modes=MEMORY_MODES, seed=0, report=None):
+    '''
+    Measure the memory used by the benchmarks (see `measure_memory()`)
+    and return a list of result rows, in the manner of `run()`.
+    '''
+    if corpora is None:
+        corpora = list(CORPORA)
+    if prefixes is None:
+        prefixes = families()
+    rows = []
+    for name in corpora:
+        generate, make_parser, nested = CORPORA[name]
+        parser = make_parser()
+        for prefix in prefixes:
+            p = family(parser, prefix)
+            for depth in (depths if nested else depths[:1]):
+                for size in sizes:
+                    doc = generate(size, depth, seed)
+                    for mode in modes:
+                        row = {
+                            'corpus': name,
+                            'size': size,
+                            'depth': depth,
+                            'bytes': len(doc.encode('utf-8')),
+                            'family': prefix,
+                            'mode': mode,
+                        }
+                        row.update(measure_memory(call(p, mode), doc))
+                        rows.append(row)
+                        if report is not None:
+                            report(row)
+    return rows
+
+
+def environment():
+    '''
+    Return a dictionary describing the interpreter and platform.
+    '''
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'compiled': scanners.c_Scanner is not None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def dump(rows, f, label=None, memory=()):
+    '''
+    Write the timing *rows* and *memory* rows to the file object *f*
+    as JSON, along with the environment (see `environment()`) and an
+    optional *label* (e.g., a release name).
+    '''
+    json.dump({'label': label, 'environment': environment(),
+               'results': list(rows), 'memory': list(memory)},
+              f, indent=1, sort_keys=True)
+    f.write('\n')
+
+
+def load(f, memory=False):
+    '''
+    Return the timing rows (or the memory rows, if *memory* is `True`)
+    written to the file object *f* by `dump()`.
+    '''
+    data = json.load(f)
+    return data.get('memory', []) if memory else data['results']
+
+
+def _key(row):
+    return (row['corpus'], row['size'], row['depth'], row['family'],
+            row['mode'])
+
+
+def compare(old, new, stat='p50'):
+    '''
+    Return a list of `(row, ratio)` pairs for the rows in *new* that
+    were also measured in *old*, where *ratio* is the old value of
+    *stat* divided by the new one (so values above 1 are improvements,
+    e.g., speedups for `'p50'` or savings for `'peak'`), or `None` if
+    either value is zero or missing.
+    '''
+    before = dict((_key(row), row) for row in old)
+    pairs = []
+    for row in new:
+        prev = before.get(_key(row))
+        if prev is not None:
+            a, b = prev.get(stat), row.get(stat)
+            pairs.append((row, a / b if a and b else None))
+    return pairs
+
+
+_HEADER = '{:<8} {:>5} {:>9} {:<6} {:<5} {:>9} {:>10} {:>10} {:>10}'
+_LINE = '{:<8} {:>5} {:>9} {:<6} {:<5} {:>9.2f} {:>10.3f} {:>10.3f} {:>10.3f}'
+
+
+def header():
+    '''Return the column headings for `line()`.'''
+    return _HEADER.format('corpus', 'depth', 'bytes', 'family', 'mode',
+                          'MB/s', 'p50 ms', 'p90 ms', 'p99 ms')
+
+
+_MEMORY_HEADER = '{:<8} {:>5} {:>9} {:<6} {:<5} {:>9} {:>12} {:>12} {:>12}'
+_MEMORY_LINE = '{:<8} {:>5} {:>9} {:<6} {:<5} {:>9} {:>12} {:>12} {:>12}'
+
+
+def memory_header():
+    '''Return the column headings for `memory_line()`.'''
+    return _MEMORY_HEADER.format('corpus', 'depth', 'bytes', 'family',
+                                 'mode', 'blocks', 'retained kB',
+                                 'peak kB', 'rss kB')
+
+
+def memory_line(row):
+    '''Return a memory row formatted as a line of text.'''
+    kb = lambda n: '-' if n is None else '{:.1f}'.format(n / 1024)
+    return _MEMORY_LINE.format(row['corpus'], row['depth'], row['bytes'],
+                               row['family'], row['mode'], row['blocks'],
+                               kb(row['retained']), kb(row['peak']),
+                               kb(row['rss']))
+
+
+def line(row):
+    '''Return a result row formatted as a line of text.'''
+    text = _LINE.format(row['corpus'], row['depth'], row['bytes'],
+                        row['family'], row['mode'], row['mb_per_s'],
+                        row['p50'] * 1e3, row['p90'] * 1e3,
+                        row['p99'] * 1e3)
+    if not row['parity']:
+        text += '  (values differ between families)'
+    return text
@@ -0,0 +1,95 @@
+'''
+Command-line interface for the benchmarks (see `textpy.bench`).
+'''
+
+import argparse
+import sys
+
+from textpy import bench
+from textpy.bench.corpora import CORPORA
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m textpy.bench',
+        description='Time textpy scanners on generated corpora, or'
+                    ' measure their memory use.'
+    )
+    parser.add_argument('--corpus', action='append', choices=list(CORPORA),
+                        help='corpus to run (repeatable; default: all)')
+    parser.add_argument('--family', action='append', choices=['c', 'py'],
+                        help='scanner family (repeatable; default: all)')
+    parser.add_argument('--mode', action='append',
+                        choices=bench.MEMORY_MODES,
+                        help='scan, match, or trace for match(trace=True)'
+                             ' (repeatable; default: scan and match, and'
+                             ' also trace with --memory)')
+    parser.add_argument('--size', action='append', type=int,
+                        help='corpus size in characters (repeatable)')
+    parser.add_argument('--depth', action='append', type=int,
+                        help='nesting depth (repeatable)')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='timed calls per measurement (default: 7)')
+    parser.add_argument('--warmup', type=int, default=2,
+                        help='untimed calls first (default: 2)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the corpus generators')
+    parser.add_argument('--memory', action='store_true',
+                        help='measure memory instead of time')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run small corpora, a few times')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the results to FILE as JSON')
+    parser.add_argument('--label', help='label stored with the results')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare median times (or peak memory, with'
+                             ' --memory) with earlier results')
+    args = parser.parse_args(argv)
+
+    sizes = tuple(args.size or bench.SIZES)
+    depths = tuple(args.depth or bench.DEPTHS)
+    repeat, warmup = args.repeat, args.warmup
+    if args.quick:
+        sizes = tuple(size for size in sizes if size <= 1 << 16) or sizes
+        repeat, warmup = min(repeat, 3), min(warmup, 1)
+    prefixes = args.family or bench.families()
+    if 'c' in prefixes and 'c' not in bench.families():
+        parser.error('the compiled scanners are not available')
+
+    if args.memory:
+        header, line, stat = bench.memory_header, bench.memory_line, 'peak'
+    else:
+        header, line, stat = bench.header, bench.line, 'p50'
+    print(header())
+    report = lambda row: print(line(row), flush=True)
+    if args.memory:
+        rows = bench.run_memory(corpora=args.corpus, sizes=sizes,
+                                depths=depths, prefixes=prefixes,
+                                modes=args.mode or bench.MEMORY_MODES,
+                                seed=args.seed, report=report)
+    else:
+        rows = bench.run(corpora=args.corpus, sizes=sizes, depths=depths,
+                         prefixes=prefixes, modes=args.mode or bench.MODES,
+                         repeat=repeat, warmup=warmup, seed=args.seed,
+                         report=report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            if args.memory:
+                bench.dump([], f, label=args.label, memory=rows)
+            else:
+                bench.dump(rows, f, label=args.label)
+    if args.compare:
+        with open(args.compare) as f:
+            old = bench.load(f, memory=args.memory)
+        print()
+        print(header() + ' {:>8}'.format('saving' if args.memory
+                                          else 'speedup'))
+        for row, ratio in bench.compare(old, rows, stat=stat):
+            print(line(row) + (' {:>8}'.format('-') if ratio is None
+                               else ' {:>8.2f}'.format(ratio)))
+    return 0 if all(row.get('parity', True) for row in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+'''
+Generated corpora for benchmarking.
+
+Each corpus has a generator, `generate(size, depth, seed)`, returning a
+document of at least *size* characters built from a seeded random
+number generator (so runs with the same arguments see the same text),
+and a parser that matches whole documents. Only the JSON and grammar
+corpora nest; the others ignore *depth*.
+'''
+
+import json
+import random
+from collections import OrderedDict
+
+from textpy import io
+from textpy.actions import constant
+from textpy.grammars import Grammar
+from textpy.scanners import BoundedString, Number, Spacing
+
+
+_WORDS = ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta',
+          'theta', 'iota', 'kappa', 'lambda', 'mu')
+_LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')
+
+
+def _fill(size, make):
+    # join the lines made by make(i) until there are size characters
+    lines = []
+    n = 0
+    while n < size:
+        line = make(len(lines))
+        lines.append(line)
+        n += len(line)
+    return ''.join(lines)
+
+
+# JSON
+
+def json_document(size, depth=1, seed=0):
+    '''
+    Return a JSON array of records, each nested *depth* levels deep.
+    '''
+    rng = random.Random(seed)
+
+    def record(i):
+        value = {
+            'id': i,
+            'name': '{}-{}'.format(rng.choice(_WORDS), i),
+            'score': round(rng.uniform(-1000, 1000), 3),
+            'ratio': rng.random() * 10 ** rng.randint(-20, 20),
+            'active': rng.random() < 0.5,
+            'note': rng.choice([None, 'tab\tand "quotes"', 'café']),
+            'tags': rng.sample(_WORDS, rng.randint(0, 4)),
+        }
+        for level in range(1, depth):
+            value = {'child': value} if level % 2 else [level, value]
+        return json.dumps(value) + ',\n'
+
+    return '[' + _fill(size, record).rstrip(',\n') + ']'
+
+
+def json_parser():
+    g = Grammar('''
+        Start    = Object | Array
+        Object   = "{" Spacing
+                   ((DQString) Spacing ":" Spacing (Value)){:Comma}
+                   Spacing "}"
+        Array    = "[" Spacing (Value){:Comma} Spacing "]"
+        Value    = Object | Array | DQString
+                 | TrueVal | FalseVal | NullVal | Number
+        TrueVal  = "true"
+        FalseVal = "false"
+        NullVal  = "null"
+        Comma    = Spacing "," Spacing
+    ''')
+    g['Number'] = Number()
+    g['DQString'] = BoundedString('"', '"', decode=True)
+    g['Spacing'] = Spacing()
+    g.update_actions(
+        Object=dict,
+        Array=list,
+        TrueVal=constant(True),
+        FalseVal=constant(False),
+        NullVal=constant(None)
+    )
+    return g
+
+
+# CSV-like rows
+
+def csv_document(size, depth=1, seed=0):
+    '''
+    Return comma-separated rows with bare, quoted, and empty fields.
+    '''
+    rng = random.Random(seed)
+
+    def row(i):
+        return '{},{},"{}, {}",{:.2f},,{}\n'.format(
+            i, rng.choice(_WORDS), rng.choice(_WORDS), rng.choice(_WORDS),
+            rng.uniform(0, 100), rng.randint(0, 1 << 30)
+        )
+
+    return _fill(size, row)
+
+
+def csv_parser():
+    return Grammar('''
+        Start  = (Row)*
+        Row    = (Field){:","} "\n"
+        Field  = Quoted | Bare
+        Quoted = /"[^"]*"/
+        Bare   = [^,\n"]*
+    ''')
+
+
+# log lines
+
+def log_document(size, depth=1, seed=0):
+    '''
+    Return timestamped log lines with a level, a source, and a message.
+    '''
+    rng = random.Random(seed)
+
+    def line(i):
+        return '2026-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}.{:03d}Z {} [{}-{}] ' \
+            '{} {} id={}\n'.format(
+                rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+                rng.randint(0, 59), rng.randint(0, 59), rng.randint(0, 999),
+                rng.choice(_LEVELS), rng.choice(_WORDS), rng.randint(0, 9),
+                rng.choice(_WORDS), ' '.join(rng.sample(_WORDS, 5)), i
+            )
+
+    return _fill(size, line)
+
+
+def log_parser():
+    return Grammar('''
+        Start   = (Line)*
+        Line    = (Stamp) " " (Level) " [" (Source) "] " (Message) "\n"
+        Stamp   = /[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9:]{8}[.][0-9]{3}Z/
+        Level   = "DEBUG" | "INFO" | "WARNING" | "ERROR"
+        Source  = [-a-z0-9.]+
+        Message = [^\n]*
+    ''')
+
+
+# the grammar definition language (see textpy.io)
+
+def grammar_document(size, depth=1, seed=0):
+    '''
+    Return a grammar definition whose rules nest groups *depth* deep.
+    '''
+    rng = random.Random(seed)
+
+    def term(i, depth, nest=False):
+        r = rng.random()
+        if depth > 1 and (nest or r < 0.2):
+            t = '(' + choice(i, depth - 1, nest) + ')'
+        elif r < 0.4:
+            t = '"{}"'.format(rng.choice(_WORDS))
+        elif r < 0.55:
+            t = '[a-{}0-9_]'.format(chr(ord('a') + rng.randrange(26)))
+        elif r < 0.65:
+            t = '/[0-9]+(\\.[0-9]*)?/'
+        elif r < 0.7:
+            t = '.'
+        else:
+            t = 'R{}'.format(rng.randrange(max(i, 1)))
+        prefix = rng.choice(('', '', '', '', '!', '&'))
+        suffix = rng.choice(('', '', '', '*', '+', '?', '{2}', '{1,3}',
+                             '{:","}', '{1,2:(",")}'))
+        return prefix + t + suffix
+
+    def choice(i, depth, nest=False):
+        return ' | '.join(
+            ' '.join(term(i, depth, nest and a == s == 0)
+                     for s in range(rng.randint(1, 3)))
+            for a in range(rng.randint(1, 3))
+        )
+
+    def rule(i):
+        return 'R{} = {}\n'.format(i, choice(i, depth, True))
+
+    return _fill(size, rule).rstrip('\n')
+
+
+def grammar_parser():
+    return io.GrammarReader
+
+
+# name: (generator, parser factory, whether depth matters)
+CORPORA = OrderedDict([
+    ('json', (json_document, json_parser, True)),
+    ('csv', (csv_document, csv_parser, False)),
+    ('log', (log_document, log_parser, False)),
+    ('grammar', (grammar_document, grammar_parser, True)),
+])
@@ -0,0 +1,52 @@
+'''
+Exceptions raised by scanners and grammars.
+'''
+
+
+class ParseError(ValueError):
+    '''
+    Raised by `match(s, strict=True)` when there is no match.
+
+    *pos* is the farthest offset where a terminal scanner failed (or
+    where matching started if none did) and *expected* is a sorted
+    tuple of the terminals that failed there. *lineno* and *colno*
+    (both starting at 1) locate *pos* in the input.
+    '''
+    def __init__(self, pos, expected=(), lineno=1, colno=None):
+        self.pos = pos
+        self.expected = tuple(expected)
+        self.lineno = lineno
+        self.colno = pos + 1 if colno is None else colno
+        msg = 'No match at line {}, column {} (offset {})'.format(
+            self.lineno, self.colno, pos
+        )
+        if self.expected:
+            msg += '; expected ' + ', '.join(self.expected)
+        ValueError.__init__(self, msg)
+
+    def __reduce__(self):
+        return (type(self), (self.pos, self.expected, self.lineno, self.colno))
+
+
+def _parse_error(s, pos, expected):
+    # the ParseError for a failure at *pos* in *s* where the scanners
+    # in *expected* failed
+    expected = sorted(set(map(str, expected)))
+    if not isinstance(s, (str, bytes, bytearray)):
+        # count in chunks so large buffers (e.g., mmaps) are not copied
+        view = memoryview(s).cast('B')
+        lineno, start = 1, 0
+        for i in range(0, pos, _CHUNK):
+            chunk = bytes(view[i:min(i + _CHUNK, pos)])
+            n = chunk.count(b'\n')
+            if n:
+                lineno += n
+                start = i + chunk.rfind(b'\n') + 1
+        return ParseError(pos, expected, lineno, pos - start + 1)
+    newline = u'\n' if isinstance(s, str) else b'\n'
+    lineno = s.count(newline, 0, pos) + 1
+    colno = pos - (s.rfind(newline, 0, pos) + 1) + 1
+    return ParseError(pos, expected, lineno, colno)
+
+
+_CHUNK = 1 << 20
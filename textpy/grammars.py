@@ -1,52 +1,584 @@
 
+import hashlib
+import importlib
+import multiprocessing
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from io import BytesIO
+
 from textpy.scanners import *
+from textpy.scanners import EOS
 from textpy import io
+from textpy import optimize
+from textpy import profiling
+from textpy import vm
+
+# scanners that skip trivia before them in rules that are not tokens
+_SKIPPING = ('Dot', 'CharacterClass', 'Literal', 'Regex', 'Spacing',
+             'Integer', 'Float', 'Number', 'BoundedString', 'Choice')
+# rules with at most this many scanner nodes are inlined by
+# Grammar.optimize() (larger ones only if referenced once)
+MAX_INLINE = 8
+# the grammars whose scanner nodes skip trivia as they set (see
+# Grammar._link_skip())
+_linked = weakref.WeakSet()
+# held while compiling, as grammars may share nodes and threads may
+# share a grammar before its first use
+_compile_lock = threading.RLock()
 # from textpy.scanners import Scanner, Nonterminal
 
+class GrammarCache(object):
+    """
+    Cache of the scanner trees built from grammar definitions.
+
+    Entries are pickled trees keyed by a hash of the definition. The
+    *maxsize* most recently used entries are kept in memory. If
+    *directory* is given, entries are also stored there, one file per
+    entry, so other processes can reuse them; as the files are
+    unpickled, the directory must not be writable by untrusted users.
+    """
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._entries = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the data stored for *key*, or `None`."""
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        elif self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        """Store the bytes *data* for *key*."""
+        self._remember(key, data)
+        if self.directory is not None:
+            # write to a temporary file first so concurrent readers
+            # never see a partial entry
+            try:
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """Empty the in-memory cache (files are kept)."""
+        self._entries.clear()
+
+    def _remember(self, key, data):
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+
 class Grammar(Scanner):
     GrammarReader = io.GrammarReader
-    def __init__(self, definition=None, actions=None, start='Start'):
+    # set to None to disable, or to a GrammarCache with a directory to
+    # share built grammars across processes
+    cache = GrammarCache()
+
+    def __init__(self, definition=None, actions=None, start='Start',
+                 skip=None, tokens=()):
         self._grm = {}
         self._description = {}
+        self._nonterminals = []
+        self._memo = None
+        self._compiled = False
+        self._dispatched = []
+        self._built = set()  # rules made from a definition
+        self._memoized = None
+        self._optimized = None
+        self._inlined = set()  # rules inlined by optimize()
+        self._skips = {}  # id(node) -> (node, skip) set by _link_skip()
         if definition is not None:
             self.read(definition)
         if actions is not None:
             self.update_actions(actions)
         self.start = start
+        self._trivia = skip
+        self._tokens = tuple(tokens)
 
     def __str__(self):
         return '\n'.join(n + ' = ' + str(r) for n, r in self._grm.items())
 
+    def __reduce__(self):
+        state = dict(self.__dict__)
+        state['_skips'] = {}
+        return (type(self), (), state)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compiled = False  # scanners do not pickle their links
+
     def __setitem__(self, identifier, scanner):
         if not isinstance(scanner, Scanner):
             raise TypeError('Values must be Scanner objects')
+        self._check_inlined([identifier])
         self._grm[identifier] = scanner
+        self._built.discard(identifier)
+        if self._compiled:
+            self._unlink()
+        for choice in self._dispatched:
+            choice.dispatch(None)
+        self._dispatched = []
 
     def __getitem__(self, identifier):
         return self._grm[identifier]
 
     def nonterminal(self, identifier):
-        return Nonterminal(self._grm, identifier)
+        nt = Nonterminal(self._grm, identifier)
+        self._nonterminals.append((identifier, nt))
+        return nt
+
+    def compile(self):
+        """
+        Check that every referenced rule is defined and bind each
+        nonterminal directly to its rule's scanner.
+
+        If the grammar has a *skip* scanner (or the name of a rule),
+        trivia matched by it is skipped before each terminal, except
+        inside the rules named in *tokens* and the *skip* rule itself;
+        a reference to a token rule skips trivia before the token
+        instead. Raise a ValueError naming the undefined rules, if
+        any, or if a scanner shared with another grammar would skip
+        other trivia than it does there. The grammar is compiled
+        automatically before the first scan or match and again after
+        any rule is redefined.
+        """
+        with _compile_lock:
+            return self._compile()
+
+    def _compile_once(self):
+        # compile on first use, once if several threads get here
+        with _compile_lock:
+            if not self._compiled:
+                self._compile()
+
+    def _compile(self):
+        undefined = set(
+            identifier for identifier, _ in self._nonterminals
+            if identifier not in self._grm
+        )
+        if self.start not in self._grm:
+            undefined.add(self.start)
+        if isinstance(self._trivia, str) and self._trivia not in self._grm:
+            undefined.add(self._trivia)
+        if undefined:
+            raise ValueError(
+                'Undefined rules: ' + ', '.join(sorted(undefined))
+            )
+        for _, nt in self._nonterminals:
+            nt.link()
+        self._link_skip()
+        self._compiled = True
+        return self
+
+    def _link_skip(self):
+        # give each node of each rule the trivia it skips; a node shared
+        # with another grammar must skip the same trivia in both
+        skip, tokens = self._trivia, set(self._tokens)
+        if isinstance(skip, str):
+            tokens.add(skip)
+            skip = self._grm[skip]
+        skips = {}
+        for identifier, scanner in self._grm.items():
+            token = skip is None or identifier in tokens
+            stack = [scanner]
+            while stack:
+                node = stack.pop()
+                if id(node) in skips:
+                    continue
+                stack.extend(optimize.children(node))
+                k = optimize.kind(node)
+                if token:
+                    want = None
+                elif k in _SKIPPING:
+                    want = skip
+                elif k == 'Nonterminal' and node._name in tokens:
+                    want = skip
+                else:
+                    want = None
+                skips[id(node)] = (node, want)
+        # each grammar holds the nodes in its _skips, so an id found
+        # there is the same node
+        for other in list(_linked):
+            if other is self:
+                continue
+            for key, (node, want) in other._skips.items():
+                entry = skips.get(key)
+                if entry is not None and entry[1] is not want:
+                    raise ValueError(
+                        'Scanner {!r} is shared with a grammar that '
+                        'skips other trivia'.format(str(node))
+                    )
+        for node, want in skips.values():
+            node.skip = want
+        self._skips = skips
+        _linked.add(self)
+
+    def _check_inlined(self, rules):
+        inlined = self._inlined.intersection(rules)
+        if inlined:
+            raise ValueError(
+                'Rules inlined by optimize(): ' + ', '.join(sorted(inlined))
+            )
+
+    def _unlink(self):
+        for _, nt in self._nonterminals:
+            nt.unlink()
+        self._skips = {}
+        self._compiled = False
+
+    def optimize(self, fuse=True, dispatch=True, rewrite=True):
+        """
+        Replace the rules of the grammar with equivalent, faster
+        scanner trees.
+
+        If *rewrite* is `True`, rules are simplified (see
+        `textpy.optimize.rewrite()`) and references to rules that are
+        small or referenced once are inlined, as long as the rules are
+        not recursive, have no action, and have a value that is not
+        collected; a grammar that skips trivia is not inlined.
+        Inlined rules cannot be redefined or given actions or sinks
+        afterwards, so do that first. If *fuse* is `True`, regular
+        subtrees are fused into single Regex scanners (see
+        `textpy.optimize.fuse()`). If *dispatch* is `True`, ordered
+        choices get first-character dispatch tables (see
+        `textpy.optimize.dispatch()`); redefining a rule discards the
+        tables. Return a dictionary reporting the changes; its
+        `'rewritten'` key lists `(rule, rewrite, subtree)` triples,
+        its `'fused'` key lists `(rule, subtree, pattern)` triples,
+        where *subtree* is the string form of the replaced subtree,
+        its `'dispatched'` key lists `(rule, choice)` pairs, and its
+        `'nodes'` key maps each rule to the number of scanner nodes
+        before and after optimizing. When the grammar skips trivia,
+        only token rules are fused.
+        """
+        report = {'rewritten': [], 'fused': [], 'dispatched': [],
+                  'nodes': {}}
+        if rewrite:
+            self.compile()
+        tokens = set(self._tokens)
+        if isinstance(self._trivia, str):
+            tokens.add(self._trivia)
+        refs = OrderedDict(
+            (identifier, _references(scanner))
+            for identifier, scanner in self._grm.items()
+        )
+        counts = {}
+        for names in refs.values():
+            for name in names:
+                counts[name] = counts.get(name, 0) + 1
+        rules, inline, inlined = {}, {}, set()
+        # rules are done before the rules referring to them, so the
+        # inlined scanners are already optimized
+        for identifier in _postorder(refs):
+            original = scanner = self._grm[identifier]
+            before = optimize.size(scanner)
+            if rewrite:
+                scanner, rewrites = optimize.rewrite(scanner, inline)
+                report['rewritten'].extend(
+                    (identifier, name, subtree)
+                    for name, subtree in rewrites
+                )
+                inlined.update(
+                    subtree for name, subtree in rewrites
+                    if name == 'inline'
+                )
+            if fuse and (self._trivia is None or identifier in tokens):
+                scanner, fused = optimize.fuse(scanner)
+                report['fused'].extend(
+                    (identifier, str(subtree), pattern)
+                    for subtree, pattern in fused
+                )
+            if (rewrite and self._trivia is None and
+                    original.action is None and not original.capturing and
+                    (before <= MAX_INLINE or
+                     counts.get(identifier) == 1) and
+                    not _recursive(refs, identifier)):
+                inline[identifier] = scanner
+            rules[identifier] = scanner
+            report['nodes'][identifier] = (before, optimize.size(scanner))
+        for identifier, scanner in rules.items():
+            if scanner is not self._grm[identifier]:
+                built = identifier in self._built
+                self._inlined.discard(identifier)
+                self[identifier] = scanner
+                if built:
+                    self._built.add(identifier)
+        self._inlined.update(inlined)
+        self._optimized = (fuse, dispatch, rewrite)
+        if dispatch:
+            self.compile()
+            for identifier, scanner in self._grm.items():
+                _, choices = optimize.dispatch(scanner)
+                report['dispatched'].extend(
+                    (identifier, str(choice)) for choice in choices
+                )
+                self._dispatched.extend(choices)
+        return report
+
+    def memoize(self, rules=None, window=-1):
+        """
+        Enable packrat memoization of the nonterminals in the grammar.
+
+        Only references to the rules named in *rules* are memoized, or
+        all of them if *rules* is `None`; use an empty list to disable
+        memoization. A non-negative *window* bounds the memo table to
+        entries within that many characters of the parse position.
+        Return the Memo table, whose *hits* and *misses* attributes
+        count lookups.
+        """
+        memo = Memo(window=window)
+        if rules is not None:
+            rules = set(rules)
+        for identifier, nt in self._nonterminals:
+            if rules is None or identifier in rules:
+                nt.memo = memo
+            else:
+                nt.memo = None
+        self._memo = memo if rules is None or rules else None
+        self._memoized = (rules, window)
+        return memo
+
+    def emit(self, rules, sink=None):
+        """
+        Pass the value of each match of a reference to the rules named
+        in *rules* to *sink* instead of collecting it, so values can be
+        consumed while a long input is matched. Use a *sink* of `None`
+        to collect them again.
+
+        A sink is called whenever a reference matches, including in
+        alternatives that are later abandoned, and only for references
+        whose values are used (e.g., inside a Group or a Repeat). The
+        start rule itself is not a reference. Sinks are not pickled.
+        """
+        rules = set(rules)
+        self._check_inlined(rules)
+        for identifier, nt in self._nonterminals:
+            if identifier in rules:
+                nt.sink = sink
+
+    def machine(self):
+        """
+        Return a Machine running the start rule compiled into a program
+        for a parsing machine (see `textpy.vm`). It scans, traces, and
+        matches like the grammar but keeps its backtracking state on a
+        heap-allocated stack, so deeply nested input does not nest
+        calls. Compile it again after changing the grammar.
+        """
+        if not self._compiled:
+            self._compile_once()
+        return vm.compile(self._grm[self.start])
+
+    @contextmanager
+    def profile(self, nodes=True):
+        """
+        Collect statistics on the rules of the grammar while in a
+        `with` block.
+
+        Each rule, and each scanner node inside the rules if *nodes* is
+        `True`, is wrapped in a Probe for the duration of the block;
+        the rules are restored afterwards. The Profile object given to
+        the block has the statistics (see `textpy.profiling`):
+
+            with grammar.profile() as prof:
+                grammar.match(s)
+            print(prof.table())
+        """
+        if not self._compiled:
+            self._compile_once()
+        rules = dict(self._grm)
+        report = profiling.Profile()
+        for identifier, scanner in rules.items():
+            self._grm[identifier] = report.add_rule(identifier, scanner, nodes)
+        self.compile()
+        try:
+            yield report
+        finally:
+            self._grm.update(rules)
+            self.compile()
 
     # def _scan(self, s, pos):
     #     scanner = self._grm[self.start]
     #     return scanner._scan(s, pos)
 
-    def scan(self, s, pos=0):
+    def scan(self, s, pos=0, partial=False):
+        if not self._compiled:
+            self._compile_once()
         scanner = self._grm[self.start]
-        return scanner.scan(s, pos)
+        if self._memo is not None:
+            self._memo.clear()
+        return scanner.scan(s, pos, partial=partial)
 
-    def match(self, s, pos=0, trace=False):
+    def match(self, s, pos=0, trace=False, deferred=False, strict=False,
+              partial=False):
+        if not self._compiled:
+            self._compile_once()
         scanner = self._grm[self.start]
-        return scanner.match(s, pos, trace=trace)
+        if self._memo is not None:
+            self._memo.clear()
+        return scanner.match(s, pos, trace=trace, deferred=deferred,
+                             strict=strict, partial=partial)
+
+    def trace(self, s, pos=0):
+        """
+        Return a Tree of the nodes matched by the start rule in *s* at
+        *pos*, or `None` if there is no match (see Scanner.trace()).
+        """
+        if not self._compiled:
+            self._compile_once()
+        return self._grm[self.start].trace(s, pos)
+
+    def iter_matches(self, s, pos=0, delimiter=None):
+        """
+        Return an iterator yielding successive matches of the start
+        rule in *s*, separated by *delimiter* if given. Iteration stops
+        at the first failure; the iterator's *pos* attribute is then
+        the offset where it stopped, or the end of *s* if all of it was
+        matched. The memo table, if any, is cleared before each match
+        so memory use is bounded by the size of a record.
+        """
+        if not self._compiled:
+            self._compile_once()
+        matches = self._grm[self.start].iter_matches(s, pos, delimiter)
+        matches.memo = self._memo
+        return matches
+
+    def match_many(self, iterable, workers=None, chunksize=1, values=True,
+                   ordered=True, grammar=None):
+        """
+        Match the start rule against each string in *iterable* in a
+        pool of *workers* processes (by default, one per CPU).
+
+        Strings are sent to the workers in batches of *chunksize*. The
+        results are the match values, or the Match objects if *values*
+        is `False`, with `None` for strings that do not match. They are
+        yielded in the order of *iterable* or, if *ordered* is `False`,
+        as `(index, result)` pairs as soon as they are ready.
+
+        The grammar is set up once in each worker. If *grammar* is
+        given, it is a `'module:attr'` path to the grammar, or to a
+        function returning it, that each worker imports; this is needed
+        when actions are lambdas or closures, or when rules were
+        assigned in code. Otherwise each worker rebuilds the grammar
+        from its definition and actions, and a ValueError is raised if
+        that is not possible.
+        """
+        source = grammar if grammar is not None else self._recipe()
+        return _match_many(source, iterable, workers, chunksize, values,
+                           ordered)
+
+    def _recipe(self):
+        # what another process needs to rebuild the grammar
+        custom = set(self._grm).difference(self._built)
+        if custom:
+            raise ValueError(
+                'Rules not made from a definition: {}; '
+                'use a module:attr path to the grammar instead'
+                .format(', '.join(sorted(custom)))
+            )
+        actions = dict(
+            (identifier, scanner.action)
+            for identifier, scanner in self._grm.items()
+            if scanner.action is not None
+        )
+        recipe = (type(self), self._description, self.start, actions,
+                  self._trivia, self._tokens, self._memoized, self._optimized)
+        try:
+            pickle.dumps(recipe)
+        except (pickle.PicklingError, AttributeError, TypeError) as ex:
+            raise ValueError(
+                'Cannot send the grammar to other processes ({}); '
+                'use a module:attr path to the grammar instead'.format(ex)
+            )
+        return recipe
+
+    def incremental(self):
+        """
+        Return an IncrementalParser for input that arrives in chunks.
+        """
+        return IncrementalParser(self)
 
     def read(self, definition):
-        d = self.GrammarReader.match(definition)
-        if d is None:
-            raise ValueError('Not a valid grammar definition: ' + definition)
-        self._description.update(d.value)
-        for identifier, spellout in d.value.items():
-            self[identifier] = self._make_scanner(spellout)
+        cache = self.cache
+        built = None
+        if cache is not None:
+            key = self._cache_key(definition)
+            data = cache.get(key)
+            if data is not None:
+                built = self._load(data)
+        if built is None:
+            d = self.GrammarReader.match(definition)
+            if d is None:
+                raise ValueError(
+                    'Not a valid grammar definition: ' + definition
+                )
+            n = len(self._nonterminals)
+            rules = [(identifier, self._make_scanner(spellout))
+                     for identifier, spellout in d.value.items()]
+            built = (d.value, rules, self._nonterminals[n:])
+            del self._nonterminals[n:]
+            if cache is not None:
+                cache.put(key, self._dump(built))
+        description, rules, nonterminals = built
+        self._description.update(description)
+        self._nonterminals.extend(nonterminals)
+        for identifier, scanner in rules:
+            self[identifier] = scanner
+            self._built.add(identifier)
+
+    def _cache_key(self, definition):
+        # the tree depends on the reader and on the scanner family
+        h = hashlib.sha256()
+        for part in (type(self).__module__, type(self).__qualname__,
+                     Scanner.__module__, definition):
+            h.update(part.encode('utf-8') + b'\0')
+        return h.hexdigest()
+
+    # The nonterminals of a cached tree refer to the rules of the
+    # grammar that reads it, which are pickled by reference.
+
+    def _dump(self, built):
+        f = BytesIO()
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = (
+            lambda obj: 'rules' if obj is self._grm else None
+        )
+        pickler.dump(built)
+        return f.getvalue()
+
+    def _load(self, data):
+        unpickler = pickle.Unpickler(BytesIO(data))
+        unpickler.persistent_load = lambda pid: self._grm
+        try:
+            return unpickler.load()
+        except Exception:
+            return None  # e.g., written by another version; rebuild
 
     def update_actions(self, items=None, **kwargs):
         if items is None:
@@ -63,6 +595,7 @@ class Grammar(Scanner):
                 )
             scanner = self._grm[identifier]
             pairs.append((scanner, action))
+        self._check_inlined(identifier for identifier, _ in items)
 
         for scanner, action in pairs:
             scanner.action = action
@@ -109,3 +642,192 @@ class Grammar(Scanner):
 
 class PEG(Grammar):
     GrammarReader = io.PEGReader
+
+
+class IncrementalParser(object):
+    """
+    Push parser matching a grammar's start rule repeatedly over input
+    that arrives in chunks.
+
+    feed() appends a chunk (`str` or bytes-like) and returns the list
+    of top-level matches that it completed; close() marks the end of
+    the input and returns the remaining matches. A ValueError is raised
+    where the start rule fails (or matches nothing). Only the
+    unconsumed tail of the input is buffered. The matches returned by
+    one call share a `string` that begins at the absolute position
+    *offset* has after the call.
+
+    A match is complete when matching the start rule with
+    `partial=True` succeeds, i.e., no scanner reached the end of the
+    buffer. Regex scanners (including those made by
+    Grammar.optimize()) cannot tell a failure from a match that was
+    cut off, so a regex pattern should not fail on a prefix of text it
+    would match. A match still cut off at the end of the buffer is
+    scanned again once the buffer has doubled, so it may be returned
+    by a later call than the one completing it.
+    """
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.offset = 0
+        self.closed = False
+        self._buffer = None
+        self._pos = 0  # end of the consumed part of the buffer
+        self._retry = 0  # buffer length at which to scan again
+
+    def feed(self, chunk):
+        if self.closed:
+            raise ValueError('cannot feed a closed parser')
+        if not isinstance(chunk, (str, bytes)):
+            chunk = bytes(chunk)
+        self._compact()
+        if self._buffer is None:
+            self._buffer = chunk
+        else:
+            self._buffer += chunk
+        if len(self._buffer) < self._retry:
+            return []
+        return self._parse(True)
+
+    def close(self):
+        self._compact()
+        self.closed = True
+        if self._buffer is None:
+            return []
+        return self._parse(False)
+
+    def _compact(self):
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self.offset += self._pos
+            self._pos = 0
+
+    def _parse(self, partial):
+        grammar = self.grammar
+        s = self._buffer
+        n = len(s)
+        pos = 0
+        matches = []
+        self._retry = 0
+        while pos < n:
+            m = grammar.match(s, pos, partial=partial)
+            # a partial match fails if a scanner was cut off, so only
+            # then scan again to tell that from an error
+            if m is None and partial and \
+                    grammar.scan(s, pos, partial=True) == EOS:
+                # wait until the buffer has doubled so a long match is
+                # not rescanned for every small chunk
+                self._retry = 2 * (n - pos)
+                break
+            if m is None or m.endpos == pos:
+                raise ValueError(
+                    'No match at offset {}'.format(self.offset + pos)
+                )
+            matches.append(m)
+            pos = m.endpos
+        self._pos = pos
+        return matches
+
+
+def _references(scanner):
+    # the names of the rules referred to in the tree under scanner
+    names = []
+    stack = [scanner]
+    while stack:
+        node = stack.pop()
+        if optimize.kind(node) == 'Nonterminal':
+            names.append(node._name)
+        stack.extend(optimize.children(node))
+    return names
+
+
+def _postorder(refs):
+    # rule names, each after the rules it refers to unless recursive
+    order, seen = [], set()
+    for root in refs:
+        if root in seen:
+            continue
+        seen.add(root)
+        stack = [(root, iter(refs[root]))]
+        while stack:
+            identifier, names = stack[-1]
+            for name in names:
+                if name in refs and name not in seen:
+                    seen.add(name)
+                    stack.append((name, iter(refs[name])))
+                    break
+            else:
+                stack.pop()
+                order.append(identifier)
+    return order
+
+
+def _recursive(refs, identifier):
+    # True if the rule can refer back to itself
+    seen = set()
+    stack = list(refs[identifier])
+    while stack:
+        name = stack.pop()
+        if name == identifier:
+            return True
+        if name in refs and name not in seen:
+            seen.add(name)
+            stack.extend(refs[name])
+    return False
+
+
+# worker processes for Grammar.match_many()
+
+_worker_grammar = None
+
+
+def _init_worker(source):
+    global _worker_grammar
+    if isinstance(source, str):
+        modname, _, attr = source.partition(':')
+        grammar = importlib.import_module(modname)
+        for name in attr.split('.'):
+            grammar = getattr(grammar, name)
+        if not isinstance(grammar, Grammar):
+            grammar = grammar()
+    else:
+        (cls, description, start, actions, skip, tokens, memoized,
+         optimized) = source
+        grammar = cls(start=start, skip=skip, tokens=tokens)
+        grammar._description.update(description)
+        for identifier, spellout in description.items():
+            grammar[identifier] = grammar._make_scanner(spellout)
+            grammar._built.add(identifier)
+        grammar.update_actions(actions)
+        if memoized is not None:
+            grammar.memoize(*memoized)
+        if optimized is not None:
+            grammar.optimize(*optimized)
+    _worker_grammar = grammar.compile()
+
+
+def _match_many(source, iterable, workers, chunksize, values, ordered):
+    pool = multiprocessing.Pool(
+        workers, initializer=_init_worker, initargs=(source,)
+    )
+    with pool:
+        if ordered:
+            results = pool.imap(
+                partial(_match_one, values), iterable, chunksize
+            )
+        else:
+            results = pool.imap_unordered(
+                partial(_match_indexed, values), enumerate(iterable), chunksize
+            )
+        for result in results:
+            yield result
+
+
+def _match_one(values, s):
+    m = _worker_grammar.match(s)
+    if values and m is not None:
+        return m.value
+    return m
+
+
+def _match_indexed(values, item):
+    return item[0], _match_one(values, item[1])
@@ -91,13 +91,14 @@ CommentReader = Sequence(
 # composed grammar functions
 
 patterns = {}
+_GroupReference = Nonterminal(patterns, 'Group')
 
 PrimaryReader = Choice(
     DotReader,
     DQLiteralReader,
     CharacterClassReader,
     RegexReader,
-    Nonterminal(patterns, 'Group'),
+    _GroupReference,
     Group(
         Sequence(
             Group(_Id),
@@ -179,6 +180,7 @@ GroupReader = Bounded(
 )
 
 patterns['Group'] = GroupReader
+_GroupReference.link()
 
 RuleReader = Sequence(
     _WS, Group(_Id), _WS, Literal('='), _WS, Group(ChoiceReader),
@@ -206,6 +208,7 @@ GrammarReader = Repeat(
 # PEG functions
 
 PEGPatterns = {}
+_PEGGroupReference = Nonterminal(PEGPatterns, 'Group')
 
 PEGSQRegexReader = Group(
     BoundedString("~'", "'"),
@@ -224,7 +227,7 @@ PEGPrimaryReader = Choice(
     CharacterClassReader,
     PEGSQRegexReader,
     PEGDQRegexReader,
-    Nonterminal(PEGPatterns, 'Group'),
+    _PEGGroupReference,
     Group(
         Sequence(
             Group(_Id),
@@ -261,6 +264,7 @@ PEGGroupReader = Bounded(
 )
 
 PEGPatterns['Group'] = PEGGroupReader
+_PEGGroupReference.link()
 
 PEGRuleReader = Sequence(
     _WS, Group(_Id), _WS, Literal('<-'), _WS, Group(PEGChoiceReader),
@@ -0,0 +1,719 @@
+'''
+Optimization passes over scanner trees.
+
+The passes take a scanner and return an equivalent one (possibly the
+same object) along with a report of what changed. They work on both
+the `c_` and `py_` scanner families, and new scanners are built from
+the same family as the ones they replace. Nonterminals are not
+followed; use `textpy.grammars.Grammar.optimize()` to optimize every
+rule of a grammar.
+'''
+
+import re
+import sys
+
+from textpy import scanners
+
+
+_KINDS = {}
+for _name in ('Dot', 'CharacterClass', 'Literal', 'Regex', 'Spacing',
+              'Integer', 'Float', 'Number', 'BoundedString', 'Bounded',
+              'Sequence', 'Choice', 'Repeat', 'Optional', 'Lookahead',
+              'NegativeLookahead', 'Nonterminal', 'Group'):
+    for _prefix in ('py_', 'c_'):
+        _cls = getattr(scanners, _prefix + _name)
+        if _cls is not None:
+            _KINDS[_cls] = _name
+
+
+def kind(scanner):
+    '''
+    Return the name of the built-in scanner type of *scanner*, or
+    `None` if it is not one (e.g., a user-defined subclass).
+    '''
+    return _KINDS.get(type(scanner))
+
+
+def children(scanner):
+    '''
+    Return the list of scanners directly used by *scanner*.
+    '''
+    k = kind(scanner)
+    if k in ('Sequence', 'Choice'):
+        return list(scanner._scanners)
+    elif k == 'Repeat':
+        if scanner._delimiter is None:
+            return [scanner._scanner]
+        return [scanner._scanner, scanner._delimiter]
+    elif k == 'Bounded':
+        return [scanner._lhs, scanner._body, scanner._rhs]
+    elif k in ('Optional', 'Lookahead', 'NegativeLookahead', 'Group'):
+        return [scanner._scanner]
+    return []
+
+
+def rebuild(scanner, subscanners):
+    '''
+    Return a copy of *scanner* using *subscanners* in place of the
+    scanners returned by `children()`. The copy skips the same trivia
+    as *scanner*.
+
+    If *subscanners* are the same objects as the current children,
+    *scanner* itself is returned.
+    '''
+    current = children(scanner)
+    if len(current) == len(subscanners) and all(
+            a is b for a, b in zip(current, subscanners)):
+        return scanner
+    k = kind(scanner)
+    action = scanner.action
+    if k in ('Sequence', 'Choice'):
+        new = _new(scanner, k, *subscanners, action=action)
+    elif k == 'Repeat':
+        delimiter = subscanners[1] if len(subscanners) > 1 else None
+        new = _new(scanner, k, subscanners[0], min=scanner._min,
+                   max=scanner._max, delimiter=delimiter, action=action,
+                   sink=scanner.sink)
+    elif k == 'Bounded':
+        new = _new(scanner, k, *subscanners, action=action)
+    elif k == 'Optional':
+        new = _new(scanner, k, subscanners[0], default=scanner._default,
+                   action=action)
+    elif k in ('Lookahead', 'NegativeLookahead'):
+        new = _new(scanner, k, subscanners[0])
+    elif k == 'Group':
+        new = _new(scanner, k, subscanners[0], action=action,
+                   sink=scanner.sink)
+    else:
+        raise TypeError('cannot rebuild {!r}'.format(scanner))
+    new.skip = scanner.skip
+    return new
+
+
+def _new(scanner, k, *args, **kwargs):
+    # construct a scanner of kind k from the same family as scanner
+    if isinstance(scanner, scanners.py_Scanner):
+        cls = getattr(scanners, 'py_' + k)
+    else:
+        cls = getattr(scanners, 'c_' + k)
+    return cls(*args, **kwargs)
+
+
+def size(scanner):
+    '''
+    Return the number of scanner nodes in the tree under *scanner*.
+    '''
+    n = 0
+    stack = [scanner]
+    while stack:
+        n += 1
+        stack.extend(children(stack.pop()))
+    return n
+
+
+# Regex fusion
+
+# possessive quantifiers and atomic groups are needed to reproduce the
+# non-backtracking behavior of the scanners
+CAN_FUSE = sys.version_info >= (3, 11)
+
+_DIGITS = '[0-9]+'
+_EXPONENT = '[eE][-+]?[0-9]+'
+_ANY = '(?s:.)'
+_REGEX_FLAGS = (
+    (re.IGNORECASE, 'i'),
+    (re.MULTILINE, 'm'),
+    (re.DOTALL, 's'),
+    (re.VERBOSE, 'x'),
+    (re.ASCII, 'a'),
+)
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def fuse(scanner, min_size=3):
+    '''
+    Replace maximal regular subtrees of *scanner* with single Regex
+    scanners.
+
+    A subtree is fused when it has at least *min_size* nodes, contains
+    no Groups, Nonterminals, or actions, its value is the matched
+    substring, and every node in it can be expressed as an atomic
+    regular expression (possessive repetition and atomic ordered
+    choice, so the fused Regex never backtracks where the scanners
+    would not). Fusion requires Python 3.11 or later; on older
+    versions *scanner* is returned unchanged.
+
+    Return a pair `(scanner, fused)` where *fused* is a list of
+    `(subtree, pattern)` pairs for each replaced subtree. Note that
+    traces (`match(s, trace=True)`) show a fused subtree as a single
+    match.
+    '''
+    fused = []
+    if CAN_FUSE:
+        scanner = _fuse(scanner, min_size, fused)
+    return scanner, fused
+
+
+def _fuse(scanner, min_size, fused):
+    subscanners = children(scanner)
+    if subscanners and _textual(scanner) and size(scanner) >= min_size:
+        pattern = _pattern(scanner)
+        if pattern is not None:
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                pass  # e.g., embedded regexes reuse a group name
+            else:
+                fused.append((scanner, pattern))
+                return _new(scanner, 'Regex', regex)
+    return rebuild(
+        scanner, [_fuse(sub, min_size, fused) for sub in subscanners]
+    )
+
+
+def _textual(scanner):
+    # True if the value of a match is the matched substring
+    if scanner.action is not None or scanner.capturing:
+        return False
+    k = kind(scanner)
+    if k in ('Integer', 'Float', 'Number') and scanner.convert:
+        return False
+    elif k == 'Repeat' and scanner.sink is not None:
+        return False
+    elif k == 'Choice':
+        return all(_textual(sub) for sub in scanner._scanners)
+    elif k == 'Optional':
+        return scanner._default == '' and _textual(scanner._scanner)
+    elif k in ('Bounded', 'Nonterminal', 'Group', None):
+        return False
+    return True
+
+
+def _pattern(scanner):
+    # Return an atomic regular expression equivalent to scanner, or
+    # None if there is none. The pattern is safe to concatenate but
+    # not to quantify without a group.
+    if scanner.action is not None:
+        return None
+    k = kind(scanner)
+    if k == 'Dot':
+        return _ANY
+    elif k == 'Literal':
+        return re.escape(scanner._x)
+    elif k == 'CharacterClass':
+        return _class_pattern(scanner)
+    elif k == 'Regex':
+        return _regex_pattern(scanner.regex)
+    elif k == 'Spacing':
+        if not scanner._ws:
+            return ''
+        return '[{}]*+'.format(''.join(map(re.escape, scanner._ws)))
+    elif k == 'Integer':
+        return '(?>[-+]?{})'.format(_DIGITS)
+    elif k == 'Float':
+        return (
+            r'(?>[-+]?(?:\.{d}(?:{e})?|{d}(?:\.[0-9]*(?:{e})?|{e})))'
+            .format(d=_DIGITS, e=_EXPONENT)
+        )
+    elif k == 'Number':
+        return (
+            r'(?>[-+]?(?:\.{d}(?:{e})?|{d}(?:\.[0-9]*(?:{e})?|{e})?))'
+            .format(d=_DIGITS, e=_EXPONENT)
+        )
+    elif k == 'BoundedString':
+        first, last = scanner.first, scanner.last
+        if not isinstance(first, str) or not isinstance(last, str):
+            return None
+        if not last:
+            return re.escape(first)
+        return r'(?>{}(?:(?!{})(?:\\{}|{}))*+{})'.format(
+            re.escape(first), re.escape(last), _ANY, _ANY, re.escape(last)
+        )
+
+    subpatterns = [_pattern(sub) for sub in children(scanner)]
+    if any(p is None for p in subpatterns):
+        return None
+    if k in ('Sequence', 'Bounded'):
+        return ''.join(subpatterns)
+    elif k == 'Choice':
+        if not subpatterns:
+            return '(?!)'
+        return '(?>{})'.format('|'.join(subpatterns))
+    elif k == 'Optional':
+        return '(?:{})?+'.format(subpatterns[0])
+    elif k == 'Lookahead':
+        return '(?={})'.format(subpatterns[0])
+    elif k == 'NegativeLookahead':
+        return '(?!{})'.format(subpatterns[0])
+    elif k == 'Repeat':
+        return _repeat_pattern(scanner._min, scanner._max, *subpatterns)
+    return None  # Group, Nonterminal, or unknown
+
+
+def _class_pattern(cc):
+    items = []
+    for a, b in cc._ranges:
+        if a == b:
+            items.append(re.escape(a))
+        else:
+            items.append('{}-{}'.format(re.escape(a), re.escape(b)))
+    if not items:
+        return '(?s:.)' if cc._negated else '(?!)'
+    return '[{}{}]'.format('^' if cc._negated else '', ''.join(items))
+
+
+def _regex_pattern(regex):
+    pattern = regex.pattern
+    if not isinstance(pattern, str) or _BACKREFERENCE.search(pattern):
+        return None
+    flags = regex.flags & ~re.UNICODE
+    inline = ''
+    for flag, letter in _REGEX_FLAGS:
+        if flags & flag:
+            inline += letter
+            flags &= ~flag
+    if flags:
+        return None
+    if inline:
+        return '(?>(?{}:{}))'.format(inline, pattern)
+    return '(?>{})'.format(pattern)
+
+
+def _quantifier(lo, hi):
+    if hi < 0:
+        return '{{{},}}+'.format(lo)
+    return '{{{},{}}}+'.format(lo, hi)
+
+
+def _repeat_pattern(lo, hi, item, delimiter=None):
+    if hi == 0:
+        return '' if lo == 0 else '(?!)'
+    if delimiter is None:
+        return '(?:{}){}'.format(item, _quantifier(lo, hi))
+    rest = '(?:{}{}){}'.format(
+        delimiter, item, _quantifier(max(lo - 1, 0), hi - 1 if hi > 0 else -1)
+    )
+    if lo == 0:
+        return '(?:{}{})?+'.format(item, rest)
+    return '{}{}'.format(item, rest)
+
+
+# First-character dispatch
+
+# character classes with more members than this are not enumerated
+MAX_FIRST_SET = 1024
+
+_SIGNS = frozenset('-+')
+_DIGIT_SET = frozenset('0123456789')
+
+
+def first(scanner):
+    '''
+    Return the FIRST set of *scanner* as a pair `(chars, nullable)`.
+
+    *chars* is a frozenset of the characters a match can start with,
+    or `None` if they are unknown (e.g., for Dot or Regex), and
+    *nullable* is `True` if the scanner may succeed without consuming
+    anything. Nonterminals are followed to their rules; a rule that
+    refers back to itself before consuming input has an unknown FIRST
+    set.
+    '''
+    return _first(scanner, {}, set())
+
+
+def _first(scanner, rules, active):
+    k = kind(scanner)
+    if k == 'Literal':
+        x = scanner._x
+        return (frozenset(x[:1]), not x)
+    elif k == 'CharacterClass':
+        if scanner._negated:
+            return (None, False)
+        chars = set()
+        for a, b in scanner._ranges:
+            if len(chars) + ord(b) - ord(a) >= MAX_FIRST_SET:
+                return (None, False)
+            chars.update(map(chr, range(ord(a), ord(b) + 1)))
+        return (frozenset(chars), False)
+    elif k == 'Spacing':
+        return (frozenset(scanner._ws), True)
+    elif k == 'Integer':
+        return (_SIGNS | _DIGIT_SET, False)
+    elif k in ('Float', 'Number'):
+        return (_SIGNS | _DIGIT_SET | frozenset('.'), False)
+    elif k == 'BoundedString':
+        if not scanner.first:
+            return (None, False)
+        return (frozenset(scanner.first[:1]), False)
+    elif k in ('Lookahead', 'NegativeLookahead'):
+        # a lookahead does not consume, so what follows it decides
+        return (frozenset(), True)
+    elif k in ('Sequence', 'Bounded'):
+        chars = set()
+        for sub in children(scanner):
+            subchars, nullable = _first(sub, rules, active)
+            if subchars is None:
+                return (None, False)
+            chars.update(subchars)
+            if not nullable:
+                return (frozenset(chars), False)
+        return (frozenset(chars), True)
+    elif k == 'Choice':
+        chars = set()
+        nullable = False
+        for sub in scanner._scanners:
+            subchars, subnullable = _first(sub, rules, active)
+            if subchars is None:
+                return (None, False)
+            chars.update(subchars)
+            nullable = nullable or subnullable
+        return (frozenset(chars), nullable)
+    elif k == 'Repeat':
+        if scanner._max == 0:
+            return (frozenset(), True)
+        chars, nullable = _first(scanner._scanner, rules, active)
+        return (chars, nullable or scanner._min <= 0)
+    elif k == 'Optional':
+        chars, _ = _first(scanner._scanner, rules, active)
+        return (chars, True)
+    elif k == 'Group':
+        return _first(scanner._scanner, rules, active)
+    elif k == 'Nonterminal':
+        rule = _rule(scanner)
+        if rule is None or id(rule) in active:
+            return (None, False)
+        if id(rule) not in rules:
+            active.add(id(rule))
+            rules[id(rule)] = _first(rule, rules, active)
+            active.discard(id(rule))
+        return rules[id(rule)]
+    return (None, False)  # Dot, Regex, or unknown
+
+
+def _rule(nonterminal):
+    rule = nonterminal._scanner
+    if rule is None:
+        try:
+            rule = nonterminal._grammar[nonterminal._name]
+        except KeyError:
+            pass
+    return rule
+
+
+def dispatch(scanner):
+    '''
+    Build first-character dispatch tables for every Choice in the tree
+    under *scanner*.
+
+    Alternatives are only tried when the next character is in their
+    FIRST set (see `first()`); alternatives that are nullable or have
+    unknown FIRST sets are always tried, and the original order of
+    alternatives is kept. Choices where dispatching would not rule out
+    any alternative are left alone. Dispatch tables depend on the
+    rules that nonterminals refer to, so they must be rebuilt if a
+    rule changes.
+
+    Return a pair `(scanner, choices)` where *choices* lists the
+    Choice scanners that received a table.
+    '''
+    choices = []
+    rules = {}
+    seen = set()
+    stack = [scanner]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        stack.extend(children(node))
+        if kind(node) == 'Choice' and _dispatch(node, rules):
+            choices.append(node)
+    return scanner, choices
+
+
+def _dispatch(choice, rules):
+    alternatives = choice._scanners
+    firsts = []
+    for alt in alternatives:
+        chars, nullable = _first(alt, rules, set())
+        firsts.append(None if nullable else chars)
+    if len(alternatives) < 2 or all(chars is None for chars in firsts):
+        return False
+    default = tuple(
+        alt for alt, chars in zip(alternatives, firsts) if chars is None
+    )
+    table = {}
+    for c in set().union(*[chars for chars in firsts if chars is not None]):
+        table[c] = tuple(
+            alt for alt, chars in zip(alternatives, firsts)
+            if chars is None or c in chars
+        )
+    choice.dispatch(table, default)
+    return True
+
+
+# Rewriting
+
+REWRITES = ('flatten', 'inline', 'merge', 'factor', 'prune', 'ungroup')
+
+
+def rewrite(scanner, inline=None):
+    '''
+    Simplify the tree under *scanner* without changing the values of
+    matches or which actions are called.
+
+    The rewrites are:
+
+    * `flatten` - splice Sequences (Choices) without actions into
+                  their parent Sequence (Choice), and replace those
+                  with a single scanner by the scanner where that
+                  gives the same value
+    * `inline`  - replace references to the rules in *inline*, a
+                  mapping of rule names to scanners, by the scanners;
+                  references with an action, memo table, sink, or
+                  trivia to skip are kept
+    * `merge`   - join adjacent Literals in a Sequence
+    * `factor`  - turn adjacent alternatives of a Choice that start
+                  with the same non-capturing scanners into one
+                  Sequence of the common prefix and a Choice of the
+                  rest (ordered choice never backtracks into the
+                  prefix, so this does not change what matches)
+    * `prune`   - drop the alternatives after one that always succeeds
+    * `ungroup` - remove Groups without actions or sinks whose values
+                  are never used (inside lookaheads and the delimiters
+                  of Bounded)
+
+    Inlined scanners are used as they are, and Nonterminals are not
+    followed otherwise; Choices with dispatch tables are left alone.
+    Inlined rules must not refer back to themselves.
+
+    Return a pair `(scanner, rewrites)` where *rewrites* lists a
+    `(rewrite, subtree)` pair for each change, with the string form of
+    the subtree it was applied to. Note that traces show the rewritten
+    tree, that a failure of merged Literals is reported as one of the
+    whole literal, and that failures of negative lookaheads describe
+    the rewritten subtree.
+    '''
+    rewrites = []
+    if inline is None:
+        inline = {}
+    opaque = set(id(x) for x in inline.values())
+    scanner = _rewrite(scanner, inline, opaque, True, rewrites)
+    return scanner, rewrites
+
+
+def _rewrite(scanner, inline, opaque, used, rewrites):
+    # *used* is False where the value of scanner is never computed
+    k = kind(scanner)
+    if k == 'Nonterminal':
+        rule = inline.get(scanner._name)
+        if (rule is not None and scanner.action is None and
+                scanner.memo is None and scanner.sink is None and
+                scanner.skip is None):
+            rewrites.append(('inline', str(scanner)))
+            return rule
+        return scanner
+    elif (k == 'Group' and not used and scanner.action is None and
+            scanner.sink is None):
+        rewrites.append(('ungroup', str(scanner)))
+        return _rewrite(scanner._scanner, inline, opaque, used, rewrites)
+    elif k == 'Choice' and scanner._dispatch is not None:
+        return scanner
+    subscanners = children(scanner)
+    if not subscanners or id(scanner) in opaque:
+        return scanner
+    if k in ('Lookahead', 'NegativeLookahead'):
+        unused = set([0])
+    elif k == 'Bounded':
+        unused = set([0, 2])
+    else:
+        unused = set()
+    new = [
+        _rewrite(sub, inline, opaque, used and i not in unused, rewrites)
+        for i, sub in enumerate(subscanners)
+    ]
+    if k == 'Sequence':
+        return _rewrite_sequence(scanner, new, opaque, rewrites)
+    elif k == 'Choice':
+        return _rewrite_choice(scanner, new, opaque, rewrites)
+    return rebuild(scanner, new)
+
+
+def _rewrite_sequence(seq, subscanners, opaque, rewrites):
+    items = []
+    for sub in subscanners:
+        if (kind(sub) == 'Sequence' and sub.action is None and
+                id(sub) not in opaque):
+            rewrites.append(('flatten', str(sub)))
+            items.extend(sub._scanners)
+        else:
+            items.append(sub)
+    merged = []
+    for sub in items:
+        prev = merged[-1] if merged else None
+        if (prev is not None and _plain_literal(prev) and
+                _plain_literal(sub) and sub.skip is None and
+                type(prev._x) is type(sub._x)):
+            rewrites.append(('merge', '{} {}'.format(prev, sub)))
+            lit = _new(prev, 'Literal', prev._x + sub._x)
+            lit.skip = prev.skip
+            merged[-1] = lit
+        else:
+            merged.append(sub)
+    if len(merged) == 1 and seq.action is None and _passes(merged[0]):
+        rewrites.append(('flatten', str(seq)))
+        return merged[0]
+    return rebuild(seq, merged)
+
+
+def _plain_literal(scanner):
+    return kind(scanner) == 'Literal' and scanner.action is None
+
+
+def _passes(scanner):
+    # True if a Sequence of only scanner (without an action) has the
+    # same value as scanner
+    if scanner.capturing:
+        return (kind(scanner) in ('Sequence', 'Repeat', 'Group') and
+                scanner.action is None and scanner.sink is None)
+    return _textual(scanner)
+
+
+def _rewrite_choice(choice, subscanners, opaque, rewrites):
+    alternatives = []
+    for sub in subscanners:
+        if (kind(sub) == 'Choice' and sub.action is None and
+                sub._dispatch is None and id(sub) not in opaque):
+            rewrites.append(('flatten', str(sub)))
+            alternatives.extend(sub._scanners)
+        else:
+            alternatives.append(sub)
+    capturing = any(alt.capturing for alt in alternatives)
+    for i, alt in enumerate(alternatives[:-1]):
+        if _infallible(alt, set()):
+            # the values of capturing Choices are collected even when
+            # they are strings, so keep the Choice capturing
+            if capturing and not any(a.capturing
+                                     for a in alternatives[:i + 1]):
+                break
+            rewrites.append(
+                ('prune', ' | '.join(map(str, alternatives[i + 1:])))
+            )
+            del alternatives[i + 1:]
+            break
+    alternatives = _factor(choice, alternatives, opaque, rewrites)
+    if (len(alternatives) == 1 and choice.action is None and
+            alternatives[0].action is None):
+        rewrites.append(('flatten', str(choice)))
+        return alternatives[0]
+    return rebuild(choice, alternatives)
+
+
+def _factor(choice, alternatives, opaque, rewrites):
+    # left-factor runs of adjacent alternatives that are Sequences
+    # starting with the same scanners
+    factored = []
+    i = 0
+    while i < len(alternatives):
+        run = [alternatives[i]]
+        keys = _sequence_keys(alternatives[i])
+        if keys:
+            for alt in alternatives[i + 1:]:
+                other = _sequence_keys(alt)
+                if (not other or other[0] != keys[0] or
+                        alt.capturing != run[0].capturing):
+                    break
+                run.append(alt)
+        if len(run) < 2:
+            factored.append(alternatives[i])
+            i += 1
+            continue
+        n = len(keys)
+        for alt in run[1:]:
+            other = _sequence_keys(alt)
+            n = next((j for j in range(min(n, len(other)))
+                      if keys[j] != other[j]), min(n, len(other)))
+        rewrites.append(('factor', ' | '.join(map(str, run))))
+        prefix = list(run[0]._scanners[:n])
+        rests = [_new(alt, 'Sequence', *alt._scanners[n:]) for alt in run]
+        rests = [
+            rest._scanners[0]
+            if len(rest._scanners) == 1 and _passes(rest._scanners[0])
+            else rest
+            for rest in rests
+        ]
+        # the rests may be pruned or factored in turn
+        rest = _rewrite_choice(_new(choice, 'Choice'), rests, opaque,
+                               rewrites)
+        factored.append(_new(choice, 'Sequence', *(prefix + [rest])))
+        i += len(run)
+    return factored
+
+
+def _sequence_keys(alt):
+    # the keys of the leading non-capturing scanners of a Sequence
+    if kind(alt) != 'Sequence' or alt.action is not None:
+        return []
+    keys = []
+    for sub in alt._scanners:
+        key = _key(sub)
+        if key is None:
+            break
+        keys.append(key)
+    return keys
+
+
+def _key(scanner):
+    # a key equal for scanners that match alike and whose values are
+    # not collected by a Sequence, or None
+    if (scanner.capturing or scanner.action is not None or
+            getattr(scanner, 'sink', None) is not None):
+        return None
+    k = kind(scanner)
+    if k is None or (k == 'Choice' and scanner._dispatch is not None):
+        return None
+    elif k == 'Nonterminal':
+        return (type(scanner), id(scanner._grammar), scanner._name,
+                id(scanner.memo), id(scanner.skip))
+    key = [type(scanner), id(scanner.skip)]
+    for arg in scanner.__reduce__()[1]:
+        if isinstance(arg, _SCANNERS):
+            arg = _key(arg)
+            if arg is None:
+                return None
+        else:
+            try:
+                hash(arg)
+            except TypeError:
+                return None
+        key.append(arg)
+    return tuple(key)
+
+
+_SCANNERS = tuple(
+    cls for cls in (scanners.py_Scanner, scanners.c_Scanner)
+    if cls is not None
+)
+
+
+def _infallible(scanner, active):
+    # True if scanner always succeeds (unless it needs more input)
+    k = kind(scanner)
+    if k in ('Optional', 'Spacing'):
+        return True
+    elif k == 'Repeat':
+        return scanner._min <= 0
+    elif k == 'Literal':
+        return not scanner._x
+    elif k in ('Sequence', 'Bounded'):
+        return all(_infallible(sub, active) for sub in children(scanner))
+    elif k == 'Choice':
+        return any(_infallible(sub, active) for sub in scanner._scanners)
+    elif k in ('Group', 'Lookahead'):
+        return _infallible(scanner._scanner, active)
+    elif k == 'Nonterminal':
+        rule = _rule(scanner)
+        if rule is None or id(rule) in active:
+            return False
+        return _infallible(rule, active | set([id(rule)]))
+    return False
@@ -0,0 +1,142 @@
+'''
+Per-rule and per-node profiling of scanner trees.
+
+Profiling wraps scanners in `Probe` scanners that count invocations,
+successes, failures, consumed characters, and re-attempts at the same
+position, and time them. Probes work with both the `c_` and `py_`
+scanner families and do not change parse results. Use
+`textpy.grammars.Grammar.profile()` to profile every rule of a grammar.
+'''
+
+import json
+
+from textpy import scanners
+from textpy.optimize import kind, children, rebuild
+
+
+STATISTICS = ('calls', 'successes', 'failures', 'consumed', 'retries',
+              'time', 'self_time')
+
+
+def instrument(scanner, name):
+    '''
+    Return a copy of the tree under *scanner* with every node wrapped
+    in a Probe, along with a list of `(path, probe)` pairs.
+
+    Paths are *name* for the root and are extended with `.i` for the
+    *i*-th child (see `textpy.optimize.children()`). Nonterminals are
+    not followed. Dispatch tables of Choice nodes are carried over to
+    their copies.
+    '''
+    probes = []
+    return _instrument(scanner, name, probes), probes
+
+
+def _instrument(scanner, path, probes):
+    current = children(scanner)
+    probed = [
+        _instrument(child, '{}.{}'.format(path, i), probes)
+        for i, child in enumerate(current)
+    ]
+    if probed:
+        copy = rebuild(scanner, probed)
+        if kind(scanner) == 'Choice' and scanner._dispatch is not None:
+            new = dict((id(a), b) for a, b in zip(current, probed))
+            copy.dispatch(
+                dict((c, tuple(new[id(alt)] for alt in alts))
+                     for c, alts in scanner._dispatch.items()),
+                tuple(new[id(alt)] for alt in scanner._default)
+            )
+        scanner = copy
+    probe = _probe(scanner, path)
+    probes.append((path, probe))
+    return probe
+
+
+def _probe(scanner, name):
+    # a probe from the same family as scanner
+    if isinstance(scanner, scanners.py_Scanner):
+        return scanners.py_Probe(scanner, name)
+    return scanners.c_Probe(scanner, name)
+
+
+class Profile(object):
+    '''
+    Statistics collected by the probes of a profiled grammar.
+
+    *rules* maps rule names to the probes wrapping whole rules and
+    *nodes* lists `(rule, path, probe)` triples for the nodes inside
+    the rules (empty if only rules are profiled).
+    '''
+    def __init__(self):
+        self.rules = {}
+        self.nodes = []
+
+    def add_rule(self, name, scanner, nodes=True):
+        '''
+        Return *scanner* wrapped in probes for the rule *name*.
+        '''
+        if nodes:
+            scanner, probes = instrument(scanner, name)
+            self.nodes.extend((name, path, probe) for path, probe in probes)
+            probe = _probe(scanner._scanner, name)
+            # the root node probe also times the rule, so drop it
+            self.nodes.pop()
+        else:
+            probe = _probe(scanner, name)
+        self.rules[name] = probe
+        return probe
+
+    def reset(self):
+        '''Set all statistics to zero.'''
+        for probe in self.rules.values():
+            probe.reset()
+        for _, _, probe in self.nodes:
+            probe.reset()
+
+    def as_dict(self):
+        '''
+        Return the statistics as a dictionary with `'rules'` (a mapping
+        of rule names to statistics) and `'nodes'` (a list of
+        statistics with `'rule'`, `'path'`, and `'scanner'` keys).
+        '''
+        return {
+            'rules': dict(
+                (name, _statistics(probe))
+                for name, probe in self.rules.items()
+            ),
+            'nodes': [
+                dict(rule=rule, path=path, scanner=str(probe),
+                     **_statistics(probe))
+                for rule, path, probe in self.nodes
+            ],
+        }
+
+    def to_json(self, **kwargs):
+        '''Return the statistics as a JSON string (see `as_dict()`).'''
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def table(self, nodes=False, sort='time'):
+        '''
+        Return the statistics as a text table, one line per rule (and
+        per node if *nodes* is `True`) sorted by the descending value
+        of the *sort* statistic.
+        '''
+        rows = [(name, probe) for name, probe in self.rules.items()]
+        if nodes:
+            rows.extend((path, probe) for _, path, probe in self.nodes)
+        rows.sort(key=lambda row: getattr(row[1], sort), reverse=True)
+        width = max([len(name) for name, _ in rows] + [4])
+        header = '{:<{w}} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'
+        line = '{:<{w}} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10.6f} {:>10.6f}'
+        lines = [header.format('name', *STATISTICS, w=width)]
+        for name, probe in rows:
+            lines.append(line.format(
+                name, *[getattr(probe, stat) for stat in STATISTICS],
+                w=width
+            ))
+        return '\n'.join(lines)
+
+
+def _statistics(probe):
+    return dict((stat, getattr(probe, stat)) for stat in STATISTICS)
@@ -1,9 +1,18 @@
 
 import re
+import threading
+from array import array
 from functools import partial
+from bisect import bisect_right
+from time import perf_counter
+
+from textpy.exceptions import ParseError, _parse_error
 
 __all__ = [
+    'ParseError',
     'Match',
+    'Tree',
+    'TreeCursor',
     'Scanner',
     'Dot',
     'CharacterClass',
@@ -12,6 +21,7 @@ __all__ = [
     'Spacing',
     'Integer',
     'Float',
+    'Number',
     'BoundedString',
     'Bounded',
     'Sequence',
@@ -23,12 +33,16 @@ __all__ = [
     'Lookahead',
     'NegativeLookahead',
     'Nonterminal',
+    'Memo',
     'Group',
+    'Probe',
+    'Machine',
     'split',
 ]
 
 try:
     from textpy._scanners import (
+        Tree                as c_Tree,
         Scanner             as c_Scanner,
         Dot                 as c_Dot,
         CharacterClass      as c_CharacterClass,
@@ -37,6 +51,7 @@ try:
         Spacing             as c_Spacing,
         Integer             as c_Integer,
         Float               as c_Float,
+        Number              as c_Number,
         BoundedString       as c_BoundedString,
         Bounded             as c_Bounded,
         Sequence            as c_Sequence,
@@ -46,9 +61,13 @@ try:
         Lookahead           as c_Lookahead,
         NegativeLookahead   as c_NegativeLookahead,
         Nonterminal         as c_Nonterminal,
+        Memo                as c_Memo,
         Group               as c_Group,
+        Probe               as c_Probe,
+        Machine             as c_Machine,
     )
 except ImportError:
+    c_Tree                = None
     c_Scanner             = None
     c_Dot                 = None
     c_CharacterClass      = None
@@ -57,6 +76,7 @@ except ImportError:
     c_Spacing             = None
     c_Integer             = None
     c_Float               = None
+    c_Number              = None
     c_BoundedString       = None
     c_Bounded             = None
     c_Sequence            = None
@@ -66,7 +86,10 @@ except ImportError:
     c_Lookahead           = None
     c_NegativeLookahead   = None
     c_Nonterminal         = None
+    c_Memo                = None
     c_Group               = None
+    c_Probe               = None
+    c_Machine             = None
 
 NOMATCH = -1
 EOS = -2
@@ -78,12 +101,15 @@ TRACE = 2
 
 class Match(object):
     def __init__(self, s, pos, endpos, value=None):
-        self.string = s
+        self.string = s.source if type(s) is _Text else s
         self.pos = pos
         self.endpos = endpos
         self.value = value
         # self.lastindex = sum(n.lastindex for n in ast)
 
+    def __reduce__(self):
+        return (type(self), (self.string, self.pos, self.endpos, self.value))
+
     def start(self, group=0):
         if group == 0:
             return self.pos
@@ -110,26 +136,247 @@ class Match(object):
         return self.string[start:end]
 
 
+class py_Tree(object):
+    """
+    Compact parse tree built by Scanner.trace().
+
+    Nodes are numbered in pre-order (the root is node 0) and stored in
+    parallel arrays of 64-bit integers: *starts* and *ends* are the
+    span of each node, *parents* and *nexts* are the indices of the
+    parent and next sibling (or -1), and *ids* index *scanners*, the
+    list of the scanners that made the nodes. The first child of node
+    i, if any, is node i + 1. Match objects are only made on request.
+    """
+    def __init__(self, string):
+        self.string = string
+        self.starts = array('q')
+        self.ends = array('q')
+        self.parents = array('q')
+        self.nexts = array('q')
+        self.ids = array('q')
+        self.scanners = []
+        self._ids = {}
+        self._parent = -1
+        self._memos = []  # memo entries whose nodes are in the tree
+
+    def __len__(self):
+        return len(self.starts)
+
+    def parent(self, i):
+        """Return the index of the parent of node *i*, or -1."""
+        return self.parents[i]
+
+    def first_child(self, i):
+        """Return the index of the first child of node *i*, or -1."""
+        if i + 1 < len(self.starts) and self.parents[i + 1] == i:
+            return i + 1
+        return -1
+
+    def next_sibling(self, i):
+        """Return the index of the next sibling of node *i*, or -1."""
+        return self.nexts[i]
+
+    def children(self, i):
+        """Return the list of the indices of the children of node *i*."""
+        kids = []
+        j = self.first_child(i)
+        while j != -1:
+            kids.append(j)
+            j = self.nexts[j]
+        return kids
+
+    def scanner(self, i):
+        """Return the scanner that made node *i*."""
+        return self.scanners[self.ids[i]]
+
+    def rule(self, i):
+        """Return the rule name if node *i* is a nonterminal, or None."""
+        return getattr(self.scanner(i), '_name', None)
+
+    def match(self, i=0):
+        """Return a Match for node *i* with its text as the value."""
+        start, end = self.starts[i], self.ends[i]
+        return Match(self.string, start, end, self.string[start:end])
+
+    def evaluate(self, i=0):
+        """
+        Return the value that match() gives node *i*, running the
+        actions of the nodes whose values are used exactly once.
+        """
+        return _evaluate(self, i)
+
+    def walk(self):
+        """
+        Iterate over `(i, entering)` pairs, depth-first: each node is
+        yielded with `True` before its children and with `False` after.
+        """
+        stack = []
+        parents = self.parents
+        for i in range(len(self.starts)):
+            while stack and stack[-1] != parents[i]:
+                yield stack.pop(), False
+            yield i, True
+            stack.append(i)
+        while stack:
+            yield stack.pop(), False
+
+    def _open(self, scanner, pos):
+        i = len(self.starts)
+        sid = self._ids.get(id(scanner))
+        if sid is None:
+            sid = self._ids[id(scanner)] = len(self.scanners)
+            self.scanners.append(scanner)
+        self.starts.append(pos)
+        self.ends.append(-1)
+        self.parents.append(self._parent)
+        self.nexts.append(-1)
+        self.ids.append(sid)
+        self._parent = i
+        return i
+
+    def _close(self, i, end):
+        self.ends[i] = end
+        self._parent = self.parents[i]
+
+    def _leaf(self, scanner, pos, end):
+        self._close(self._open(scanner, pos), end)
+
+    def _truncate(self, n):
+        # drop the nodes from index n on (made by a failed attempt)
+        if self._memos:
+            self._save(n)
+        for a in (self.starts, self.ends, self.parents, self.nexts,
+                  self.ids):
+            del a[n:]
+
+    def _save(self, n):
+        # copy out the nodes of memo entries from index n on; the
+        # entries are in the order they were made, so an entry's inner
+        # entries come after it when popped and share its copy
+        memos = self._memos
+        outer = None
+        while memos and memos[-1].base >= n:
+            e = memos.pop()
+            if outer is not None and e.base >= outer.base:
+                e.saved = outer.saved
+                e.offset = outer.offset + e.base - outer.base
+            else:
+                j = e.base + e.count
+                e.saved = (self.starts[e.base:j], self.ends[e.base:j],
+                           self.parents[e.base:j], self.ids[e.base:j])
+                e.offset = 0
+                outer = e
+
+    def _copy(self, e):
+        # add the nodes of memo entry e under the open node
+        if e.saved is None:
+            a = e.base
+            starts, ends, parents, ids = (self.starts, self.ends,
+                                          self.parents, self.ids)
+        else:
+            a = e.offset
+            starts, ends, parents, ids = e.saved
+        b = a + e.count
+        shift = len(self.starts) - e.base
+        self.starts.extend(starts[a:b])
+        self.ends.extend(ends[a:b])
+        self.parents.extend([p + shift for p in parents[a:b]])
+        self.ids.extend(ids[a:b])
+        self.nexts.extend([-1] * e.count)
+
+    def _discard(self, i):
+        self._parent = self.parents[i]
+        self._truncate(i)
+
+    def _finish(self):
+        # link siblings; the last child seen of each node is kept in
+        # *last* (indexed by parent, or n for the roots)
+        n = len(self.starts)
+        last = [-1] * (n + 1)
+        nexts = self.nexts
+        for i, p in enumerate(self.parents):
+            if p < 0:
+                p = n
+            if last[p] >= 0:
+                nexts[last[p]] = i
+            last[p] = i
+
+
+class TreeCursor(object):
+    """
+    Cursor over the nodes of a Tree (of either scanner family).
+
+    The cursor starts at *node* and is moved with the goto_*() methods,
+    which return `False` (and stay put) if there is no such node, so a
+    tree can be walked without recursion.
+    """
+    def __init__(self, tree, node=0):
+        self.tree = tree
+        self.node = node
+
+    @property
+    def start(self): return self.tree.starts[self.node]
+    @property
+    def end(self): return self.tree.ends[self.node]
+    @property
+    def scanner(self): return self.tree.scanner(self.node)
+    @property
+    def rule(self): return self.tree.rule(self.node)
+    @property
+    def text(self): return self.tree.string[self.start:self.end]
+
+    def match(self):
+        """Return a Match for the current node."""
+        return self.tree.match(self.node)
+
+    def goto_parent(self):
+        return self._goto(self.tree.parents[self.node])
+
+    def goto_first_child(self):
+        return self._goto(self.tree.first_child(self.node))
+
+    def goto_next_sibling(self):
+        return self._goto(self.tree.nexts[self.node])
+
+    def _goto(self, i):
+        if i < 0:
+            return False
+        self.node = i
+        return True
+
+
 class py_Scanner(object):
     capturing = False
     action = None
+    skip = None  # trivia skipped first (see Grammar)
 
     def __init__(self, action=None):
         self.action = action
 
-    def scan(self, s, pos=0):
+    # Scanners are pickled as their constructor arguments (derived
+    # tables are rebuilt) with the action as the state.
+    def __reduce__(self):
+        return (type(self), (), self.action)
+
+    def __setstate__(self, state):
+        self.action = state
+
+    def scan(self, s, pos=0, partial=False):
         try:
-            return self._scan(s, pos)
+            return self._scan(_input(s, partial), pos)
         except IndexError:
             return NOMATCH
 
     def _match(self, s, pos, mode):
         try:
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
             end = self._scan(s, pos)
             if end == NOMATCH:
                 return None
             else:
-                val = s[pos:end]
+                val = _slice(s, pos, end)
                 action = self.action
                 if action is not None:
                     val = action(val)
@@ -137,59 +384,179 @@ class py_Scanner(object):
         except IndexError:
             return None
 
-    def match(self, s, pos=0, trace=False):
-        return self._match(s, pos, TRACE if trace else NORMAL)
+    def match(self, s, pos=0, trace=False, deferred=False, strict=False,
+              partial=False):
+        inp = _input(s, partial=partial, strict=strict)
+        if deferred or partial:
+            # recognize first, then run actions on the kept nodes only
+            t = self._trace(inp, pos)
+            m = None
+            if t is not None:
+                m = Match(s, pos, t.ends[0], _evaluate(t, 0))
+        else:
+            m = self._match(inp, pos, TRACE if trace else NORMAL)
+        if m is None and strict:
+            raise _failure(inp, pos)
+        return m
+
+    def trace(self, s, pos=0):
+        """
+        Return a Tree of the nodes matched in *s* at *pos*, or `None`
+        if there is no match. Unlike `match(s, trace=True)`, no Match
+        objects are made for the nodes.
+        """
+        return self._trace(_input(s), pos)
+
+    def _trace(self, s, pos):
+        t = py_Tree(_source(s))
+        try:
+            end = self._tree(s, pos, t)
+        except IndexError:
+            end = NOMATCH
+        if end < 0:
+            return None
+        t._finish()
+        return t
+
+    def _tree(self, s, pos, t):
+        # add the node(s) matched at pos to t; composite scanners open a
+        # node, add their children, and close or discard it
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        end = self._scan(s, pos)
+        if end >= 0:
+            t._leaf(self, pos, end)
+        return end
+
+    def _uses(self, t, i, j):
+        # whether the value of node i needs that of its child node j
+        return True
+
+    def _value(self, s, t, i, values):
+        # the value of node i from the values of its children, as in
+        # _match() with the NORMAL mode
+        val = _slice(s, t.starts[i], t.ends[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
+    def iter_matches(self, s, pos=0, delimiter=None):
+        """
+        Return an iterator yielding successive matches of the scanner
+        in *s*, separated by *delimiter* if given, starting at *pos*.
+        """
+        return py_MatchIterator(self, _input(s), pos, delimiter)
+
+
+class py_MatchIterator(object):
+    """
+    Iterator over successive matches of a scanner (see
+    Scanner.iter_matches()). Iteration stops at the end of the input or
+    where the scanner or delimiter fails; *pos* is then the offset
+    where it stopped. If *memo* is set, it is cleared before each match.
+    """
+    def __init__(self, scanner, s, pos, delimiter=None):
+        self._scanner = scanner
+        self._delimiter = delimiter
+        self._input = s
+        self.pos = pos
+        self.memo = None
+        self._started = False
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = pos = self.pos
+        if self._done:
+            raise StopIteration
+        if self._started and self._delimiter is not None:
+            pos = self._delimiter._scan(self._input, pos)
+        if 0 <= pos < len(self._input):
+            if self.memo is not None:
+                self.memo.clear()
+            m = self._scanner._match(self._input, pos, NORMAL)
+            if m is not None and m.endpos > start:
+                self._started = True
+                self.pos = m.endpos
+                return m
+            self.pos = pos
+        elif pos >= 0:
+            self.pos = pos
+        self._done = True
+        raise StopIteration
 
 class py_Dot(py_Scanner):
     def __repr__(self): return 'Dot()'
     def __str__(self): return '.'
     def _scan(self, s, pos):
-        s[pos]  # check for IndexError
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if pos >= len(s):
+            return _at_end(s, self, pos)
         return pos + 1
 
 
 class py_CharacterClass(py_Scanner):
     def __init__(self, clsstr, action=None):
         self.action = action
-        self._clsstr = clsstr
-        self._ranges = []
-        self._chars = []
-        i = 0
-        while i < len(clsstr)-2:
-            if clsstr[i+1] == u'-':
-                self._ranges.append((clsstr[i], clsstr[i+2]))
-            else:
-                self._chars.append(clsstr[i])
-            i += 1
-        # remaining character(s) cannot be ranges
-        while i < len(clsstr):
-            self._chars.append(clsstr[i])
-            i += 1
+        self._clsstr = clsstr = _as_text(clsstr)
+        self._negated, ranges = _parse_class(clsstr)
+        self._ranges = [(chr(a), chr(b)) for a, b in ranges]
+        # membership of Latin-1 characters (already negated if needed)
+        latin1 = bytearray([self._negated] * 256)
+        for a, b in ranges:
+            for c in range(a, min(b, 255) + 1):
+                latin1[c] = not self._negated
+        self._latin1 = bytes(latin1)
+        # sorted, disjoint ranges of characters beyond Latin-1
+        ranges = [(max(a, 256), b) for a, b in ranges if b > 255]
+        self._starts = [a for a, _ in ranges]
+        self._ends = [b for _, b in ranges]
 
     def __repr__(self): return 'CharacterClass({})'.format(repr(self._clsstr))
     def __str__(self): return '[{}]'.format(self._clsstr)
+    def __reduce__(self): return (type(self), (self._clsstr,), self.action)
 
     def _scan(self, s, pos):
-        c = s[pos]
-        if c in self._chars or any(a <= c <= b for a, b in self._ranges):
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if pos >= len(s):
+            return _at_end(s, self, pos)
+        c = ord(s[pos])
+        if c < 256:
+            return pos + 1 if self._latin1[c] else _fail(s, self, pos)
+        i = bisect_right(self._starts, c) - 1
+        if (i >= 0 and c <= self._ends[i]) != self._negated:
             return pos + 1
-        return NOMATCH
+        return _fail(s, self, pos)
 
 
 class py_Literal(py_Scanner):
     def __init__(self, x, action=None):
         self.action = action
-        self._x = x
-        self._xlen = len(x)
+        self._x = _as_text(x)
+        self._xlen = len(self._x)
 
     def __repr__(self): return 'Literal({})'.format(repr(self._x))
     def __str__(self): return '"{}"'.format(self._x)
+    def __reduce__(self): return (type(self), (self._x,), self.action)
 
     def _scan(self, s, pos):
-        end = pos + self._xlen
-        if s[pos:end] != self._x:
-            return NOMATCH
-        return end
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        x = self._x
+        if not s.startswith(x, pos):
+            if (_partial(s) and len(s) - self._xlen < pos <= len(s)
+                    and x.startswith(s[pos:])):
+                return EOS
+            return _fail(s, self, pos)
+        return pos + self._xlen
 
 
 class py_Regex(py_Scanner):
@@ -199,14 +566,31 @@ class py_Regex(py_Scanner):
             self.regex = pattern
         else:
             self.regex = re.compile(pattern)
+        # input is always scanned as str (see _input()), but bytes-like
+        # input and bytes patterns get ASCII semantics
+        self._regex = self.regex
+        self._ascii_regex = None
+        if not isinstance(self.regex.pattern, str):
+            self._regex = self._ascii_regex = _ascii_regex(self.regex)
 
     def __repr__(self): return 'Regex({})'.format(repr(self.regex.pattern))
     def __str__(self): return '/{}/'.format(self.regex.pattern)
+    def __reduce__(self): return (type(self), (self.regex,), self.action)
 
     def _scan(self, s, pos):
-        m = self.regex.match(s, pos=pos)
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        regex = self._regex
+        if type(s) is _Text and not isinstance(s.source, str):
+            regex = self._ascii_regex
+            if regex is None:
+                regex = self._ascii_regex = _ascii_regex(self.regex)
+        m = regex.match(s, pos)
+        if _partial(s) and (m.end() if m is not None else pos) >= len(s):
+            return EOS
         if m is None:
-            return NOMATCH
+            return _fail(s, self, pos)
         else:
             return m.end()
 
@@ -214,40 +598,90 @@ class py_Regex(py_Scanner):
 class py_Spacing(py_Scanner):
     def __init__(self, ws=u' \t\n\r\f\v', action=None):
         self.action = action
-        self._ws = ws
+        self._ws = _as_text(ws)
 
     def __repr__(self):
         return 'Spacing({})'.format(
             repr(self._ws) if self._ws != u' \t\n\r\f\v' else ''
         )
     def __str__(self): return '[{}]*'.format(repr(self._ws)[1:-1])
+    def __reduce__(self): return (type(self), (self._ws,), self.action)
 
     def _scan(self, s, pos):
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
         ws = self._ws
+        n = len(s)
+        while pos < n and s[pos] in ws:
+            pos += 1
+        if pos == n and _partial(s):
+            return EOS
+        return pos
+
+
+class _py_Numeric(py_Scanner):
+    # With *convert*, the value of a match is the number itself.
+    convert = False
+    _real = False  # float values, else int, or either if None
+
+    def __init__(self, action=None, convert=False):
+        self.action = action
+        self.convert = convert
+    def __repr__(self):
+        if self.convert:
+            return '{}(convert=True)'.format(self)
+        return '{}()'.format(self)
+    def __reduce__(self):
+        return (type(self), (None, self.convert), self.action)
+
+    def _match(self, s, pos, mode):
+        if not self.convert or mode == TRACE:
+            return py_Scanner._match(self, s, pos, mode)
         try:
-            while s[pos] in ws:
-                pos += 1
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
+            end = self._scan(s, pos)
         except IndexError:
-            pass
-        return pos
+            return None
+        if end == NOMATCH:
+            return None
+        val = _number_value(s, pos, end, self._real)
+        if self.action is not None:
+            val = self.action(val)
+        return Match(s, pos, end, val)
+
+    def _value(self, s, t, i, values):
+        if not self.convert:
+            return py_Scanner._value(self, s, t, i, values)
+        val = _number_value(s, t.starts[i], t.ends[i], self._real)
+        if self.action is not None:
+            val = self.action(val)
+        return val
 
 
-class py_Integer(py_Scanner):
-    def __repr__(self): return 'Integer()'
+class py_Integer(_py_Numeric):
     def __str__(self): return 'Integer'
 
     def _scan(self, s, pos):
         # [-+]? \d+
-        if s[pos] in u'-+':
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if _partial(s) and _INTEGER_PREFIX.fullmatch(s, pos):
+            return EOS
+        start = pos
+        if s.startswith(_SIGNS, pos):
             pos += 1
         numdigits = _scan_digits(s, pos)
         if numdigits == 0:
-            return NOMATCH
+            return _fail(s, self, start)
         return pos + numdigits
 
 
-class py_Float(py_Scanner):
-    def __repr__(self): return 'Float()'
+class py_Float(_py_Numeric):
+    _real = True
     def __str__(self): return 'Float'
 
     def _scan(self, s, pos):
@@ -256,23 +690,29 @@ class py_Float(py_Scanner):
         #   [-+]? \.\d+ ([eE][-+]?\d+)?
         #   [-+]? \d+ [eE][-+]?\d+
         # note that bare integers (e.g. 1, -1, etc.) are not accepted
-        if s[pos] in u'-+':  # [-+]?
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        if _partial(s) and _FLOAT_PREFIX.fullmatch(s, pos):
+            return EOS
+        start = pos
+        if s.startswith(_SIGNS, pos):  # [-+]?
             pos += 1
 
-        if s[pos] == u'.':  # \.\d+ ([eE][-+]?\d+)?
+        if s.startswith(u'.', pos):  # \.\d+ ([eE][-+]?\d+)?
             dpos = _scan_digits(s, pos+1)
             if dpos == 0:
-                return NOMATCH
+                return _fail(s, self, start)
             pos += dpos + 1
             pos += _scan_exponent(s, pos)
 
         else:  # other two patterns begin with \d+
             dpos = _scan_digits(s, pos)
             if dpos == 0:
-                return NOMATCH
+                return _fail(s, self, start)
             pos += dpos
 
-            if s[pos] == u'.':  # \d+\.\d* ([eE][-+]?\d+)?
+            if s.startswith(u'.', pos):  # \d+\.\d* ([eE][-+]?\d+)?
                 pos += 1
                 pos += _scan_digits(s, pos)
                 pos += _scan_exponent(s, pos)
@@ -280,33 +720,100 @@ class py_Float(py_Scanner):
             else:  # \d+ [eE][-+]?\d+
                 dpos = _scan_exponent(s, pos)
                 if dpos == 0:
-                    return NOMATCH
+                    return _fail(s, self, start)
                 pos += dpos
         return pos
 
 
+class py_Number(_py_Numeric):
+    # a Float or else an Integer, converted to a float or an int
+    _real = None
+    def __init__(self, action=None, convert=True):
+        self.action = action
+        self.convert = convert
+    def __repr__(self):
+        if not self.convert:
+            return 'Number(convert=False)'
+        return 'Number()'
+    def __str__(self): return 'Number'
+
+    def _scan(self, s, pos):
+        end = py_Float._scan(self, s, pos)
+        if end == NOMATCH:
+            end = py_Integer._scan(self, s, pos)
+        return end
+
+
 class py_BoundedString(py_Scanner):
-    def __init__(self, first, last, action=None):
+    # With *decode*, the value of a match is the string between the
+    # delimiters with JSON-style escapes decoded.
+    def __init__(self, first, last, action=None, decode=False):
         self.action = action
-        self.first = first
-        self.last = last
+        self.first = _as_text(first)
+        self.last = _as_text(last)
+        self.decode = decode
 
     def __repr__(self):
+        if self.decode:
+            return 'BoundedString("{}", "{}", decode=True)'.format(
+                self.first, self.last
+            )
         return 'BoundedString("{}", "{}")'.format(self.first, self.last)
     def __str__(self): return 'BoundedString'
+    def __reduce__(self):
+        return (type(self), (self.first, self.last, None, self.decode),
+                self.action)
 
     def _scan(self, s, pos):
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
         a, b = self.first, self.last
         alen, blen = len(a), len(b)
-        if s[pos:pos+alen] != a:
-            return NOMATCH
+        n = len(s)
+        start = pos
+        if not s.startswith(a, pos):
+            if (_partial(s) and n - alen < pos <= n
+                    and a.startswith(s[pos:])):
+                return EOS
+            return _fail(s, self, pos)
         pos += alen
-        while s[pos:pos+blen] != b:
-            if s[pos] == u'\\':
-                pos += 2
-            else:
-                pos += 1
-        return pos + blen
+        # jump between the next end delimiter and the next escape
+        end = s.find(b, pos)
+        while end >= 0:
+            esc = s.find(u'\\', pos, end)
+            if esc < 0:
+                return end + blen
+            pos = esc + 2
+            if end < pos:
+                end = s.find(b, pos)
+        return _at_end(s, self, start)
+
+    def _match(self, s, pos, mode):
+        if not self.decode or mode == TRACE:
+            return py_Scanner._match(self, s, pos, mode)
+        try:
+            pos = _skip(self, s, pos)
+            if pos < 0:
+                return None
+            end = self._scan(s, pos)
+        except IndexError:
+            return None
+        if end == NOMATCH:
+            return None
+        val = _unescape(s, pos + len(self.first), end - len(self.last))
+        if self.action is not None:
+            val = self.action(val)
+        return Match(s, pos, end, val)
+
+    def _value(self, s, t, i, values):
+        if not self.decode:
+            return py_Scanner._value(self, s, t, i, values)
+        val = _unescape(s, t.starts[i] + len(self.first),
+                        t.ends[i] - len(self.last))
+        if self.action is not None:
+            val = self.action(val)
+        return val
 
 
 class py_Bounded(py_Scanner):
@@ -321,6 +828,8 @@ class py_Bounded(py_Scanner):
             repr(self._lhs), repr(self._body), repr(self._rhs)
         )
     def __str__(self): return 'Bounded'
+    def __reduce__(self):
+        return (type(self), (self._lhs, self._body, self._rhs), self.action)
 
     def _scan(self, s, pos):
         end = self._lhs._scan(s, pos)
@@ -330,6 +839,28 @@ class py_Bounded(py_Scanner):
                 end = self._rhs._scan(s, end)
         return end
 
+    def _tree(self, s, pos, t):
+        i = t._open(self, pos)
+        end = self._lhs._tree(s, pos, t)
+        if end >= 0:
+            end = self._body._tree(s, end, t)
+            if end >= 0:
+                end = self._rhs._tree(s, end, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    def _uses(self, t, i, j):
+        return j != i + 1 and t.nexts[j] != -1  # only the body
+
+    def _value(self, s, t, i, values):
+        val = values[t.nexts[i + 1]]
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
     def _match(self, s, pos, mode):
         end = self._lhs._scan(s, pos)
         m = None
@@ -361,14 +892,37 @@ class py_Sequence(py_Scanner):
         return 'Sequence({})'.format(', '.join(map(repr, self._scanners)))
     def __str__(self):
         return ' '.join(map(str, self._scanners))
+    def __reduce__(self):
+        return (type(self), self._scanners, self.action)
 
     def _scan(self, s, pos):
         for scanner in self._scanners:
             pos = scanner._scan(s, pos)
-            if pos == NOMATCH:
+            if pos < 0:
                 break
         return pos
 
+    def _tree(self, s, pos, t):
+        i = t._open(self, pos)
+        for scanner in self._scanners:
+            pos = scanner._tree(s, pos, t)
+            if pos < 0:
+                t._discard(i)
+                return pos
+        t._close(i, pos)
+        return pos
+
+    def _uses(self, t, i, j):
+        return t.scanner(j).capturing
+
+    def _value(self, s, t, i, values):
+        val = _collect(t, i, values)
+        if not self.capturing:
+            val = _slice(s, t.starts[i], t.ends[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
     def _match(self, s, pos, mode):
         val = []
         end = pos
@@ -380,17 +934,15 @@ class py_Sequence(py_Scanner):
                 end = m.endpos
                 if mode == TRACE:
                     val.append(m)
-                elif scanner.action is None:
-                    val.extend(m.value)
                 else:
-                    val.append(m.value)
+                    _add(val, scanner, m.value, None)
             else:
                 end = scanner._scan(s, end)
                 if end == NOMATCH:
                     return None
         if mode != TRACE:
             if not self.capturing:
-                val = s[pos:end]
+                val = _slice(s, pos, end)
             action = self.action
             if action is not None:
                 val = action(val)
@@ -402,22 +954,67 @@ class py_Choice(py_Scanner):
         self.action = action
         self._scanners = scanners
         self.capturing = any(s.capturing for s in scanners)
+        self._dispatch = None
+        self._default = scanners
 
     def __repr__(self):
         return 'Choice({})'.format(', '.join(map(repr, self._scanners)))
     def __str__(self):
         return ' | '.join(map(str, self._scanners))
+    def __reduce__(self):
+        return (type(self), self._scanners,
+                (self.action, self._dispatch, self._default))
+    def __setstate__(self, state):
+        self.action, self._dispatch, self._default = state
+
+    def dispatch(self, table=None, default=()):
+        """
+        Only try the alternatives in *table*[c] when the next
+        character is c, or those in *default* when c is not in
+        *table*. Each entry must keep the alternatives in their
+        original order. At the end of the input, and when *table* is
+        `None` (which disables dispatching), all alternatives are tried.
+        """
+        self._dispatch = table
+        self._default = self._scanners if table is None else default
+
+    def _candidates(self, s, pos):
+        if self._dispatch is None:
+            return self._scanners
+        pos = _skip(self, s, pos)  # dispatch on the next token
+        if pos < 0 or pos >= len(s):
+            return self._scanners
+        return self._dispatch.get(s[pos], self._default)
 
     def _scan(self, s, pos):
-        for scanner in self._scanners:
+        for scanner in self._candidates(s, pos):
             endpos = scanner._scan(s, pos)
-            if endpos >= 0:
-                return endpos
+            if endpos != NOMATCH:
+                return endpos  # a match, or EOS if undecided
+        return NOMATCH
+
+    def _tree(self, s, pos, t):
+        i = t._open(self, pos)
+        for scanner in self._candidates(s, pos):
+            end = scanner._tree(s, pos, t)
+            if end >= 0:
+                t._close(i, end)
+                return end
+            elif end == EOS:
+                t._discard(i)
+                return EOS  # undecided
+        t._discard(i)
         return NOMATCH
 
+    def _value(self, s, t, i, values):
+        val = values[i + 1]
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
     def _match(self, s, pos, mode):
         val = None
-        for scanner in self._scanners:
+        for scanner in self._candidates(s, pos):
             m = scanner._match(s, pos, mode)
             if m is not None:
                 if mode == TRACE:
@@ -431,12 +1028,16 @@ class py_Choice(py_Scanner):
 
 
 class py_Repeat(py_Scanner):
-    def __init__(self, scanner, min=0, max=-1, delimiter=None, action=None):
+    # With a *sink*, the values the repetition would collect are passed
+    # to the sink as each item matches, and it has no value itself.
+    def __init__(self, scanner, min=0, max=-1, delimiter=None, action=None,
+                 sink=None):
         self.action = action
         self._scanner = scanner
         self._min = min
         self._max = max
         self._delimiter = delimiter
+        self.sink = sink
         self.capturing = (scanner.capturing or
                           (delimiter is not None and delimiter.capturing))
 
@@ -450,16 +1051,22 @@ class py_Repeat(py_Scanner):
         self._max,
         ':' + str(self._delimiter) if self._delimiter is not None else ''
     )
+    def __reduce__(self):
+        return (type(self),
+                (self._scanner, self._min, self._max, self._delimiter),
+                self.action)
 
     def _scan(self, s, pos):
         scanner, delimiter = self._scanner, self._delimiter
         a, b = self._min, self._max
         count = 0
         try:
-            newpos = scanner._scan(s, pos)
-            while newpos >= 0 and count != b:
+            newpos = scanner._scan(s, pos) if b != 0 else NOMATCH
+            while newpos >= 0:
                 pos = newpos
                 count += 1
+                if count == b:
+                    break  # without trying another item
                 if delimiter is not None:
                     newpos = delimiter._scan(s, pos)
                     if newpos < 0:
@@ -469,12 +1076,62 @@ class py_Repeat(py_Scanner):
                     newpos = scanner._scan(s, pos)
         except IndexError:
             pass
+        if newpos == EOS and count != b:
+            return EOS
         if count >= a:
             return pos
         return NOMATCH
 
+    def _tree(self, s, pos, t):
+        scanner, delimiter = self._scanner, self._delimiter
+        a, b = self._min, self._max
+        count = 0
+        end = pos
+        i = t._open(self, pos)
+        mark = len(t)
+        try:
+            while count != b:
+                mark = len(t)
+                newpos = end
+                if delimiter is not None and count > 0:
+                    newpos = delimiter._tree(s, newpos, t)
+                if newpos >= 0:
+                    newpos = scanner._tree(s, newpos, t)
+                if newpos < 0:
+                    t._truncate(mark)  # e.g., a trailing delimiter
+                    if newpos == EOS:
+                        t._discard(i)
+                        return EOS
+                    break
+                end = newpos
+                count += 1
+        except IndexError:
+            t._truncate(mark)
+            t._parent = i
+        if count >= a:
+            t._close(i, end)
+            return end
+        t._discard(i)
+        return NOMATCH
+
+    def _uses(self, t, i, j):
+        return t.scanner(j).capturing
+
+    def _value(self, s, t, i, values):
+        val = _collect(t, i, values)
+        if self.sink is not None:
+            for v in val:
+                self.sink(v)
+            return _EMITTED
+        if not self.capturing:
+            val = _slice(s, t.starts[i], t.ends[i])
+        if self.action is not None:
+            val = self.action(val)
+        return val
+
     def _match(self, s, pos, mode):
         scanner, delimiter = self._scanner, self._delimiter
+        sink = self.sink if mode != TRACE else None
         s_is_grp = scanner.capturing
         d_is_grp = delimiter.capturing if delimiter is not None else False
         a, b = self._min, self._max
@@ -489,35 +1146,37 @@ class py_Repeat(py_Scanner):
                 if mode == TRACE:
                     val.append(m)
                 elif s_is_grp:
-                    if scanner.action is None:
-                        val.extend(m.value)
-                    else:
-                        val.append(m.value)
+                    _add(val, scanner, m.value, sink)
+                if count == b:
+                    break
                 if delimiter is not None:
+                    d = None
                     if mode == TRACE or d_is_grp:
-                        m = delimiter._match(s, end, mode)
-                        if m is None:
+                        d = delimiter._match(s, end, mode)
+                        if d is None:
                             break
-                        d_end = m.endpos
-                        if mode == TRACE:
-                            val.append(m)
-                        elif delimiter.action is None:
-                            val.extend(m.value)
-                        else:
-                            val.append(m.value)
+                        d_end = d.endpos
                     else:
                         d_end = delimiter._scan(s, end)
                         if d_end == NOMATCH:
                             break
                     m = scanner._match(s, d_end, mode)
+                    # keep the delimiter only if an item follows it
+                    if m is not None and d is not None:
+                        if mode == TRACE:
+                            val.append(d)
+                        else:
+                            _add(val, delimiter, d.value, sink)
                 else:
                     m = scanner._match(s, end, mode)
         except IndexError:
             pass
         if count >= a:
-            if mode != TRACE:
+            if sink is not None:
+                val = _EMITTED
+            elif mode != TRACE:
                 if not (s_is_grp or d_is_grp):
-                    val = s[pos:end]
+                    val = _slice(s, pos, end)
                 action = self.action
                 if action is not None:
                     val = action(val)
@@ -537,6 +1196,8 @@ class py_Optional(py_Scanner):
 
     def __repr__(self): return 'Optional({})'.format(repr(self._scanner))
     def __str__(self): return str(self._scanner) + '?'
+    def __reduce__(self):
+        return (type(self), (self._scanner, self._default), self.action)
 
     def _scan(self, s, pos):
         scanner = self._scanner
@@ -546,13 +1207,35 @@ class py_Optional(py_Scanner):
                 end = pos
         except IndexError:
             end = pos
+        return end  # EOS is passed on
+
+    def _tree(self, s, pos, t):
+        i = t._open(self, pos)
+        try:
+            end = self._scanner._tree(s, pos, t)
+        except IndexError:
+            t._truncate(i + 1)
+            t._parent = i
+            end = NOMATCH
+        if end == EOS:
+            t._discard(i)
+            return EOS
+        elif end < 0:
+            end = pos
+        t._close(i, end)
         return end
 
+    def _value(self, s, t, i, values):
+        if t.first_child(i) == -1:
+            return self._default
+        return values[i + 1]
+
     def _match(self, s, pos, mode):
         scanner = self._scanner
         m = scanner._match(s, pos, mode)
         if mode == TRACE:
-            return Match(s, pos, pos, [m])  # m could be None
+            end = pos if m is None else m.endpos
+            return Match(s, pos, end, [m])  # m could be None
         elif m is None:
             return Match(s, pos, pos, self._default)
         else:
@@ -565,11 +1248,12 @@ class py_Lookahead(py_Scanner):
 
     def __repr__(self): return 'Lookahead({})'.format(repr(self._scanner))
     def __str__(self): return '&' + str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner,))
 
     def _scan(self, s, pos):
-        scanner = self._scanner
-        if scanner._scan(s, pos) == NOMATCH:
-            return NOMATCH
+        end = self._scanner._scan(s, pos)
+        if end < 0:
+            return end
         else:
             return pos
 
@@ -581,66 +1265,337 @@ class py_NegativeLookahead(py_Scanner):
     def __repr__(self):
         return 'NegativeLookahead({})'.format(repr(self._scanner))
     def __str__(self): return '!' + str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner,))
 
     def _scan(self, s, pos):
-        scanner = self._scanner
-        if scanner._scan(s, pos) == NOMATCH:
+        if type(s) is _Text:
+            s.quiet += 1  # failing here is not an error
+            try:
+                end = self._scanner._scan(s, pos)
+            finally:
+                s.quiet -= 1
+        else:
+            end = self._scanner._scan(s, pos)
+        if end == NOMATCH:
             return pos
+        elif end == EOS:
+            return EOS
         else:
-            return NOMATCH
+            return _fail(s, self, pos)
+
+
+class _TreeEntry(object):
+    # a memoized rule in a Tree: where it ends and the *count* nodes of
+    # its body, at index *base* of the tree or, once dropped from it,
+    # at index *offset* of the *saved* arrays
+    __slots__ = ('end', 'base', 'count', 'saved', 'offset')
+
+    def __init__(self, end, base, count):
+        self.end = end
+        self.base = base
+        self.count = count
+        self.saved = None
+        self.offset = 0
+
+
+class _MemoTable(object):
+    # the entries of a Memo for one thread
+    def __init__(self, string):
+        self.string = string
+        self.scans = {}
+        self.matches = {}
+        self.traces = {}
+        self.trees = {}  # for the Tree in *tree*
+        self.tree = None
+        self.horizon = 0
+
+    def __len__(self):
+        return sum(
+            len(entries)
+            for table in (self.scans, self.matches, self.traces,
+                          self.trees)
+            for entries in table.values()
+        )
+
+    def evict(self, pos, window):
+        if window < 0:
+            return
+        horizon = pos - window
+        # sweep only after the horizon moved a full window so the cost
+        # is amortized over the stored entries
+        if horizon - self.horizon > window:
+            for table in (self.scans, self.matches, self.traces,
+                          self.trees):
+                for key in [key for key in table if key < horizon]:
+                    del table[key]
+            self.horizon = horizon
+
+
+class py_Memo(object):
+    """
+    Packrat memoization table shared by one or more Nonterminals.
+
+    Results are stored per rule name and position for the string
+    currently being parsed; the table is emptied when a different
+    string is seen or when clear() is called. If *window* is
+    non-negative, entries more than *window* characters behind the
+    most recently stored position are evicted so memory stays bounded
+    on long inputs. The *hits* and *misses* attributes count lookups.
+
+    Each thread has its own table, so a Memo (and the grammar using
+    it) may be shared by threads parsing different strings; len() and
+    clear() apply to the calling thread's table. The counts are not
+    synchronized and are approximate when threads parse concurrently.
+    """
+
+    def __init__(self, window=-1):
+        self.window = window
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+
+    def __reduce__(self):
+        return (type(self), (self.window,))  # entries are not kept
+
+    def __len__(self):
+        return len(self._table(None))
+
+    def clear(self):
+        self._local.table = _MemoTable(None)
+
+    def _table(self, string):
+        # the calling thread's table, emptied if *string* is new
+        table = getattr(self._local, 'table', None)
+        if table is None or (string is not None
+                             and string is not table.string):
+            table = self._local.table = _MemoTable(string)
+        return table
+
+    def _scan(self, scanner, name, s, pos):
+        table = self._table(s)
+        entries = table.scans.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            return entries[name]
+        self.misses += 1
+        end = scanner._scan(s, pos)
+        if entries is None:
+            entries = table.scans[pos] = {}
+            table.evict(pos, self.window)
+        entries[name] = end
+        return end
+
+    def _match(self, scanner, name, s, pos, mode):
+        memo = self._table(s)
+        table = memo.traces if mode == TRACE else memo.matches
+        entries = table.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            end, value = entries[name]
+            if end == NOMATCH:
+                return None
+            return Match(s, pos, end, value)
+        self.misses += 1
+        m = scanner._match(s, pos, mode)
+        if entries is None:
+            entries = table[pos] = {}
+            memo.evict(pos, self.window)
+        if m is None:
+            entries[name] = (NOMATCH, None)
+        else:
+            entries[name] = (m.endpos, m.value)
+        return m
+
+    def _tree(self, scanner, name, s, pos, t):
+        # a hit copies the nodes of the rule's body into t
+        memo = self._table(s)
+        if memo.tree is not t:
+            memo.tree = t
+            memo.trees = {}
+        entries = memo.trees.get(pos)
+        if entries is not None and name in entries:
+            self.hits += 1
+            e = entries[name]
+            if e.end >= 0:
+                t._copy(e)
+            return e.end
+        self.misses += 1
+        base = len(t)
+        end = scanner._tree(s, pos, t)
+        if entries is None:
+            entries = memo.trees[pos] = {}
+            memo.evict(pos, self.window)
+        e = entries[name] = _TreeEntry(end, base, len(t) - base)
+        if end >= 0:
+            t._memos.append(e)
+        return end
 
 
 class py_Nonterminal(py_Scanner):
-    def __init__(self, grammar, name, action=None):
+    # With a *sink*, the value of each match is passed to the sink
+    # instead (see py_Repeat).
+    memo = None
+    sink = None
+
+    def __init__(self, grammar, name, action=None, memo=None, sink=None):
         self.action = action
         self._grammar = grammar
         self._name = name
+        self._scanner = None
+        self.memo = memo
+        self.sink = sink
 
     def __repr__(self): return 'Nonterminal(<dict>, "{}")'.format(self._name)
     def __str__(self): return self._name
+    def __reduce__(self):
+        return (type(self), (self._grammar, self._name, None, self.memo),
+                (self.action, self._scanner))
+    def __setstate__(self, state):
+        self.action, self._scanner = state
+
+    def link(self):
+        """
+        Bind the nonterminal directly to its rule's scanner so scanning
+        no longer looks the rule up in the grammar. Raise a ValueError
+        if the rule is not defined.
+        """
+        try:
+            scanner = self._grammar[self._name]
+        except KeyError:
+            scanner = None
+        if scanner is None:
+            raise ValueError('Undefined rule: {}'.format(self._name))
+        self._scanner = scanner
 
-    def _scan(self, s, pos):
+    def unlink(self):
+        """Revert to looking up the rule at scan time."""
+        self._scanner = None
+
+    def _resolve(self):
         scanner = self._grammar[self._name]
         if scanner is None:
             raise Exception(
                 'Nonterminal {} is not associated with a grammar'
                 .format(self._name)
             )
+        return scanner
+
+    def _scan(self, s, pos):
+        scanner = self._scanner
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)  # before a token rule
+        if pos < 0:
+            return pos
+        memo = self.memo
+        if memo is not None:
+            return memo._scan(scanner, self._name, s, pos)
         return scanner._scan(s, pos)
 
+    def _tree(self, s, pos, t):
+        scanner = self._scanner
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return pos
+        i = t._open(self, pos)
+        if self.memo is not None:
+            end = self.memo._tree(scanner, self._name, s, pos, t)
+        else:
+            end = scanner._tree(s, pos, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    def _value(self, s, t, i, values):
+        val = values[i + 1]
+        if val is _EMITTED:
+            return val
+        if self.action is not None:
+            val = self.action(val)
+        if self.sink is not None:
+            self.sink(val)
+            val = _EMITTED
+        return val
+
     def _match(self, s, pos, mode):
-        scanner = self._grammar[self._name]
-        m = scanner._match(s, pos, mode)
+        scanner = self._scanner
+        if scanner is None:
+            scanner = self._resolve()
+        pos = _skip(self, s, pos)
+        if pos < 0:
+            return None
+        memo = self.memo
+        if memo is not None:
+            m = memo._match(scanner, self._name, s, pos, mode)
+        else:
+            m = scanner._match(s, pos, mode)
         if m is not None:
             if mode == TRACE:
                 m = Match(s, pos, m.endpos, [m])
-            else: 
+            elif m.value is not _EMITTED:
                 action = self.action
                 if action is not None:
                     m.value = action(m.value)
+                if self.sink is not None:
+                    self.sink(m.value)
+                    m.value = _EMITTED
         return m
 
 
 class py_Group(py_Scanner):
-    def __init__(self, scanner, action=None):
+    # With a *sink*, the value the group would add to its parent's
+    # values is passed to the sink instead (see py_Repeat).
+    def __init__(self, scanner, action=None, sink=None):
         self.action = action
         self._scanner = scanner
         self.action = action
         self.capturing = True
+        self.sink = sink
 
     def __repr__(self): return 'Group({})'.format(repr(self._scanner))
     def __str__(self): return '({})'.format(str(self._scanner))
+    def __reduce__(self): return (type(self), (self._scanner,), self.action)
 
     def _scan(self, s, pos):
         scanner = self._scanner
         return scanner._scan(s, pos)
 
+    def _tree(self, s, pos, t):
+        i = t._open(self, pos)
+        end = self._scanner._tree(s, pos, t)
+        if end < 0:
+            t._discard(i)
+        else:
+            t._close(i, end)
+        return end
+
+    def _value(self, s, t, i, values):
+        val = values[i + 1]
+        if val is _EMITTED:
+            return val
+        if self.sink is not None:
+            self.sink(val if self.action is None else self.action(val))
+            return _EMITTED
+        if self.action is None:
+            return [val]
+        return self.action(val)
+
     def _match(self, s, pos, mode):
         scanner = self._scanner
         m = scanner._match(s, pos, mode)
         if m is not None:
             if mode == TRACE:
                 m = Match(s, pos, m.endpos, [m])
+            elif m.value is _EMITTED:
+                pass
+            elif self.sink is not None:
+                action = self.action
+                self.sink(m.value if action is None else action(m.value))
+                m.value = _EMITTED
             elif self.action is None:
                 m.value = [m.value]
             else:
@@ -648,8 +1603,255 @@ class py_Group(py_Scanner):
         return m
 
 
+
+# time spent in nested probes, used to compute self time
+_probe_child_time = 0.0
+
+
+class py_Probe(py_Scanner):
+    """
+    Wrapper recording statistics about the scans and matches of
+    *scanner* (see textpy.profiling); results are not changed.
+
+    *calls* counts invocations, of which *successes* matched and
+    *failures* did not (EOS counts as a failure), *consumed* is the
+    number of characters matched, *time* and *self_time* are the
+    seconds spent with and without nested probes, and *retries* counts
+    invocations at a position already tried on the same input.
+    """
+    def __init__(self, scanner, name=None):
+        self._scanner = scanner
+        self.name = name
+        self.capturing = scanner.capturing
+        # parents check the action to decide how to use values, but
+        # only the wrapped scanner applies it
+        self.action = scanner.action
+        self.reset()
+
+    def __repr__(self): return 'Probe({})'.format(repr(self._scanner))
+    def __str__(self): return str(self._scanner)
+    def __reduce__(self): return (type(self), (self._scanner, self.name))
+
+    def reset(self):
+        """Set all statistics to zero."""
+        self.calls = self.successes = self.failures = 0
+        self.consumed = self.retries = 0
+        self.time = self.self_time = 0.0
+        self._string = None
+        self._positions = set()
+
+    def _enter(self, s, pos):
+        global _probe_child_time
+        source = s.source if type(s) is _Text else s
+        if source is not self._string:
+            self._string = source
+            self._positions = set()
+        if pos in self._positions:
+            self.retries += 1
+        else:
+            self._positions.add(pos)
+        self.calls += 1
+        _probe_child_time = 0.0
+        return perf_counter()
+
+    def _exit(self, start, outer, pos, end):
+        global _probe_child_time
+        elapsed = perf_counter() - start
+        self.time += elapsed
+        self.self_time += elapsed - _probe_child_time
+        _probe_child_time = outer + elapsed
+        if end >= 0:
+            self.successes += 1
+            self.consumed += end - pos
+        else:
+            self.failures += 1
+
+    def _scan(self, s, pos):
+        outer = _probe_child_time
+        start = self._enter(s, pos)
+        end = NOMATCH
+        try:
+            end = self._scanner._scan(s, pos)
+        finally:
+            self._exit(start, outer, pos, end)
+        return end
+
+    def _tree(self, s, pos, t):
+        return self._scanner._tree(s, pos, t)  # not a node
+
+    def _match(self, s, pos, mode):
+        outer = _probe_child_time
+        start = self._enter(s, pos)
+        m = None
+        try:
+            m = self._scanner._match(s, pos, mode)
+        finally:
+            self._exit(start, outer, pos, NOMATCH if m is None else m.endpos)
+        return m
+
+
+# the opcodes of textpy.vm, in the same order
+(_SCAN, _CHAR, _SET, _SPAN, _CHOICE, _COMMIT, _PCOMMIT, _BCOMMIT,
+ _FAILNOT, _FAIL, _CALL, _RET, _OPEN, _CLOSE, _LEAF, _SKIP, _QUIET,
+ _END) = range(18)
+
+
+class py_Machine(py_Scanner):
+    """
+    Scanner running a program made by `textpy.vm.compile()` from
+    *scanner*, with an explicit backtracking stack instead of nested
+    calls (see textpy.vm).
+    """
+    def __init__(self, scanner, code, nodes):
+        self._scanner = scanner
+        self._code = tuple(code)
+        self._nodes = list(nodes)
+        # parents check the action to decide how to use values, but
+        # only the compiled scanner applies it
+        self.action = scanner.action
+        self.capturing = scanner.capturing
+
+    def __repr__(self): return 'Machine({})'.format(repr(self._scanner))
+    def __str__(self): return str(self._scanner)
+    def __reduce__(self):
+        return (type(self), (self._scanner, self._code, self._nodes))
+
+    def _scan(self, s, pos):
+        return self._run(s, pos, None)
+
+    def _tree(self, s, pos, t):
+        return self._run(s, pos, t)
+
+    def _match(self, s, pos, mode):
+        t = py_Tree(_source(s))
+        end = self._run(s, pos, t)
+        if end < 0:
+            return None
+        t._finish()
+        if mode == TRACE:
+            return _traced(s, t, 0)
+        return Match(s, pos, end, _evaluate(t, 0))
+
+    def _run(self, s, pos, t):
+        # scan from *pos*, adding nodes to *t* unless it is None; the
+        # stack has [pc, pos, mark, parent, quiet] backtrack entries
+        # and [pc, None] return addresses
+        code, nodes = self._code, self._nodes
+        text = type(s) is _Text
+        quiet = s.quiet if text else 0
+        stack = []
+        pc = 0
+        try:
+            while True:
+                op, arg = code[pc]
+                ok = True
+                if op == _SCAN or op == _CHAR or op == _SET:
+                    node = nodes[arg]
+                    if t is None or op != _SCAN:
+                        end = node._scan(s, pos)
+                        if end >= 0 and t is not None:
+                            t._leaf(node, pos, end)
+                    else:
+                        end = node._tree(s, pos, t)
+                    if end == EOS:
+                        return EOS
+                    ok = end >= 0
+                    pos = end
+                    pc += 1
+                elif op == _SPAN:
+                    node = nodes[arg]
+                    cc = node._scanner
+                    start = pos
+                    if t is not None:
+                        i = t._open(node, pos)
+                    end = cc._scan(s, pos)
+                    while end >= 0:
+                        if t is not None:
+                            t._leaf(cc, pos, end)
+                        pos = end
+                        end = cc._scan(s, pos)
+                    if end == EOS:
+                        return EOS
+                    ok = pos - start >= node._min
+                    if ok and t is not None:
+                        t._close(i, pos)
+                    pc += 1
+                elif op == _CHOICE:
+                    entry = [arg, pos, 0, 0, s.quiet if text else 0]
+                    if t is not None:
+                        entry[2:4] = len(t), t._parent
+                    stack.append(entry)
+                    pc += 1
+                elif op == _COMMIT:
+                    stack.pop()
+                    pc = arg
+                elif op == _PCOMMIT:
+                    entry = stack[-1]
+                    entry[1] = pos
+                    if t is not None:
+                        entry[2:4] = len(t), t._parent
+                    pc = arg
+                elif op == _BCOMMIT or op == _FAILNOT:
+                    _, pos, mark, parent, q = stack.pop()
+                    if text:
+                        s.quiet = q
+                    if t is not None:
+                        t._truncate(mark)
+                        t._parent = parent
+                    if op == _BCOMMIT:
+                        pc = arg
+                    else:
+                        _fail(s, nodes[arg], pos)
+                        ok = False
+                elif op == _FAIL:
+                    ok = False
+                elif op == _CALL:
+                    stack.append([pc + 1, None])
+                    pc = arg
+                elif op == _RET:
+                    pc = stack.pop()[0]
+                elif op == _OPEN:
+                    if t is not None:
+                        t._open(nodes[arg], pos)
+                    pc += 1
+                elif op == _CLOSE:
+                    if t is not None:
+                        t._close(t._parent, pos)
+                    pc += 1
+                elif op == _LEAF:
+                    if t is not None:
+                        t._leaf(nodes[arg], pos, pos)
+                    pc += 1
+                elif op == _SKIP:
+                    pos = _skip(nodes[arg], s, pos)
+                    if pos < 0:
+                        return pos
+                    pc += 1
+                elif op == _QUIET:
+                    if text:
+                        s.quiet += arg
+                    pc += 1
+                else:  # _END
+                    return pos
+                if not ok:
+                    # unwind to the last backtrack entry
+                    while stack and stack[-1][1] is None:
+                        stack.pop()
+                    if not stack:
+                        return NOMATCH
+                    pc, pos, mark, parent, q = stack.pop()
+                    if text:
+                        s.quiet = q
+                    if t is not None:
+                        t._truncate(mark)
+                        t._parent = parent
+        finally:
+            if text:
+                s.quiet = quiet
+
 # use fast versions if available
 
+Tree                = c_Tree or py_Tree
 Scanner             = c_Scanner or py_Scanner
 Dot                 = c_Dot or py_Dot
 CharacterClass      = c_CharacterClass or py_CharacterClass
@@ -658,6 +1860,7 @@ Regex               = c_Regex or py_Regex
 Spacing             = c_Spacing or py_Spacing
 Integer             = c_Integer or py_Integer
 Float               = c_Float or py_Float
+Number              = c_Number or py_Number
 BoundedString       = c_BoundedString or py_BoundedString
 Bounded             = c_Bounded or py_Bounded
 Sequence            = c_Sequence or py_Sequence
@@ -667,7 +1870,10 @@ Optional            = c_Optional or py_Optional
 Lookahead           = c_Lookahead or py_Lookahead
 NegativeLookahead   = c_NegativeLookahead or py_NegativeLookahead
 Nonterminal         = c_Nonterminal or py_Nonterminal
+Memo                = c_Memo or py_Memo
 Group               = c_Group or py_Group
+Probe               = c_Probe or py_Probe
+Machine             = c_Machine or py_Machine
 
 # convenient partial applications
 
@@ -715,28 +1921,320 @@ def split(s, sep=u' \t\v\n\f\r', maxsplit=-1, esc=u'\\', quotes=u'"\''):
 # helper functions
 
 # (these helpers do not follow the normal return-value semantics)
+
+def _evaluate(t, i):
+    # compute the values of the nodes under node i that are used, in
+    # post-order so actions run in the order of the input
+    s = _input(t.string)
+    parents, nexts = t.parents, t.nexts
+    end = i
+    while end != -1 and nexts[end] == -1:
+        end = parents[end]
+    end = len(t) if end == -1 else nexts[end]
+    values = [None] * len(t)
+    used = bytearray(len(t))
+    used[i] = 1
+    stack = []
+    for j in range(i, end):
+        p = parents[j]
+        if j > i and used[p] and t.scanner(p)._uses(t, p, j):
+            used[j] = 1
+        while stack and stack[-1] != p:
+            k = stack.pop()
+            if used[k]:
+                values[k] = t.scanner(k)._value(s, t, k, values)
+        stack.append(j)
+    while stack:
+        k = stack.pop()
+        if used[k]:
+            values[k] = t.scanner(k)._value(s, t, k, values)
+    return values[i]
+
+
+def _traced(s, t, i):
+    # the Match that match(trace=True) gives for node i, built from the
+    # nodes under it in post-order rather than by nested calls
+    parents = t.parents
+    end = i
+    while end != -1 and t.nexts[end] == -1:
+        end = parents[end]
+    end = len(t) if end == -1 else t.nexts[end]
+    stack = []  # (node, Match objects of its children) of open nodes
+    m = None
+    for j in range(i, end + 1):
+        p = parents[j] if j < end else -2
+        while stack and stack[-1][0] != p:
+            k, val = stack.pop()
+            m = _traced_node(s, t, k, val)
+            if stack:
+                stack[-1][1].append(m)
+        stack.append((j, []))
+    return m
+
+
+def _traced_node(s, t, i, val):
+    # the Match of node i, given those of its children
+    scanner = t.scanner(i)
+    start, end = t.starts[i], t.ends[i]
+    if isinstance(scanner, (py_Sequence, py_Choice, py_Repeat, py_Group,
+                            py_Nonterminal)):
+        return Match(s, start, end, val)
+    elif isinstance(scanner, py_Optional):
+        return Match(s, start, end, val or [None])
+    elif isinstance(scanner, py_Bounded):
+        return Match(s, start, end, val[1:2])  # only the body
+    return scanner._match(s, start, TRACE)  # terminals have no children
+
+
+def _collect(t, i, values):
+    # the values of the capturing children of node i, as a list
+    val = []
+    j = t.first_child(i)
+    while j != -1:
+        scanner = t.scanner(j)
+        if scanner.capturing:
+            _add(val, scanner, values[j], None)
+        j = t.nexts[j]
+    return val
+
+
+class _Emitted(tuple):
+    # the value of a match whose value went to a sink; it adds nothing
+    # to the values of its parent
+    __slots__ = ()
+
+
+_EMITTED = _Emitted()
+
+
+def _add(vals, scanner, value, sink):
+    # add the value of a match of a capturing *scanner* to *vals*, or
+    # pass what would be added to *sink*
+    if value is _EMITTED:
+        return
+    if scanner.action is None:
+        if sink is None:
+            vals.extend(value)
+        else:
+            for v in value:
+                sink(v)
+    elif sink is None:
+        vals.append(value)
+    else:
+        sink(value)
+
+
+class _Text(str):
+    # A bytes-like input decoded as Latin-1 so the scanners can read it
+    # as a str (captured values are sliced from *buffer* instead), a
+    # *partial* input that more input may follow, or an input recording
+    # the *farthest* offset where terminals failed (see _fail()).
+    partial = False
+    farthest = -1
+    expected = ()
+    quiet = 0
+
+
+def _input(s, partial=False, strict=False):
+    if isinstance(s, str):
+        if not (partial or strict):
+            return s
+        buf = text = s
+    else:
+        buf = s
+        if not isinstance(s, bytes):
+            buf = memoryview(s)
+            if buf.ndim != 1 or buf.format != 'B':
+                buf = buf.cast('B')
+        text = str(buf, 'latin-1')
+    text = _Text(text)
+    text.source = s
+    text.buffer = buf
+    text.partial = partial
+    return text
+
+
+def _partial(s):
+    return type(s) is _Text and s.partial
+
+
+def _unescape(s, pos, end):
+    # s[pos:end] with JSON-style escapes decoded; invalid escapes are
+    # kept as they are. The result is a str, or bytes for byte input
+    # (with the decoded characters encoded as UTF-8).
+    x = s[pos:end]
+    if type(s) is _Text and not isinstance(s.source, str):
+        x = _ESCAPE.sub(_utf8_escape, x)
+        return x.encode('latin-1')
+    return _ESCAPE.sub(_str_escape, x)
+
+
+def _str_escape(m):
+    hi, lo, code, char = m.groups()
+    if char is not None:
+        return _ESCAPES[char]
+    elif code is not None:
+        return chr(int(code, 16))
+    return chr(0x10000 + ((int(hi, 16) - 0xD800) << 10)
+               + (int(lo, 16) - 0xDC00))
+
+
+def _utf8_escape(m):
+    # the escaped character as UTF-8 bytes read as Latin-1
+    c = _str_escape(m)
+    return c.encode('utf-8', 'surrogatepass').decode('latin-1')
+
+
+def _number_value(s, pos, end, real):
+    # the number spelled by s[pos:end] as a float if *real* is True, an
+    # int if it is False, or as spelled if it is None
+    x = s[pos:end]
+    if real is None:
+        real = not x.lstrip(u'-+').isdigit()
+    return float(x) if real else int(x)
+
+
+def _skip(scanner, s, pos):
+    # the position after the trivia skipped before *scanner* at pos
+    if scanner.skip is None:
+        return pos
+    if type(s) is _Text:
+        s.quiet += 1  # missing trivia is not an error
+        try:
+            end = scanner.skip._scan(s, pos)
+        finally:
+            s.quiet -= 1
+    else:
+        end = scanner.skip._scan(s, pos)
+    return pos if end == NOMATCH else end
+
+
+def _at_end(s, scanner, pos):
+    # the result of a terminal that needs to read past the end of *s*
+    return EOS if _partial(s) else _fail(s, scanner, pos)
+
+
+def _fail(s, scanner, pos):
+    # record that *scanner* failed at *pos* and return NOMATCH; only
+    # inputs made by _input() keep the records
+    if type(s) is _Text and pos >= s.farthest and not s.quiet:
+        if pos > s.farthest:
+            s.farthest = pos
+            s.expected = set()
+        s.expected.add(scanner)
+    return NOMATCH
+
+
+def _failure(s, pos):
+    # the ParseError for a failed match of *s* from *pos*
+    return _parse_error(s.source, max(pos, s.farthest), s.expected)
+
+
+# the JSON-style escapes decoded by BoundedString with *decode*
+_ESCAPE = re.compile(
+    r'\\(?:u([dD][89abAB][0-9a-fA-F]{2})\\u([dD][c-fC-F][0-9a-fA-F]{2})'
+    r'|u([0-9a-fA-F]{4})|(["\\/bfnrt]))'
+)
+_ESCAPES = {
+    u'"': u'"', u'\\': u'\\', u'/': u'/', u'b': u'\b', u'f': u'\f',
+    u'n': u'\n', u'r': u'\r', u't': u'\t',
+}
+# the inputs that Integer and Float read to the end of, when partial
+_INTEGER_PREFIX = re.compile(r'[-+]?[0-9]*')
+_FLOAT_PREFIX = re.compile(
+    r'[-+]?(?:(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]*)?|\.?)'
+)
+
+
+def _source(s):
+    return s.source if type(s) is _Text else s
+
+
+def _slice(s, pos, end):
+    if type(s) is _Text:
+        return s.buffer[pos:end]
+    return s[pos:end]
+
+
+def _as_text(x):
+    # patterns may be given as bytes, which are read as Latin-1
+    if isinstance(x, str):
+        return x
+    return str(x, 'latin-1')
+
+
+def _ascii_regex(regex):
+    # recompile *regex* to match like a bytes regex on the str that
+    # _input() produces
+    pattern = regex.pattern
+    if not isinstance(pattern, str):
+        pattern = pattern.decode('latin-1')
+    return re.compile(pattern, (regex.flags & ~re.UNICODE) | re.ASCII)
+
+
+_CLASS_ESCAPES = {
+    u'n': u'\n', u't': u'\t', u'r': u'\r', u'f': u'\f', u'v': u'\v'
+}
+
+
+def _parse_class(clsstr):
+    # Return (negated, ranges) for the class string, where ranges is a
+    # sorted list of disjoint (first, last) code point pairs.
+    negated = False
+    items = []
+    i, n = 0, len(clsstr)
+    if n > 1 and clsstr[0] == u'^':
+        negated = True
+        i = 1
+    while i < n:
+        c = clsstr[i]
+        i += 1
+        if c == u'\\' and i < n:
+            c = _CLASS_ESCAPES.get(clsstr[i], clsstr[i])
+            i += 1
+        if i < n and clsstr[i] == u'-' and i + 1 < n:
+            d = clsstr[i+1]
+            i += 2
+            if d == u'\\' and i < n:
+                d = _CLASS_ESCAPES.get(clsstr[i], clsstr[i])
+                i += 1
+            if d < c:
+                raise ValueError(
+                    'Invalid range in character class: ' + clsstr
+                )
+            items.append((ord(c), ord(d)))
+        else:
+            items.append((ord(c), ord(c)))
+    ranges = []
+    for a, b in sorted(items):
+        if ranges and a <= ranges[-1][1] + 1:
+            if b > ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], b)
+        else:
+            ranges.append((a, b))
+    return negated, ranges
+
+_SIGNS = (u'-', u'+')
+_EXPONENTS = (u'e', u'E')
+
+
 def _scan_digits(s, pos):
     i = 0
-    try:
-        while u'0' <= s[pos+i] <= u'9':
-            i += 1
-    except IndexError:
-        pass
+    n = len(s)
+    while pos + i < n and u'0' <= s[pos+i] <= u'9':
+        i += 1
     return i
 
 
 def _scan_exponent(s, pos):
     numdigits = 0
-    try:
-        if s[pos] in u'eE':
-            if s[pos+1] in '-+':
-                numdigits = _scan_digits(s, pos+2)
-                if numdigits > 0:
-                    return numdigits + 2
-            else:
-                numdigits = _scan_digits(s, pos+1)
-                if numdigits > 0:
-                    return numdigits + 1
-    except IndexError:
-        pass
+    if s.startswith(_EXPONENTS, pos):
+        if s.startswith(_SIGNS, pos+1):
+            numdigits = _scan_digits(s, pos+2)
+            if numdigits > 0:
+                return numdigits + 2
+        else:
+            numdigits = _scan_digits(s, pos+1)
+            if numdigits > 0:
+                return numdigits + 1
     return 0
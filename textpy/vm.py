@@ -0,0 +1,245 @@
+'''
+Compilation of scanners into programs for a parsing machine.
+
+`compile()` turns a scanner, and the rules reachable through its
+nonterminals, into a flat list of instructions in the style of LPeg's
+parsing machine. The program is run by a `Machine` scanner with an
+explicit, heap-allocated backtracking stack, so deeply nested input
+does not nest calls. A Machine scans, traces, and matches like the
+scanner it was compiled from, with two differences: actions (and
+sinks) only run on the nodes that are kept, as in deferred matching,
+and memo tables, dispatch tables, and Probes are not used. The Match
+objects of `match(trace=True)` are built from the machine's Tree, so
+they do not nest calls either.
+
+Each instruction is an `(opcode, argument)` pair, where the argument
+is the index of a scanner in the program's node list or the address
+of another instruction:
+
+    SCAN n     scan with node n (a terminal, or any other scanner the
+               machine does not compile) or, when tracing, add its tree
+    CHAR n     match the one-character Literal n
+    SET n      match the CharacterClass n
+    SPAN n     match the Repeat n of a CharacterClass
+    CHOICE l   push a backtrack entry resuming at l
+    COMMIT l   pop the entry and jump to l
+    PCOMMIT l  update the entry to the current position and jump to l
+    BCOMMIT l  pop the entry, restoring its position, and jump to l
+    FAILNOT n  pop the entry, restoring it, and fail as node n (a
+               NegativeLookahead)
+    FAIL       backtrack to the last entry
+    CALL l     push a return address and jump to l
+    RET        return
+    OPEN n     start a tree node for node n (when tracing)
+    CLOSE      end the current tree node
+    LEAF n     add an empty tree node for node n
+    SKIP n     skip the trivia before node n
+    QUIET d    add d to the depth where failures are not recorded
+    END        succeed
+'''
+
+from textpy import scanners
+from textpy.optimize import kind, children
+
+
+(SCAN, CHAR, SET, SPAN, CHOICE, COMMIT, PCOMMIT, BCOMMIT, FAILNOT, FAIL,
+ CALL, RET, OPEN, CLOSE, LEAF, SKIP, QUIET, END) = range(18)
+
+OPCODES = ('SCAN', 'CHAR', 'SET', 'SPAN', 'CHOICE', 'COMMIT', 'PCOMMIT',
+           'BCOMMIT', 'FAILNOT', 'FAIL', 'CALL', 'RET', 'OPEN', 'CLOSE',
+           'LEAF', 'SKIP', 'QUIET', 'END')
+
+# repetitions with more bounded items than this are scanned by their
+# Repeat instead of being unrolled
+MAX_UNROLL = 16
+
+
+def compile(scanner):
+    '''
+    Return a Machine running *scanner* compiled into a program.
+
+    Nonterminals are compiled into calls of their rules, which must be
+    defined (e.g., by compiling the grammar first). The Machine is from
+    the same family as *scanner* and does not see later changes to the
+    scanners or rules it was compiled from.
+    '''
+    c = _Compiler()
+    c.compile(scanner)
+    c.emit(END)
+    c.compile_rules()
+    if isinstance(scanner, scanners.py_Scanner):
+        cls = scanners.py_Machine
+    else:
+        cls = scanners.c_Machine
+    return cls(scanner, c.code, c.nodes)
+
+
+def disassemble(machine):
+    '''
+    Return a listing of the program run by *machine*.
+    '''
+    lines = []
+    for i, (op, arg) in enumerate(machine._code):
+        name = OPCODES[op]
+        if op in (SCAN, CHAR, SET, SPAN, FAILNOT, OPEN, LEAF, SKIP):
+            lines.append('{:4d} {:8s} {}'.format(i, name,
+                                                 machine._nodes[arg]))
+        elif op in (CHOICE, COMMIT, PCOMMIT, BCOMMIT, CALL, QUIET):
+            lines.append('{:4d} {:8s} {}'.format(i, name, arg))
+        else:
+            lines.append('{:4d} {}'.format(i, name))
+    return '\n'.join(lines)
+
+
+class _Compiler(object):
+    def __init__(self):
+        self.code = []
+        self.nodes = []
+        self._index = {}  # id(scanner) -> index in nodes
+        self._rules = {}  # id(rule) -> address, or None if pending
+        self._calls = []  # (address of CALL, rule)
+
+    def emit(self, op, arg=0):
+        self.code.append((op, arg))
+        return len(self.code) - 1
+
+    def patch(self, addr, target=None):
+        # point the instruction at *addr* to *target* (or the next one)
+        if target is None:
+            target = len(self.code)
+        self.code[addr] = (self.code[addr][0], target)
+
+    def node(self, scanner):
+        i = self._index.get(id(scanner))
+        if i is None:
+            i = self._index[id(scanner)] = len(self.nodes)
+            self.nodes.append(scanner)
+        return i
+
+    def compile(self, x):
+        k = kind(x)
+        emit, node = self.emit, self.node
+        if k == 'Literal' and x.skip is None and len(x._x) == 1:
+            emit(CHAR, node(x))
+        elif k == 'CharacterClass' and x.skip is None:
+            emit(SET, node(x))
+        elif k in ('Sequence', 'Bounded', 'Group'):
+            emit(OPEN, node(x))
+            for sub in children(x):
+                self.compile(sub)
+            emit(CLOSE)
+        elif k == 'Choice':
+            self._choice(x)
+        elif k == 'Repeat':
+            self._repeat(x)
+        elif k == 'Optional':
+            emit(OPEN, node(x))
+            choice = emit(CHOICE)
+            self.compile(x._scanner)
+            self.patch(emit(COMMIT))
+            self.patch(choice)
+            emit(CLOSE)
+        elif k == 'Lookahead':
+            choice = emit(CHOICE)
+            self.compile(x._scanner)
+            commit = emit(BCOMMIT)
+            self.patch(choice)
+            emit(FAIL)
+            self.patch(commit)
+            emit(LEAF, node(x))
+        elif k == 'NegativeLookahead':
+            choice = emit(CHOICE)
+            emit(QUIET, 1)
+            self.compile(x._scanner)
+            emit(FAILNOT, node(x))
+            self.patch(choice)
+            emit(LEAF, node(x))
+        elif k == 'Nonterminal':
+            if x.skip is not None:
+                emit(SKIP, node(x))
+            emit(OPEN, node(x))
+            self._calls.append((emit(CALL), _rule(x)))
+            emit(CLOSE)
+        else:  # terminals and anything else
+            emit(SCAN, node(x))
+
+    def _choice(self, x):
+        emit = self.emit
+        emit(OPEN, self.node(x))
+        alternatives = x._scanners
+        if not alternatives:
+            emit(FAIL)
+        commits = []
+        for alt in alternatives[:-1]:
+            choice = emit(CHOICE)
+            self.compile(alt)
+            commits.append(emit(COMMIT))
+            self.patch(choice)
+        if alternatives:
+            self.compile(alternatives[-1])
+        for commit in commits:
+            self.patch(commit)
+        emit(CLOSE)
+
+    def _repeat(self, x):
+        emit = self.emit
+        item, delimiter = x._scanner, x._delimiter
+        a, b = x._min, x._max
+        if (b < 0 and delimiter is None and item.skip is None
+                and kind(item) == 'CharacterClass'):
+            emit(SPAN, self.node(x))
+            return
+        if (a if b < 0 else b) > MAX_UNROLL:
+            emit(SCAN, self.node(x))
+            return
+        emit(OPEN, self.node(x))
+        for i in range(a):
+            if i > 0 and delimiter is not None:
+                self.compile(delimiter)
+            self.compile(item)
+        exits = []
+        if b < 0:
+            if a == 0 and delimiter is not None:
+                # the first item has no delimiter before it
+                exits.append(emit(CHOICE))
+                self.compile(item)
+                self.patch(emit(COMMIT))
+            exits.append(emit(CHOICE))
+            loop = len(self.code)
+            if delimiter is not None:
+                self.compile(delimiter)
+            self.compile(item)
+            emit(PCOMMIT, loop)
+        else:
+            for i in range(a, b):
+                exits.append(emit(CHOICE))
+                if i > 0 and delimiter is not None:
+                    self.compile(delimiter)
+                self.compile(item)
+                self.patch(emit(COMMIT))
+        for choice in exits:
+            self.patch(choice)
+        emit(CLOSE)
+
+    def compile_rules(self):
+        # compile the body of each called rule once, ending in RET
+        while self._calls:
+            calls, self._calls = self._calls, []
+            for addr, rule in calls:
+                target = self._rules.get(id(rule))
+                if target is None:
+                    target = self._rules[id(rule)] = len(self.code)
+                    self.node(rule)  # keep it alive with the program
+                    self.compile(rule)
+                    self.emit(RET)
+                self.patch(addr, target)
+
+
+def _rule(nonterminal):
+    # the scanner of the rule a nonterminal refers to
+    scanner = nonterminal._scanner
+    if scanner is None:
+        scanner = nonterminal._grammar.get(nonterminal._name)
+    if scanner is None:
+        raise ValueError('Undefined rule: {}'.format(nonterminal._name))
+    return scanner